@@ -6,6 +6,7 @@ import urllib
 from urllib.parse import urlparse
 from tkinter import *
 from BaseReader import BaseReader
+import SocketQueue
 from Bastion import Bastion
 
 
@@ -163,7 +164,8 @@ class AppletLoader:
         else:
             # Asynchronous loading
             self.parent = self.make_parent()
-            api = self.app.open_url(self.codeurl, 'GET', {}, self.reload)
+            params = {SocketQueue.PRIORITY: SocketQueue.FRAME}
+            api = self.app.open_url(self.codeurl, 'GET', params, self.reload)
             ModuleReader(self.context, api, self)
 
     def make_parent(self):
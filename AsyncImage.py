@@ -1,6 +1,7 @@
 from FileReader import TempFileReader
 from tkinter import *
 from utils import grailutil
+import SocketQueue
 import os
 
 TkPhotoImage = PhotoImage
@@ -101,6 +102,7 @@ class BaseAsyncImage:
         if context: self.context = context
         if self.reader:
             return
+        self.headers[SocketQueue.PRIORITY] = self.context.image_priority()
         try:
             api = self.context.app.open_url(self.url, 'GET', self.headers,
                                             self.reload or reload) 
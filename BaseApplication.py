@@ -24,6 +24,7 @@ import printing.filetypes
 import printing.htmltags
 import protocols
 import protocols.ProtocolAPI
+from SocketQueue import SocketQueue
 
 
 class BaseApplication(grailbase.app.Application):
@@ -43,6 +44,18 @@ class BaseApplication(grailbase.app.Application):
         # cache of available extensions
         self.__extensions = {}
 
+        # socket management
+        sockets = self.prefs.GetInt('sockets', 'number')
+        per_host = self.prefs.GetInt('sockets', 'per-host')
+        self.sq = SocketQueue(sockets, per_host)
+        self.prefs.AddGroupCallback('sockets',
+                                    lambda self=self: \
+                                    self.sq.change_max(
+                                        self.prefs.GetInt('sockets',
+                                                          'number'),
+                                        self.prefs.GetInt('sockets',
+                                                          'per-host')))
+
     def find_type_extension(self, package, mimetype):
         handler = None
         try:
@@ -1,8 +1,10 @@
 """Base reader class -- read from a URL in the background."""
 
 import sys
+import time
 import tkinter
 # from tkinter import *
+import IOLoop
 from urllib.parse import urlparse
 from utils import grailutil
 
@@ -10,7 +12,10 @@ from utils import grailutil
 # Default tuning parameters
 # BUFSIZE = 8*1024                      # Buffer size for api.getdata()
 BUFSIZE = 512                           # Smaller size for better response
+MAXBUFSIZE = 64*1024                    # Largest the buffer size grows to
 SLEEPTIME = 100                         # Milliseconds between regular checks
+DRAINTIME = 0.05                        # Seconds of reading per wakeup
+STATUSTIME = 0.2                        # Seconds between status updates
 
 class BaseReader:
 
@@ -22,6 +27,12 @@ class BaseReader:
     Derived classes are supposed to override the handle_*() methods to
     do something meaningful.
 
+    Each time the API has data, the reader keeps reading for up to
+    draintime seconds, as long as more is ready.  The buffer size
+    doubles after a full read and halves after one that filled less
+    than half of it, between BUFSIZE and maxbufsize; and the status
+    display is updated at most every statustime seconds.
+
     The sequence of calls made to the stop and handle_* functions can
     be expressed by a regular expression:
 
@@ -31,6 +42,9 @@ class BaseReader:
 
     # Tuning parameters
     sleeptime = SLEEPTIME
+    maxbufsize = MAXBUFSIZE
+    draintime = DRAINTIME
+    statustime = STATUSTIME
 
     def __init__(self, context, api):
         self.context = context
@@ -38,7 +52,9 @@ class BaseReader:
         self.callback = self.checkmeta
         self.poller = self.api.pollmeta
         self.bufsize = BUFSIZE
-        
+        self.last_status = 0            # time of the last status update
+        self.status_pending = 0
+
         # Stuff for status reporting
         self.nbytes = 0
         self.maxbytes = 0
@@ -49,6 +65,7 @@ class BaseReader:
 
         self.fno = None   # will be assigned by start
         self.killed = None
+        self.loop = IOLoop.get_loop(context.app)
 
         # Only http_access has delayed startup property.
         # Second argument would allow implementation of persistent
@@ -78,8 +95,7 @@ class BaseReader:
             if self.fno >= 20: self.fno = -1 # XXX for SGI Tk OPEN_MAX bug
 
         if self.fno >= 0:
-            tkinter.createfilehandler(
-                self.fno, tkinter.READABLE, self.checkapi)
+            self.loop.add_reader(self.fno, self.checkapi)
         else:
             # No fileno() -- check every 100 ms
             self.checkapi_regularly()
@@ -113,11 +129,20 @@ class BaseReader:
         return "%s(...%s)" % (self.__class__.__name__, self.api)
 
     def update_status(self):
+        self.status_pending = 0
+        self.last_status = time.time()
         self.context.new_reader_status() # Will call our __str__() method
 
+    def flush_status(self):
+        # Show the bytes counted since the last update, unless that
+        # was too recent; the next wakeup or stop() will catch up.
+        if self.status_pending and self.context \
+           and time.time() - self.last_status >= self.statustime:
+            self.update_status()
+
     def update_maxbytes(self, headers):
         self.maxbytes = 0
-        if headers.has_key('content-length'):
+        if 'content-length' in headers:
             try:
                 self.maxbytes = int(headers['content-length'])
             except ValueError:
@@ -126,7 +151,7 @@ class BaseReader:
 
     def update_nbytes(self, data):
         self.nbytes = self.nbytes + len(data)
-        self.update_status()
+        self.status_pending = 1
 
     def kill(self):
         self.killed = 1
@@ -134,10 +159,13 @@ class BaseReader:
         self.handle_error(-1, "Killed", {})
 
     def stop(self):
+        if self.status_pending and self.context:
+            self.update_status()
+
         if self.fno >= 0:
             fno = self.fno
             self.fno = -1
-            tkinter.deletefilehandler(fno)
+            self.loop.remove_reader(fno)
 
         self.callback = None
         self.poller = None
@@ -158,7 +186,7 @@ class BaseReader:
         if self.callback:
             sleeptime = self.sleeptime
             if self.poller and self.poller()[1]: sleeptime = 0
-            self.context.root.after(sleeptime, self.checkapi_regularly)
+            self.loop.call_later(sleeptime, self.checkapi_regularly)
 
     def checkapi(self, *args):
         if not self.callback:
@@ -166,7 +194,7 @@ class BaseReader:
             if self.fno >= 0:
                 fno = self.fno
                 self.fno = -1
-                tkinter.deletefilehandler(fno)
+                self.loop.remove_reader(fno)
             return
         try:
             self.callback()                     # Call via function pointer
@@ -184,19 +212,30 @@ class BaseReader:
             self.getapimeta()
 
     def checkdata(self):
-        self.message, ready = self.api.polldata()
-        if ready:
+        # Drain what is ready, within the time limit
+        deadline = time.time() + self.draintime
+        while self.api and self.callback == self.checkdata:
+            self.message, ready = self.api.polldata()
+            if not ready:
+                break
             self.getapidata()
+            if time.time() >= deadline:
+                # What is ready may already be buffered, in which case
+                # the descriptor won't wake us up again
+                if self.api:
+                    self.loop.call_later(0, self.checkapi)
+                break
+        self.flush_status()
 
     def getapimeta(self):
         errcode, errmsg, headers = self.api.getmeta()
         self.callback = self.checkdata
         self.poller = self.api.polldata
-        if headers.has_key('content-type'):
+        if 'content-type' in headers:
             content_type = headers['content-type']
         else:
             content_type = None
-        if headers.has_key('content-encoding'):
+        if 'content-encoding' in headers:
             content_encoding = headers['content-encoding']
         else:
             content_encoding = None
@@ -208,11 +247,16 @@ class BaseReader:
             self.callback()             # XXX Handle httpAPI readahead
 
     def getapidata(self):
-        data = self.api.getdata(self.bufsize)
+        bufsize = self.bufsize
+        data = self.api.getdata(bufsize)
         if not data:
             self.handle_eof()
             self.stop()
             return
+        if len(data) >= bufsize:
+            self.bufsize = min(bufsize * 2, max(self.maxbufsize, bufsize))
+        elif len(data) < bufsize // 2:
+            self.bufsize = max(bufsize // 2, BUFSIZE)
         self.update_nbytes(data)
         self.handle_data(data)
 
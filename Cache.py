@@ -13,6 +13,8 @@ SharedItemExpired = 'SharedItem Expired'
 
 from functools import cache
 from utils.Assert import Assert
+import bisect
+import hashlib
 import os
 import protocols
 import time
@@ -33,6 +35,14 @@ class SharedItem:
     The disk cache passes an disk_cache_access api which sets some
     basic headers and starts the object out in the DATA state.
 
+    Data fetched from the network for a cacheable item is not kept in
+    memory: it is teed into a spool file in the cache directory as it
+    arrives, readers are served from that file by offset, and the
+    cache adopts the file by renaming it once the load is complete.
+    Other items (POSTs, cache hits) keep their chunks in self.data;
+    self.offsets holds the starting offset of each chunk, so a reader
+    at any offset finds its chunk by bisection.
+
     """
 
     def __init__(self, url, mode, params, cache, key, data=None,
@@ -51,8 +61,11 @@ class SharedItem:
         self.reloading = 0
         self.data = []
         self.datalen = 0
-        self.datamap = {}
+        self.offsets = []
         self.complete = 0
+        self.spool = None
+        self.spoolname = None
+        self.digest = None
 
         # initialize in one of four states
         # some variables may be initialized in reset or refresh
@@ -111,6 +124,7 @@ class SharedItem:
                 self.finish()
             else:
                 self.abort()
+            self.close_spool()
 
     def cache_update(self):
         if (self.incache == 0 or self.reloading == 1) \
@@ -154,36 +168,32 @@ class SharedItem:
             if not buf:
                 self.finish()
                 self.complete = 1
+            elif self.spool or (self.datalen == 0 and self.open_spool()):
+                self.spool.write(buf)
+                self.digest.update(buf)
+                self.datalen = self.datalen + len(buf)
             else:
-                l = len(buf)
-                if l > maxbytes:
-                    # we got more than we wanted,
-                    # so split into two strings (avoid search next time)
-                    self.data.append(buf[:maxbytes])
-                    self.datamap[offset] = len(self.data) - 1
-                    self.data.append(buf[maxbytes:])
-                    self.datamap[offset+maxbytes] = len(self.data) - 1
-                else:
-                    self.data.append(buf)
-                    self.datamap[offset] = len(self.data) - 1
-                self.datalen = self.datalen + l
-
-        try:
-            # the common case
-            chunk = self.data[self.datamap[offset]]
-            if len(chunk) > maxbytes:
-                return chunk[0:maxbytes]
-            else:
-                return chunk
-        except KeyError:
+                self.data.append(buf)
+                self.offsets.append(self.datalen)
+                self.datalen = self.datalen + len(buf)
+
+        if self.spool:
+            return os.pread(self.spool.fileno(), maxbytes, offset)
+
+        if offset >= self.datalen:
             if self.stage == META:
                 self.meta = self.api.getmeta()
                 self.stage = DATA
-            elif self.complete == 1 and offset >= self.datalen:
-                return ''
-            chunk_key, delta = self._getdata_search_string_list(offset)
-            chunk = self.data[self.datamap[chunk_key]]
-            return chunk[delta:]
+            return ''
+
+        # O(log k) in the number of chunks, wherever the offset falls
+        i = bisect.bisect_right(self.offsets, offset) - 1
+        chunk = self.data[i]
+        delta = offset - self.offsets[i]
+        if delta == 0 and len(chunk) <= maxbytes:
+            # the common case
+            return chunk
+        return chunk[delta:delta+maxbytes]
 
     def fileno(self):
         if self.api:
@@ -196,7 +206,7 @@ class SharedItem:
 
     def finish(self):
         if self.cache:
-            self.cache.deactivate(self.key)
+            self.cache.deactivate(self.key, self)
             if not (self.meta and self.meta[0] == 200):
                 self.cache.delete(self.key)
         self.stage = DONE
@@ -205,31 +215,50 @@ class SharedItem:
         if api:
             api.close()
 
-    def _getdata_search_string_list(self, offset):
-        ### WARNING: this lookup is costly, please avoid
-        ###          cost is O(k), where k is # of chunks
-        ###          if you use this a lot, you'll get O(N^2) reads
-        delta = offset
-        chunk_key = None
-        for chunk_offset in self.datamap.keys():
-            if offset > chunk_offset:
-                diff = offset - chunk_offset
-                if diff <= delta:
-                    delta = diff
-                    chunk_key = chunk_offset
-        return chunk_key, delta
+    def open_spool(self):
+        """Start teeing the data to a spool file, if it will be cached.
+
+        Only called once the meta data is in, so the cache can apply
+        the same test it uses before storing an item (see
+        CacheManager.spool_p); anything it would refuse stays in
+        memory. Returns true if a spool file was opened.
+        """
+        if not self.cache or self.postdata or self.iscached() \
+           or not self.meta or not self.cache.spool_p(self):
+            return 0
+        self.spool, self.spoolname = self.cache.new_spool()
+        if not self.spool:
+            return 0
+        self.digest = hashlib.sha1()
+        return 1
+
+    def close_spool(self):
+        """Close the spool file, removing it unless the cache took it."""
+        spool = self.spool
+        self.spool = None
+        if spool:
+            spool.close()
+        if self.spoolname:
+            try:
+                os.unlink(self.spoolname)
+            except os.error:
+                pass
+            self.cache.release_spool(self.spoolname)
+            self.spoolname = None
 
     def init_new_load(self,stage):
+        self.close_spool()
         self.meta = None
         self.data = []
         self.datalen = 0
-        self.datamap = {}
+        self.offsets = []
         self.stage = stage
         self.complete = 0
 
-    def refresh(self,when):
+    def refresh(self,validators):
+        # validators holds If-None-Match and/or If-Modified-Since
         params = copy.copy(self.params)
-        params['If-Modified-Since'] = when.get_str()
+        params.update(validators)
         self.api = protocols.protocol_access(self.url,
                                              self.mode, params,
                                              data=self.postdata)
@@ -244,6 +273,7 @@ class SharedItem:
         if self.meta[0] == 304:
             # we win! it hasn't been modified
             # but we probably need to delete the api object
+            self.cache.revalidated(self.key, self.meta[2])
             self.api.close()
             self.api = self.cache_api
             self.meta = self.api.getmeta()
@@ -1,13 +1,22 @@
 from Cache import SharedItem, SharedAPI
+import CachePolicy
+import SocketQueue
 from utils.Assert import Assert
-from urllib.parse import urlparse
-import urllib
+from urllib.parse import urlparse, urlunparse
+import string
 import os
+import mmap
+import tempfile
 import time
 from utils import ht_time
 from utils import grailutil
 import mimetypes
 import re
+import hashlib
+import base64
+import heapq
+import itertools
+from collections import OrderedDict
 
 META, DATA, DONE = 'META', 'DATA', 'DONE' # Three stages
 
@@ -41,8 +50,9 @@ def parse_cache_control(s):
     def parse_directive(s):
         i = str.find(s, '=')
         if i >= 0:
-            return (s[:i], s[i+1:])
-        return (s, '')
+            return (str.lower(str.strip(s[:i])),
+                    str.strip(str.strip(s[i+1:]), '"'))
+        return (str.lower(str.strip(s)), '')
     elts = str.split(s, ',')
     return map(parse_directive, elts)
 
@@ -68,11 +78,29 @@ class CacheManager:
     count; when that cound reaches zero, it removes itself from the
     list. 
 
+    memory: an optional MemoryCache holding the bodies of recently
+    used disk cache entries, sized by the disk-cache--memory-size
+    preference. It is not one of the caches in the hierarchy list;
+    DiskCacheEntry.get() consults it before going to disk.
+
+    vary = {}: for each URL whose responses carried a Vary header,
+    the request headers it named. The cache key for such a URL
+    includes the values of those request headers (see url2key).
+
+    stats = {}: hit counts per tier ('memory', 'disk') and misses,
+    see hit_rates(); also the number of conditional requests answered
+    with 304 ('revalidated') and the body bytes they did not transfer
+    ('bytes-saved').
+
     freshness: CM is partly responsible for checking the freshness of
     pages. (pages with explicit TTL know when they expire.) freshness
     tests are preference driven, can be never, per session, or per
     time-unit. on each open, check to see if we should send an
     If-Mod-Since to the original server (based on fresh_p method).
+    Pages past their Expires date or Cache-Control max-age are
+    revalidated with If-None-Match/If-Modified-Since as well; unless
+    they are marked must-revalidate, they may be served stale while
+    the revalidation runs in the background (see serve_stale_p).
 
     """
     
@@ -85,10 +113,17 @@ class CacheManager:
         self.caches = []
         self.items = {}
         self.active = {}
+        self.spools = {}
+        self.vary = {}
+        self.stats = {'memory': 0, 'disk': 0, 'miss': 0,
+                      'revalidated': 0, 'bytes-saved': 0}
+        self.memory = None
+        self.set_memory_size(self.app.prefs.GetInt('disk-cache',
+                                                   'memory-size') * 1024)
         self.disk = None
-        self.disk = DiskCache(self, self.app.prefs.GetInt('disk-cache',
-                                                     'size') * 1024,
-                         self.app.prefs.Get('disk-cache', 'directory'))
+        self.disk = self.new_disk_cache(self.app.prefs.GetInt('disk-cache',
+                                                              'size') * 1024,
+                                self.app.prefs.Get('disk-cache', 'directory'))
         self.set_freshness_test()
         self.app.prefs.AddGroupCallback('disk-cache', self.update_prefs)
 
@@ -96,20 +131,37 @@ class CacheManager:
         bool = self.app.prefs.GetInt('disk-cache', 'checkpoint')
         if bool:
             self.app.register_on_exit(lambda save=self.save_cache_state:save())
+        else:
+            self.app.register_on_exit(lambda flush=self.flush_logs:flush())
 
     def save_cache_state(self):
         for cache in self.caches:
+            cache.flush_log()
             cache._checkpoint_metadata()
 
+    def flush_logs(self):
+        """Commit any log writes the caches are holding back."""
+        for cache in self.caches:
+            cache.flush_log()
+
     def update_prefs(self):
         self.set_freshness_test()
+        self.set_memory_size(self.app.prefs.GetInt('disk-cache',
+                                                   'memory-size') * 1024)
         size = self.caches[0].max_size = self.app.prefs.GetInt('disk-cache',
                                                                'size') \
                                                                * 1024
         new_dir = self.app.prefs.Get('disk-cache', 'directory')
-        if new_dir != self.disk.pref_dir:
+        journal = self.app.prefs.Get('disk-cache', 'journal')
+        if new_dir != self.disk.pref_dir \
+           or journal != self.disk.journal_type:
+            self.disk.flush_log()
             self.disk._checkpoint_metadata()
             self.reset_disk_cache(size, new_dir)
+        else:
+            self.disk.set_durability(self.app.prefs.Get('disk-cache',
+                                                        'durability'))
+            self.disk.set_policy(self.app.prefs.Get('disk-cache', 'policy'))
 
     def reset_disk_cache(self, size=None, dir=None, flush_log=0):
         """Close the current disk cache and open a new one.
@@ -126,9 +178,47 @@ class CacheManager:
         if not dir:
             dir = self.disk.directory
         self.disk.close(flush_log)
-        self.disk = DiskCache(self, size, dir)
+        self.disk = self.new_disk_cache(size, dir)
+
+    def set_memory_size(self, size):
+        """Resize the in-memory tier; a size of 0 disables it."""
+        if size <= 0:
+            self.memory = None
+        elif self.memory:
+            self.memory.set_size(size)
+        else:
+            self.memory = MemoryCache(size)
+
+    def hit_rates(self):
+        """Return a dictionary of hit rates per tier, as fractions."""
+        total = self.stats['memory'] + self.stats['disk'] + self.stats['miss']
+        rates = {}
+        for tier in ('memory', 'disk'):
+            if total:
+                rates[tier] = float(self.stats[tier]) / total
+            else:
+                rates[tier] = 0.0
+        return rates
+
+    def new_disk_cache(self, size, dir):
+        """Create a disk cache using the journal format from the prefs."""
+        journal = self.app.prefs.Get('disk-cache', 'journal')
+        if journal == 'sqlite':
+            cache = SQLiteDiskCache(self, size, dir)
+        else:
+            cache = DiskCache(self, size, dir)
+        cache.set_durability(self.app.prefs.Get('disk-cache', 'durability'))
+        cache.set_policy(self.app.prefs.Get('disk-cache', 'policy'))
+        for entry in cache.items.values():
+            if entry.vary:
+                self.learn_vary(entry.key, entry.vary)
+        return cache
         
     def set_freshness_test(self):
+        self.stale_window = self.app.prefs.GetInt('disk-cache',
+                                                  'stale-while-revalidate')
+        self.sort_query = self.app.prefs.GetBoolean('disk-cache',
+                                                    'sort-query')
         # read preferences to determine when pages should be checked
         # for freshness -- once per session, every n secs, or never
         fresh_type = self.app.prefs.Get('disk-cache', 'freshness-test-type')
@@ -185,18 +275,23 @@ class CacheManager:
 
         try:
             api = self.cache_read(key)
-        except CacheReadFailed as cache:
+        except CacheReadFailed as err:
+            cache = err.args[0]
             cache.evict(key)
             api = None
         if api:
             # creating reference to cached item
+            entry = self.items[key]
             if reload:
                 item = SharedItem(url, mode, params, self, key, data, api,
                                  reload=reload)
                 self.touch(key)
-            elif not self.fresh_p(key):
+            elif entry.stale_p() and self.serve_stale_p(entry):
+                item = SharedItem(url, mode, params, self, key, data, api)
+                self.revalidate(key, url, mode, params)
+            elif entry.stale_p() or not self.fresh_p(key):
                 item = SharedItem(url, mode, params, self, key, data, api,
-                                 refresh=self.items[key].lastmod)
+                                 refresh=entry.validators())
                 self.touch(key,refresh=1)
             else:
                 item = SharedItem(url, mode, params, self, key, data, api)
@@ -219,11 +314,69 @@ class CacheManager:
         self.active[item.key] = item
         return SharedAPI(self.active[item.key])
 
-    def deactivate(self,key):
-        """Removes a SharedItem from the shared object list."""
-        if self.active.has_key(key):
+    def deactivate(self,key,item=None):
+        """Removes a SharedItem from the shared object list.
+
+        If item is given, it is only removed if it is the active one.
+        """
+        if key in self.active \
+           and (item is None or self.active[key] is item):
             del self.active[key]
 
+    def serve_stale_p(self,entry):
+        """Check if a stale entry may be served while it is revalidated.
+
+        Allowed for entries not marked must-revalidate (or no-cache)
+        that are no further past their expiry than the larger of the
+        disk-cache--stale-while-revalidate preference and the
+        response's own stale-while-revalidate directive, in seconds.
+        """
+        directives = entry.directives()
+        if 'must-revalidate' in directives or 'no-cache' in directives:
+            return 0
+        window = self.stale_window
+        try:
+            window = max(window,
+                         int(directives.get('stale-while-revalidate', 0)))
+        except ValueError:
+            pass
+        return time.time() - entry.expires.get_secs() <= window
+
+    def revalidate(self,key,url,mode,params):
+        """Revalidate a cache entry in the background.
+
+        A conditional request is made through a SharedItem that is not
+        on the shared object list; a 304 response refreshes the entry,
+        anything else replaces it.
+        """
+        root = getattr(self.app, 'root', None)
+        if root is None:
+            return
+        try:
+            api = self.items[key].get()
+        except CacheReadFailed:
+            return
+        entry = self.items[key]
+        # nobody is waiting for the answer
+        params = params.copy()
+        params[SocketQueue.PRIORITY] = SocketQueue.PREFETCH
+        try:
+            item = SharedItem(url, mode, params, self, key, None, api,
+                              refresh=entry.validators())
+        except IOError:
+            api.close()
+            return
+        self.touch(key,refresh=1)
+        Revalidator(root, SharedAPI(item))
+
+    def revalidated(self,key,headers):
+        """Called by a SharedItem when a conditional request got a 304."""
+        self.stats['revalidated'] = self.stats['revalidated'] + 1
+        if key in self.items:
+            entry = self.items[key]
+            self.stats['bytes-saved'] = self.stats['bytes-saved'] + entry.size
+            entry.revalidate(headers)
+
     def add_cache(self, cache):
         """Called by cache to notify manager this it is ready."""
         self.caches.append(cache)
@@ -231,6 +384,47 @@ class CacheManager:
     def close_cache(self, cache):
         self.caches.remove(cache)
 
+    def spool_p(self, item):
+        """Check if a loading item's data should be spooled to disk.
+
+        Applies okay_to_cache_p() and the status test of
+        SharedItem.cache_update() to the meta data, before any of the
+        body has arrived; the size is taken from Content-Length.
+        """
+        if not item.meta or item.meta[0] != 200:
+            return 0
+        if not self.okay_to_cache_p(item):
+            return 0
+        try:
+            length = int(item.meta[2].get('content-length'))
+        except (TypeError, ValueError):
+            return 1
+        if length > self.caches[0].max_size / 4:
+            return 0
+        return 1
+
+    def new_spool(self):
+        """Return a (file, filename) pair to spool a new item into.
+
+        Returns (None, None) if there is no cache to spool into. The
+        file is live until release_spool() is called for it, and the
+        cache sweeps leave it alone until then.
+        """
+        if self.caches:
+            spool, path = self.caches[0].new_spool()
+            if spool:
+                self.spools[path] = 1
+            return spool, path
+        return None, None
+
+    def release_spool(self, path):
+        """Called when a spool file is adopted by the cache or removed."""
+        if path in self.spools:
+            del self.spools[path]
+
+    def live_spool_p(self, path):
+        return path in self.spools
+
     def cache_read(self,key):
         """Checks cache for URL. Returns protocol API on hit.
 
@@ -238,9 +432,12 @@ class CacheManager:
         CE object is found, call its method get() to create a protocol
         API for the item.
         """
-        if self.items.has_key(key):
-            return self.items[key].get()
+        if key in self.items:
+            api = self.items[key].get()
+            self.stats[api.tier] = self.stats[api.tier] + 1
+            return api
         else:
+            self.stats['miss'] = self.stats['miss'] + 1
             return None
 
     def touch(self,key=None,url=None,refresh=0):
@@ -275,7 +472,19 @@ class CacheManager:
 
     def add(self,item,reload=0):
         """If item is not in the cache and is allowed to be cached, add it. 
+
+        If the response varies on request headers, the item is re-keyed
+        first so that the key includes them.
         """
+        vary = item.meta[2].get('vary')
+        if vary and str.strip(vary) != '*':
+            self.learn_vary(item.key, vary)
+            key = self.url2key(item.url, item.mode, item.params)
+            if key != item.key:
+                if self.active.get(item.key) is item:
+                    del self.active[item.key]
+                    self.active[key] = item
+                item.key = key
         try:
             if not self.items.has_key(item.key) and self.okay_to_cache_p(item):
                 self.caches[0].add(item)
@@ -298,7 +507,10 @@ class CacheManager:
         2. The item is bigger than a quarter of the cache size.
         3. The 'Pragma: no-cache' header was sent
         4. The 'Expires: 0' header was sent
-        5. The URL includes a query part '?'
+        5. The URL includes a query part '?' and the response has no
+           explicit expiry (Expires, max-age or s-maxage) and is not
+           marked public
+        6. The response varies on everything ('Vary: *')
         
         """
 
@@ -308,7 +520,7 @@ class CacheManager:
         (scheme, netloc, path, parm, query, frag) = \
                  urlparse(item.url)
 
-        if query or scheme not in self.cache_protocols:
+        if scheme not in self.cache_protocols:
             return 0
 
         # don't cache really big things
@@ -332,12 +544,20 @@ class CacheManager:
                 return 0
 
         # respond to http/1.1 cache control directives
+        directives = {}
         if params.has_key('cache-control'):
-            for k, v in parse_cache_control(params['cache-control']):
+            directives = dict(parse_cache_control(params['cache-control']))
+            for k in directives.keys():
                 if k in  ('no-cache', 'no-store'):
                     return 0
-                if k == 'max-age':
-                    expires = int(v)
+
+        if str.strip(params.get('vary', '')) == '*':
+            return 0
+
+        if query and not ('expires' in params or 'max-age' in directives
+                          or 's-maxage' in directives
+                          or 'public' in directives):
+            return 0
 
         return 1
 
@@ -359,6 +579,29 @@ class CacheManager:
             # if you don't tell me the date, I don't tell you it's stale
             return 1
 
+    # characters that never need to be percent-encoded
+    unreserved = string.ascii_letters + string.digits + '-._~'
+    escape = re.compile('%([0-9A-Fa-f][0-9A-Fa-f])')
+
+    def normalize_escapes(self, s):
+        """Decode escaped unreserved characters, upper-case the rest."""
+        def fix(m, unreserved=self.unreserved):
+            c = chr(int(m.group(1), 16))
+            if c in unreserved:
+                return c
+            return '%' + str.upper(m.group(1))
+        return self.escape.sub(fix, s)
+
+    def learn_vary(self, key, vary):
+        """Remember the request headers named by a Vary header."""
+        names = []
+        for name in str.split(vary, ','):
+            name = str.lower(str.strip(name))
+            if name and name not in names:
+                names.append(name)
+        names.sort()
+        self.vary[str.split(key, ' ', 1)[0]] = names
+
     def url2key(self, url, mode, params):
         """Normalize a URL for use as a caching key.
 
@@ -366,15 +609,21 @@ class CacheManager:
         - remove the port if it is the scheme's default port
         - reformat the port using %d
         - get rid of the fragment identifier
+        - normalize percent-encoding in the path and query
+        - sort the query parameters, if the disk-cache--sort-query
+          preference is set
+        - append the request headers named by the URL's Vary header,
+          if it had one, as they are sent (see httpAPI.request_headers)
 
         """
-        scheme, netloc, path, params, query, fragment = urlparse(url)
+        scheme, netloc, path, parm, query, fragment = urlparse(url)
         i = str.find(netloc, '@')
         if i > 0:
             userpass = netloc[:i]
             netloc = netloc[i+1:]    # delete the '@'
         else:
             userpass = ""
+        host = netloc
         scheme = str.lower(scheme)
         netloc = str.lower(netloc)
         i = str.find(netloc, ':')
@@ -389,7 +638,30 @@ class CacheManager:
             netloc = netloc[:i]
         elif type(port) == type(0):
             netloc = netloc[:i] + ":%d" % port
-        return urllib.urlunparse((scheme, netloc, path, params, query, ""))
+        path = self.normalize_escapes(path)
+        query = self.normalize_escapes(query)
+        if query and self.sort_query:
+            query = str.join('&', sorted(str.split(query, '&')))
+        key = urlunparse((scheme, netloc, path, parm, query, ""))
+        if key in self.vary:
+            if scheme == 'http':
+                from protocols import httpAPI
+                if userpass:
+                    auth = base64.encodebytes(userpass.encode())
+                    auth = str.strip(auth.decode())
+                else:
+                    auth = None
+                sent = httpAPI.request_headers(host, params, auth)
+            else:
+                sent = params.items()
+            headers = {}
+            for name, value in sent:
+                headers[str.lower(name)] = value
+            for name in self.vary[key]:
+                # tabs and newlines would break the log format
+                value = str.join(' ', str.split(str(headers.get(name, ''))))
+                key = key + ' %s=%s' % (name, value)
+        return key
 
 
 class DiskCacheEntry:
@@ -405,13 +677,17 @@ class DiskCacheEntry:
     The data members include:
     date -- the date of the most recent HTTP request to the server
     (either a regular load or an If-Modified-Since request)
+    expires -- from the Expires header, or the date plus max-age
+    etag -- the entity tag, sent back in If-None-Match
+    cache_control -- the Cache-Control header, see directives()
+    vary -- the Vary header
     """
 
     def __init__(self, cache=None):
         self.cache = cache
 
     def fill(self,key,url,size,date,lastmod,expires,ctype,
-             cencoding,ctencoding):
+             cencoding,ctencoding,etag=None,cache_control=None,vary=None):
         self.key = key
         self.url = url
         self.size = size
@@ -430,6 +706,9 @@ class DiskCacheEntry:
         self.type = ctype
         self.encoding = cencoding
         self.transfer_encoding = ctencoding
+        self.etag = etag
+        self.cache_control = cache_control
+        self.vary = vary
 
     string_date = re.compile('^[A-Za-z]')
 
@@ -461,6 +740,15 @@ class DiskCacheEntry:
             else:
                 if self.transfer_encoding == 'None':
                     self.transfer_encoding = None
+        # log version 1.4 adds the HTTP/1.1 caching headers
+        for i, var in ((10, 'etag'), (11, 'cache_control'), (12, 'vary')):
+            try:
+                value = vars[i]
+            except IndexError:
+                value = None
+            if value == 'None':
+                value = None
+            setattr(self, var, value)
         self.date = None
         self.lastmod = None
         self.expires = None
@@ -471,7 +759,7 @@ class DiskCacheEntry:
     def parse_assign(self,rep,var):
         if rep == 'None':
             setattr(self,var,None)
-        elif self.string_date.match(rep) == 1:
+        elif self.string_date.match(rep):
             setattr(self,var,HTTime(str=rep))
         else:
             setattr(self,var,HTTime(secs=float(rep)))
@@ -483,8 +771,9 @@ class DiskCacheEntry:
             self.file = ''
         stuff = [self.key, self.url, self.file, self.size, self.date,
                  self.lastmod, self.expires, self.type, self.encoding,
-                 self.transfer_encoding]
-        s = str.join(map(str, stuff), '\t')
+                 self.transfer_encoding, self.etag, self.cache_control,
+                 self.vary]
+        s = '\t'.join(map(str, stuff))
         return s
 
     def get(self):
@@ -493,21 +782,77 @@ class DiskCacheEntry:
         Calls cache.get() to update the LRU information.
 
         Also checks to see if a page with an explicit Expire date has
-        expired; raises a CacheReadFaile if it has.
+        expired and cannot be revalidated; raises a CacheReadFailed if
+        so.
         """
-        if self.expires:
-            if self.expires and self.expires.get_secs() < time.time():
-                # we need to refresh the page; can we just reload?
-                raise CacheReadFailed, self.cache
+        if self.stale_p() and not self.validators():
+            # we need to refresh the page and can only reload
+            raise CacheReadFailed(self.cache)
         self.cache.get(self.key) 
+        path = self.cache.get_file_path(self.file)
+        memory = self.cache.manager.memory
+        if memory:
+            data = memory.get(self)
+            if data is not None:
+                return memory_cache_access(data, path, self.type,
+                                           self.date, self.size,
+                                           self.encoding,
+                                           self.transfer_encoding)
         try:
-            api = disk_cache_access(self.cache.get_file_path(self.file),
+            api = disk_cache_access(path,
                                     self.type, self.date, self.size,
                                     self.encoding, self.transfer_encoding)
         except IOError:
-            raise CacheReadFailed, self.cache
+            raise CacheReadFailed(self.cache)
+        if memory and api.map is not None and memory.accepts(len(api.map)):
+            # promote to the memory tier; check the size first so a
+            # body the tier would refuse is never copied out of the map
+            memory.add(self, api.map[:])
         return api
 
+    def stale_p(self):
+        """Return true if the entry is past its expiry date."""
+        return self.expires and self.expires.get_secs() < time.time()
+
+    def directives(self):
+        """Return the Cache-Control directives as a dictionary."""
+        if not self.cache_control:
+            return {}
+        return dict(parse_cache_control(self.cache_control))
+
+    def validators(self):
+        """Return the headers for a conditional request."""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.lastmod:
+            headers['If-Modified-Since'] = self.lastmod.get_str()
+        return headers
+
+    def revalidate(self,headers):
+        """Update the entry from the headers of a 304 response."""
+        date, lastmod, expires, ctype, cencoding, ctencoding, \
+              etag, cache_control, vary = self.cache.read_headers(headers)
+        self.date = HTTime(date)
+        if 'cache-control' in headers:
+            self.cache_control = cache_control
+        else:
+            # the stored max-age still holds, counted from the new date
+            try:
+                max_age = int(self.directives()['max-age'])
+            except (KeyError, ValueError):
+                pass
+            else:
+                expires = HTTime(date).get_secs() + max_age
+        if etag:
+            self.etag = etag
+        if expires:
+            self.expires = HTTime(expires)
+            self.cache.add_expireable(self)
+        elif 'cache-control' in headers:
+            self.expires = None
+        self.cache.log_entry(self)
+
     def touch(self,refresh=0):
         """Change the date of most recent check with server."""
         self.date = HTTime(secs=time.time())
@@ -517,33 +862,38 @@ class DiskCacheEntry:
     def delete(self):
         pass
 
-def compare_expire_items(item1,item2):
-    """used with list.sort() to sort list of CacheEntries by expiry date."""
-    e1 = item1.expires.get_secs() 
-    e2 = item2.expires.get_secs()
-    if e1 > e2:
-        return 1
-    elif e2 > e1:
-        return -1
-    else:
-        return 0
-
 class DiskCache:
     """Persistent object cache.
 
     need to discuss:
 
-    use_order
+    use_order -- the replacement policy object (see CachePolicy),
+    which orders the cache keys for eviction: LRU by default, or the
+    scan-resistant 2Q or ARC, chosen by the disk-cache--policy
+    preference. All of its operations are constant time.
 
-    the log: writes every change to cache or use_order, writes
-    flushed, do a checkpoint run on startup, format is tuple (entry
-    type, object), where entry type is add, evict, update use_order,
-    version. 
+    the log: writes every change to cache or use_order, do a
+    checkpoint run on startup, format is tuple (entry type, object),
+    where entry type is add, evict, update use_order, version. How
+    often writes are flushed depends on the durability level (see
+    set_durability()); a line cut short by a crash is ignored when
+    the log is read back.
 
-    expires
+    expires -- a heap of (expiry secs, sequence, entry) tuples for the
+    pages with an explicit expire date. Evicted entries are not
+    removed from the heap; they are skipped when they reach the top
+    (lazy deletion), and the heap is compacted when it grows to more
+    than twice the size of the cache.
 
     evict
 
+    files -- cache files are named by a SHA-1 digest of their
+    contents and fanned out over two levels of hex shard directories
+    ('ab/cd/abcd...'), so no directory grows too large and URLs with
+    identical bodies share one file. files maps each file name to the
+    number of entries using it; the file is unlinked when the last
+    one is evicted. Older logs may still name flat 'spam' files.
+
     Note: Nowhere do we verify that the disk has enough space for a
     full cache.
 
@@ -561,30 +911,111 @@ class DiskCache:
         self.manager = manager
         self.manager.add_cache(self)
         self.items = {}
-        self.use_order = []
+        self.files = {}
+        self.policy = 'lru'
+        self.use_order = CachePolicy.new_policy(self.policy)
         self.log = None
+        self.durability = 'always'
+        self.flush_pending = 0
         self.checkpoint = 0
         self.expires = []
+        self.expires_seq = itertools.count()
         self.types = {}
 
         grailutil.establish_dir(self.directory)
         self._read_metadata()
         self._reinit_log()
 
-    log_version = "1.3"
-    log_ok_versions = ["1.2", "1.3"]
+    journal_type = 'text'
+    journal_files = ['LOG']
+    log_version = "1.4"
+    log_ok_versions = ["1.2", "1.3", "1.4"]
 
     def close(self,log):
-        self.manager.delete(self.items.keys(), evict=0)
+        self.flush_log()
+        self.manager.delete(list(self.items.keys()), evict=0)
         if log:
-            self.use_order = []
+            self.use_order = CachePolicy.new_policy(self.policy)
             self._checkpoint_metadata()
         del self.items
         del self.expires
         self.manager.close_cache(self)
         self.dead = 1
 
+    def _journal_time(self, names):
+        """Return when the journal files were last written, or None."""
+        times = []
+        for name in names:
+            try:
+                times.append(os.stat(os.path.join(self.directory,
+                                                  name)).st_mtime_ns)
+            except os.error:
+                pass
+        if times:
+            return max(times)
+        return None
+
+    def _migrate_p(self, other):
+        """Return true if the other journal format was written last.
+
+        The journal preference can be switched back and forth, and
+        each format leaves the other's files in place, so whichever
+        was written most recently holds the cache's current state.
+        """
+        theirs = self._journal_time(other.journal_files)
+        if theirs is None:
+            return 0
+        ours = self._journal_time(self.journal_files)
+        return ours is None or theirs > ours
+
     def _read_metadata(self):
+        """Read the cache's metadata from the journal.
+
+        If the SQLite journal is newer than the LOG, the entries are
+        taken from it instead and the LOG is rewritten.
+        """
+        if self._migrate_p(SQLiteDiskCache):
+            try:
+                import sqlite3
+            except ImportError:
+                pass
+            else:
+                db = sqlite3.connect(os.path.join(self.directory,
+                                                  SQLiteDiskCache.db_name))
+                try:
+                    self._read_entries(db.execute("SELECT seq, entry "
+                                                  "FROM entries "
+                                                  "ORDER BY seq"))
+                except sqlite3.Error:
+                    pass
+                db.close()
+                self._checkpoint_metadata()
+                return
+        self._replay_log()
+
+    def _read_entries(self, rows):
+        """Add the entries in (seq, representation) rows, in use order.
+
+        Returns the last sequence number read, or 0.
+        """
+        last = 0
+        for seq, rep in rows:
+            newentry = DiskCacheEntry(self)
+            try:
+                newentry.parse(rep)
+            except (IndexError, ValueError):
+                continue
+            self.items[newentry.key] = newentry
+            self.manager.items[newentry.key] = newentry
+            self.use_order.insert(newentry.key)
+            self._ref_file(newentry.file)
+            self.size = self.size + newentry.size
+            if newentry.expires:
+                self.add_expireable(newentry)
+            last = seq
+        return last
+
+    def _replay_log(self):
         """Read the transaction log from the cache directory.
 
         Reads the pickled log entries and re-creates the cache's
@@ -603,44 +1034,58 @@ class DiskCache:
             log.close()
             return
 
+        good = 0                        # bytes of complete lines
         for line in log.readlines():
+            if line[-1:] != '\n':
+                # partial write at the end of the log; drop it, or
+                # the next record appended would be joined to it
+                log.close()
+                os.truncate(logpath, good)
+                break
+            good = good + len(line.encode(log.encoding))
             try:
                 kind = line[0:1]        
                 if kind == '2': # use update
                     key = line[2:-1]
-                    self.use_order.remove(key)
-                    self.use_order.append(key)
+                    self.use_order.touch(key)
                 elif kind == '1':           # delete
                     key = line[2:-1]
-                    if self.items.has_key(key):
+                    if key in self.items:
                         self.size = self.size - self.items[key].size
+                        self._unref_file(self.items[key].file)
                         del self.items[key]
                         del self.manager.items[key]
                         self.use_order.remove(key)
-                        Assert(not key in self.use_order)
                 elif kind == '0': # add
                     newentry = DiskCacheEntry(self)
                     newentry.parse(line[2:-1])
-                    if not self.items.has_key(newentry.key):
-                        self.use_order.append(newentry.key)
+                    if newentry.key not in self.items:
+                        self.use_order.insert(newentry.key)
+                    else:
+                        self._unref_file(self.items[newentry.key].file)
+                    self._ref_file(newentry.file)
                     newentry.cache = self
                     self.items[newentry.key] = newentry
                     self.manager.items[newentry.key] = newentry
                     self.size = self.size + newentry.size
+                    if newentry.expires:
+                        self.add_expireable(newentry)
                 elif kind == '3': # version (hopefully first)
                     ver = line[2:-1]
                     if ver not in self.log_ok_versions:
                    ### clear out anything we might have read
                    ### and bail. this is an old log file.
                         if len(self.use_order) > 0:
-                            self.use_order = []
-                            for key in self.items.keys():
+                            self.use_order = CachePolicy.new_policy(
+                                self.policy)
+                            self.files = {}
+                            for key in list(self.items.keys()):
                                 del self.items[key]
                                 del self.manager.items[key]
                                 self.size = 0
                             return
                     Assert(ver in self.log_ok_versions)
-            except IndexError:
+            except (IndexError, ValueError):
                 # ignore this line
                 pass
 
@@ -664,8 +1109,7 @@ class DiskCache:
                 # we crash it won't matter
             newlog.close()
             logpath = os.path.join(self.directory, 'LOG')
-            os.unlink(logpath)
-            os.rename(newpath, logpath)
+            os.replace(newpath, logpath)
         except:
             print("exception during checkpoint")
             traceback.print_exc()
@@ -685,17 +1129,80 @@ class DiskCache:
             dest.write('1 ' + entry.key + '\n')
         else:
             dest.write('0 ' + entry.unparse() + '\n')
-        if flush:
-            dest.flush()
+        if flush and not alt_log:
+            self.log_written()
 
     def log_use_order(self,key):
         """Write to the log changes in use_order."""
-        if self.items.has_key(key):
+        if key in self.items:
             self.log.write('2 ' + key + '\n')
-            # should we flush() here? probably...
+            self.log_written()
+
+    def set_policy(self, name):
+        """Switch replacement policy, keeping the current contents."""
+        if name == self.policy:
+            return
+        policy = CachePolicy.new_policy(name)
+        for key in self.use_order:
+            policy.insert(key)
+        self.policy = name
+        self.use_order = policy
+
+    # milliseconds a batch of log writes may wait before it is flushed
+    flush_delay = 500
+
+    def set_durability(self, level):
+        """Set how eagerly log writes reach the disk.
+
+        'always' -- flush after every add, delete and use_order update
+        'batch' -- group-commit the writes made within flush_delay msec
+        'exit' -- flush only on checkpoint, close and application exit
+        """
+        if level not in ('always', 'batch', 'exit'):
+            level = 'always'
+        self.durability = level
+        if level == 'always':
+            self.flush_log()
+
+    def log_written(self):
+        """Flush the log now or later, depending on the durability."""
+        if self.durability == 'always':
+            self.flush_log()
+        elif self.durability == 'batch' and not self.flush_pending:
+            root = getattr(self.manager.app, 'root', None)
+            if root is None:
+                self.flush_log()
+            else:
+                self.flush_pending = 1
+                root.after(self.flush_delay, self.flush_log)
+
+    def flush_log(self):
+        """Commit pending log writes."""
+        self.flush_pending = 0
+        if self.log and not self.log.closed:
             self.log.flush()
 
-    cache_file = re.compile('^spam[0-9]+')
+    cache_file = re.compile('^(spam[0-9]+|spool|[0-9a-f]{40})')
+
+    def walk_cache_files(self):
+        """Return the names of all cache files, shard by shard.
+
+        Names are relative to the cache directory and use '/' as the
+        separator, like DiskCacheEntry.file. Spool files that items
+        are still loading into are not included.
+        """
+        names = []
+        for dir, subdirs, files in os.walk(self.directory):
+            rel = os.path.relpath(dir, self.directory)
+            if rel == os.curdir:
+                prefix = ''
+            else:
+                prefix = rel.replace(os.sep, '/') + '/'
+            for file in files:
+                if self.cache_file.match(file) and not \
+                   self.manager.live_spool_p(os.path.join(dir, file)):
+                    names.append(prefix + file)
+        return names
 
     def erase_cache(self):
 
@@ -704,14 +1211,10 @@ class DiskCache:
             self.manager.disk.erase_cache()
             return
 
-        def walk_erase(rep,dir,files):
-            for file in files:
-                if rep.match(file) != -1:
-                    path = os.path.join(dir,file)
-                    if os.path.isfile(path):
-                        os.unlink(path)
-
-        os.path.walk(self.directory, walk_erase, self.cache_file)
+        for file in self.walk_cache_files():
+            path = self.get_file_path(file)
+            if os.path.isfile(path):
+                os.unlink(path)
         self.manager.reset_disk_cache(flush_log=1)
 
     def erase_unlogged_files(self):
@@ -721,25 +1224,16 @@ class DiskCache:
             self.manager.disk.erase_unlogged_files()
             return
 
-        def walk_erase_unknown(known,dir,files,rep=self.cache_file):
-            for file in files:
-                if not known.has_key(file) \
-                   and rep.match(file) != -1:
-                    path = os.path.join(dir,file)
-                    if os.path.isfile(path):
-                        os.unlink(path)
-
-        files = map(lambda entry:entry.file, self.items.values())
-        file_dict = { 'LOG': 1 }
-        for file in files:
-            file_dict[file] = 1
-        os.path.walk(self.directory, walk_erase_unknown, file_dict)
+        for file in self.walk_cache_files():
+            if file not in self.files:
+                path = self.get_file_path(file)
+                if os.path.isfile(path):
+                    os.unlink(path)
 
     def get(self,key):
         """Update and log use_order."""
-        Assert(self.items.has_key(key))
-        self.use_order.remove(key)
-        self.use_order.append(key)
+        Assert(key in self.items)
+        self.use_order.touch(key)
         self.log_use_order(key)
 
     def update(self,object):
@@ -762,85 +1256,151 @@ class DiskCache:
         self.make_space(size)
 
         newitem = DiskCacheEntry(self)
-        (date, lastmod, expires, ctype, cencoding, ctencoding) \
-               = self.read_headers(headers)
+        (date, lastmod, expires, ctype, cencoding, ctencoding,
+         etag, cache_control, vary) = self.read_headers(headers)
         newitem.fill(object.key, object.url, size, date, lastmod,
-                     expires, ctype, cencoding, ctencoding)
-        newitem.file = self.get_file_name(newitem)
+                     expires, ctype, cencoding, ctencoding,
+                     etag, cache_control, vary)
+        self.make_file(newitem,object)
+        self._ref_file(newitem.file)
         if expires:
             self.add_expireable(newitem)
 
-        self.make_file(newitem,object)
         self.log_entry(newitem)
 
         self.items[object.key] = newitem
         self.manager.items[object.key] = newitem
-        self.use_order.append(object.key)
+        self.use_order.insert(object.key)
 
         return newitem
 
     def read_headers(self,headers):
-        if headers.has_key('date'):
+        if 'date' in headers:
             date = headers['date']
         else:
             date = time.time()
 
-        if headers.has_key('last-modified'):
+        if 'last-modified' in headers:
             lastmod = headers['last-modified']
         else:
             lastmod = date
 
-        if headers.has_key('expires'):
+        if 'expires' in headers:
             expires = headers['expires']
         else:
             expires = None
 
-        if headers.has_key('content-type'):
+        if 'content-type' in headers:
             ctype = headers['content-type']
         else:
             # what is the proper default content type?
             ctype = 'text/html'
 
-        if headers.has_key('content-encoding'):
+        if 'content-encoding' in headers:
             cencoding = headers['content-encoding']
         else:
             cencoding = None
 
-        if headers.has_key('content-transfer-encoding'):
+        if 'content-transfer-encoding' in headers:
             ctencoding = headers['content-transfer-encoding']
         else:
             ctencoding = None
 
-        return (date, lastmod, expires, ctype, cencoding, ctencoding)
+        etag = headers.get('etag')
+        vary = headers.get('vary')
+        cache_control = headers.get('cache-control')
+        if cache_control:
+            # max-age overrides Expires; s-maxage only applies to
+            # shared caches, so it is kept but not used here
+            directives = dict(parse_cache_control(cache_control))
+            try:
+                max_age = int(directives['max-age'])
+            except (KeyError, ValueError):
+                pass
+            else:
+                expires = HTTime(date).get_secs() + max_age
 
+        return (date, lastmod, expires, ctype, cencoding, ctencoding,
+                etag, cache_control, vary)
 
-    def add_expireable(self,entry):
-        """Adds entry to list of pages with explicit expire date."""
-        self.expires.append(entry)
 
-    def get_file_name(self,entry):
-        """Invent a filename for a new cache entry."""
-        filename = 'spam' + str(time.time()) + self.get_suffix(entry.type)
+    def add_expireable(self,entry):
+        """Adds entry to heap of pages with explicit expire date."""
+        if len(self.expires) > 2 * len(self.items) + 64:
+            # drop the entries left behind by evict()
+            self.expires = [tup for tup in self.expires
+                            if self.items.get(tup[2].key) is tup[2]]
+            heapq.heapify(self.expires)
+        heapq.heappush(self.expires, (entry.expires.get_secs(),
+                                      next(self.expires_seq), entry))
+
+    def get_file_name(self,entry,digest):
+        """Return the sharded filename for a body with this digest."""
+        filename = '%s/%s/%s%s' % (digest[:2], digest[2:4], digest,
+                                   self.get_suffix(entry.type))
         return filename
 
     def get_file_path(self,filename):
-        path = os.path.join(self.directory, filename)
+        path = os.path.join(self.directory, *str.split(filename, '/'))
         return path
 
+    def _ref_file(self,filename):
+        self.files[filename] = self.files.get(filename, 0) + 1
+
+    def _unref_file(self,filename):
+        """Drop a reference to a file; return true if it was the last."""
+        count = self.files.get(filename, 0) - 1
+        if count > 0:
+            self.files[filename] = count
+            return 0
+        self.files.pop(filename, None)
+        return 1
+
     def get_suffix(self,type):
-        if self.types.has_key(type):
+        if type in self.types:
             return self.types[type]
         else:
             return guess_extension(type) or ''
 
+    def new_spool(self):
+        """Create a spool file for an item that is still loading."""
+        try:
+            fd, path = tempfile.mkstemp(prefix='spool', dir=self.directory)
+        except (IOError, os.error):
+            return None, None
+        return open(fd, 'w+b', buffering=0), path
+
     def make_file(self,entry,object):
-        """Write the object's data to disk."""
+        """Write the object's data to disk and set entry.file.
+
+        An object that was spooled to disk while loading is committed
+        by renaming its spool file. If another entry already holds an
+        identical body, its file is shared and nothing is written.
+        """
+        spoolname = getattr(object, 'spoolname', None)
+        if spoolname:
+            digest = object.digest
+        else:
+            digest = hashlib.sha1()
+            for chunk in object.data:
+                digest.update(chunk)
+        entry.file = self.get_file_name(entry, digest.hexdigest())
         path = self.get_file_path(entry.file)
+        if entry.file in self.files and os.path.isfile(path):
+            return
         try:
-            f = open(path, 'wb')
-            f.writelines(object.data)
-            f.close()
-        except IOError as err:
+            grailutil.establish_dir(os.path.dirname(path))
+            if spoolname:
+                os.replace(spoolname, path)
+                object.spoolname = None
+                self.manager.release_spool(spoolname)
+            else:
+                tmppath = path + '.tmp'
+                f = open(tmppath, 'wb')
+                f.writelines(object.data)
+                f.close()
+                os.replace(tmppath, path)
+        except (IOError, os.error) as err:
             raise CacheFileError((path, err))
 
     def make_space(self,amount):
@@ -870,27 +1430,26 @@ class DiskCache:
         self.size = self.size + amount
 
     def evict_any_page(self):
-        """Evict the least recently used page."""
-        # get ride of least-recently used thing
+        """Evict the page the replacement policy chooses."""
         if len(self.items) > 0:
-            key = self.use_order[0]
+            key = self.use_order.victim()
             self.evict(key)
         else:
             raise CacheEmpty
 
     def evict_expired_pages(self):
-        """Evict any pages on the expires list that have expired."""
-        self.expires.sort(compare_expire_items)
-        size = len(self.expires)
-        if size > 0 \
-           and self.expires[0].expires.get_secs() < time.time():
-            index = 0
-            t = time.time()
-            while index < size and self.expires[index].expires.get_secs() < t:
-                index = index + 1
-            for item in self.expires[0:index]:
-                self.evict(item.key)
-            del self.expires[0:index]
+        """Evict any pages on the expires heap that have expired.
+
+        Only the expired entries are popped, so the cost is O(k log n)
+        for k expired pages rather than a sort of the whole heap.
+        """
+        t = time.time()
+        while self.expires and self.expires[0][0] < t:
+            secs, seq, entry = heapq.heappop(self.expires)
+            # skip entries that were evicted, replaced or revalidated
+            if self.items.get(entry.key) is entry \
+               and entry.expires and entry.expires.get_secs() == secs:
+                self.evict(entry.key)
 
     def evict(self,key):
         """Remove an entry from the cache and delete the file from disk."""
@@ -898,29 +1457,216 @@ class DiskCache:
         evictee = self.items[key]
         del self.manager.items[key]
         del self.items[key]
-        if key in self.expires:
-            self.expires.remove(key)
-        try:
-            os.unlink(self.get_file_path(evictee.file))
-        except (os.error, IOError) as err:
-            # print "error deleteing %s from cache: %s" % (key, err)
-            pass
+        if self.manager.memory:
+            self.manager.memory.discard(key)
+        # a stale heap entry is skipped by evict_expired_pages()
+        if self._unref_file(evictee.file):
+            try:
+                os.unlink(self.get_file_path(evictee.file))
+            except (os.error, IOError) as err:
+                # print "error deleteing %s from cache: %s" % (key, err)
+                pass
         self.log_entry(evictee,1) # 1 indicates delete entry
         evictee.delete()
         self.size = self.size - evictee.size
 
+
+class SQLiteDiskCache(DiskCache):
+    """Disk cache whose journal is an SQLite database.
+
+    The text LOG records history: every add, delete and use_order
+    update, replayed in full on startup until the next checkpoint.
+    This journal keeps one row per live entry instead, holding the
+    entry's log representation and a use_order sequence number, so
+    opening the cache costs time proportional to the number of
+    entries in it. Writes go through SQLite's write-ahead log.
+
+    If the text LOG was written more recently than the database (or
+    there is no database yet), the LOG is replayed and migrated. The
+    LOG is left in place, and the text journal migrates back the same
+    way, so the journal preference can be switched in either
+    direction.
+    """
+
+    journal_type = 'sqlite'
+    db_name = 'CACHE.db'
+    journal_files = [db_name, db_name + '-wal']
+
+    def _open_db(self):
+        import sqlite3
+        dbpath = os.path.join(self.directory, self.db_name)
+        self.db = sqlite3.connect(dbpath)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries "
+                        "(key TEXT PRIMARY KEY, seq INTEGER, entry TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_seq "
+                        "ON entries (seq)")
+        self.db.commit()
+
+    def _read_metadata(self):
+        """Load the live entries from the database, in use order."""
+        migrate = self._migrate_p(DiskCache)
+        self._open_db()
+        self.seq = 0
+        if migrate:
+            self._replay_log()
+            self._checkpoint_metadata()
+            return
+        rows = self.db.execute("SELECT seq, entry FROM entries ORDER BY seq")
+        self.seq = self._read_entries(rows) + 1
+
+    def _checkpoint_metadata(self):
+        """Rewrite the database from the current state of the cache."""
+        import traceback
+        try:
+            self.db.execute("DELETE FROM entries")
+            self.seq = 0
+            for key in self.use_order:
+                self.log_entry(self.items[key], flush=None)
+            self.db.commit()
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except:
+            print("exception during checkpoint")
+            traceback.print_exc()
+
+    def _reinit_log(self):
+        pass
+
+    def close(self, log):
+        DiskCache.close(self, log)
+        self.db.commit()
+        self.db.close()
+
+    def log_entry(self, entry, delete=0, alt_log=None, flush=1):
+        """Write adds and evictions to the database."""
+        if delete:
+            self.db.execute("DELETE FROM entries WHERE key = ?",
+                            (entry.key,))
+        else:
+            self.db.execute("INSERT OR REPLACE INTO entries "
+                            "VALUES (?, ?, ?)",
+                            (entry.key, self.seq, entry.unparse()))
+            self.seq = self.seq + 1
+        if flush:
+            self.log_written()
+
+    def log_use_order(self, key):
+        """Record a change in use_order by renumbering the entry."""
+        if key in self.items:
+            self.db.execute("UPDATE entries SET seq = ? WHERE key = ?",
+                            (self.seq, key))
+            self.seq = self.seq + 1
+            self.log_written()
+
+    def flush_log(self):
+        """Commit the pending transaction."""
+        self.flush_pending = 0
+        if not hasattr(self, 'dead'):
+            self.db.commit()
+
+class Revalidator:
+    """Drive a background revalidation to completion.
+
+    Polls a SharedAPI from Tk timer callbacks, so nothing waits for
+    it. A 304 leaves the item reading the cached copy, which is not
+    needed, so the API is closed as soon as the response is in;
+    otherwise the new body is read so that it replaces the cache
+    entry.
+    """
+
+    delay = 100                         # msec between polls
+    bufsize = 8*1024
+
+    def __init__(self, root, api):
+        self.root = root
+        self.api = api
+        self.poll()
+
+    def poll(self):
+        api = self.api
+        if api.stage == META:
+            message, ready = api.pollmeta()
+            if ready:
+                api.getmeta()
+                if api.iscached():
+                    api.close()
+        elif api.stage == DATA:
+            message, ready = api.polldata()
+            if ready:
+                api.getdata(self.bufsize)
+        if api.stage == DONE:
+            self.api = None
+        else:
+            self.root.after(self.delay, self.poll)
+
+class MemoryCache:
+    """Bounded in-memory tier in front of the disk cache.
+
+    Holds the bodies of recently used DiskCacheEntry objects, up to
+    max_size bytes in total, and evicts least recently used first.
+    Bodies are added when a disk cache hit promotes them and are keyed
+    on the entry object, so a body outlives neither its entry's
+    eviction nor its replacement. Like the disk cache, it will not
+    take anything bigger than a quarter of its size.
+    """
+
+    def __init__(self, size):
+        self.max_size = size
+        self.size = 0
+        self.items = OrderedDict()      # key -> (entry, data)
+
+    def set_size(self, size):
+        self.max_size = size
+        self.make_space(0)
+
+    def get(self, entry):
+        """Return the body held for entry, or None."""
+        try:
+            held, data = self.items[entry.key]
+        except KeyError:
+            return None
+        if held is not entry:
+            self.discard(entry.key)
+            return None
+        self.items.move_to_end(entry.key)
+        return data
+
+    def accepts(self, size):
+        """Return true if a body of size bytes would be kept."""
+        return size <= self.max_size / 4
+
+    def add(self, entry, data):
+        if not self.accepts(len(data)):
+            return
+        self.discard(entry.key)
+        self.make_space(len(data))
+        self.items[entry.key] = (entry, data)
+        self.size = self.size + len(data)
+
+    def discard(self, key):
+        try:
+            held, data = self.items.pop(key)
+        except KeyError:
+            return
+        self.size = self.size - len(data)
+
+    def make_space(self, amount):
+        while self.items and self.size + amount > self.max_size:
+            self.discard(next(iter(self.items)))
+
 class disk_cache_access:
-    """protocol access interface for disk cache"""
+    """protocol access interface for disk cache
+
+    Non-empty cache files are memory-mapped, and getdata() slices the
+    map instead of going through file reads.
+    """
+
+    tier = 'disk'
 
     def __init__(self, filename, content_type, date, len,
                  content_encoding, transfer_encoding):
-        self.headers = { 'content-type' : content_type,
-                         'date' : date,
-                         'content-length' : str(len) }
-        if content_encoding:
-            self.headers['content-encoding'] = content_encoding
-        if transfer_encoding:
-            self.headers['content-transfer-encoding'] = transfer_encoding
+        self.set_headers(content_type, date, len, content_encoding,
+                         transfer_encoding)
         self.filename = filename
         try:
             self.fp = open(filename, 'rb')
@@ -928,8 +1674,26 @@ class disk_cache_access:
             print("io error opening %s: %s" % (filename, err))
             # propogate error through
             raise IOError(err)
+        self.map = None
+        self.pos = 0
+        try:
+            if os.fstat(self.fp.fileno()).st_size > 0:
+                self.map = mmap.mmap(self.fp.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+        except (os.error, ValueError):
+            self.map = None
         self.state = DATA
 
+    def set_headers(self, content_type, date, len, content_encoding,
+                    transfer_encoding):
+        self.headers = { 'content-type' : content_type,
+                         'date' : date,
+                         'content-length' : str(len) }
+        if content_encoding:
+            self.headers['content-encoding'] = content_encoding
+        if transfer_encoding:
+            self.headers['content-transfer-encoding'] = transfer_encoding
+
     def pollmeta(self):
         return "Ready", 1
 
@@ -941,7 +1705,11 @@ class disk_cache_access:
 
     def getdata(self,maxbytes):
         # get some data from the disk
-        data = self.fp.read(maxbytes)
+        if self.map is not None:
+            data = self.map[self.pos:self.pos+maxbytes]
+            self.pos = self.pos + len(data)
+        else:
+            data = self.fp.read(maxbytes)
         if not data:
             self.state = DONE
         return data
@@ -953,6 +1721,10 @@ class disk_cache_access:
             return -1
 
     def close(self):
+        map = self.map
+        self.map = None
+        if map is not None:
+            map.close()
         fp = self.fp
         self.fp = None
         if fp:
@@ -966,6 +1738,28 @@ class disk_cache_access:
         """
         return self.filename, self.headers['content-type']
 
+class memory_cache_access(disk_cache_access):
+    """protocol access interface for the in-memory tier
+
+    Serves a body held by the MemoryCache. The filename still names
+    the disk cache file, for tk_img_access().
+    """
+
+    tier = 'memory'
+
+    def __init__(self, data, filename, content_type, date, len,
+                 content_encoding, transfer_encoding):
+        self.set_headers(content_type, date, len, content_encoding,
+                         transfer_encoding)
+        self.filename = filename
+        self.fp = None
+        self.map = data
+        self.pos = 0
+        self.state = DATA
+
+    def close(self):
+        self.map = None
+
 class HTTime:
     """Stores time as HTTP string or seconds since epoch or both.
 
@@ -1013,3 +1807,214 @@ class HTTime:
             return self.str
         else:
             return str(None)
+
+
+class _ScratchManager:
+    """Just enough of a CacheManager to drive a DiskCache in tests."""
+
+    memory = None
+
+    def __init__(self, root=None):
+        self.app = self
+        self.root = root                # for Tk's after(), if given
+        self.items = {}
+        self.caches = []
+        self.spools = {}
+
+    add_cache = CacheManager.add_cache
+    close_cache = CacheManager.close_cache
+    delete = CacheManager.delete
+    live_spool_p = CacheManager.live_spool_p
+    release_spool = CacheManager.release_spool
+
+
+class _ScratchRoot:
+    """Stands in for Tk: holds after() callbacks until run() is called."""
+
+    def __init__(self):
+        self.pending = []
+
+    def after(self, ms, func):
+        self.pending.append(func)
+
+    def run(self):
+        pending = self.pending
+        self.pending = []
+        for func in pending:
+            func()
+
+
+class _ScratchItem:
+    """A loaded SharedItem, as far as DiskCache.add() is concerned."""
+
+    def __init__(self, url, body):
+        self.key = self.url = url
+        self.meta = (200, 'OK', {'content-type': 'text/plain'})
+        self.data = [body]
+        self.datalen = len(body)
+
+
+def test_journals():
+    """Switch the journal text -> sqlite -> text -> sqlite.
+
+    Each switch is made the way CacheManager.update_prefs() makes it;
+    every entry added along the way must survive, in use order.
+    """
+    import shutil
+    directory = tempfile.mkdtemp()
+    manager = _ScratchManager()
+    cache = DiskCache(manager, 100000, directory)
+    keys = []
+    for klass in (DiskCache, SQLiteDiskCache, DiskCache, SQLiteDiskCache):
+        for i in range(3):
+            key = 'http://grail.test/%s/%d/%d' % (klass.journal_type,
+                                                   len(keys), i)
+            cache.add(_ScratchItem(key, key.encode()))
+            keys.append(key)
+        cache.get(keys[0])
+        keys.append(keys.pop(0))
+        cache.flush_log()
+        cache._checkpoint_metadata()
+        cache.close(0)
+        # file times may be as coarse as a clock tick
+        time.sleep(0.05)
+        if klass is DiskCache:
+            cache = SQLiteDiskCache(manager, 100000, directory)
+        else:
+            cache = DiskCache(manager, 100000, directory)
+        Assert(list(cache.use_order) == keys)
+        for key in keys:
+            Assert(os.path.isfile(cache.get_file_path(
+                cache.items[key].file)))
+        print("%-6s -> %-6s %d entries" % (klass.journal_type,
+                                          cache.journal_type, len(keys)))
+    cache.close(0)
+    shutil.rmtree(directory)
+
+
+def _crash(klass, directory, level, committed, uncommitted):
+    """Add entries in a child process that then dies without cleanup.
+
+    The committed keys are added and the pending batch timer is run;
+    the uncommitted keys are added after it. The child exits with
+    os._exit(), so nothing is checkpointed, closed or flushed.
+    """
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            root = _ScratchRoot()
+            cache = klass(_ScratchManager(root), 100000, directory)
+            cache.set_durability(level)
+            for key in committed:
+                cache.add(_ScratchItem(key, key.encode()))
+            root.run()
+            for key in uncommitted:
+                cache.add(_ScratchItem(key, key.encode()))
+            status = 0
+        finally:
+            os._exit(status)
+    pid, status = os.waitpid(pid, 0)
+    Assert(status == 0)
+
+
+def test_durability():
+    """Check which log writes survive a crash at each durability.
+
+    'always' must keep every entry and 'batch' every entry up to the
+    last batch that was flushed; 'exit' promises nothing. Whatever
+    survives must be a prefix of what was written.
+    """
+    import shutil
+    if not hasattr(os, 'fork'):
+        print("test_durability: needs os.fork()")
+        return
+    committed = ['http://grail.test/committed/%d' % i for i in range(5)]
+    uncommitted = ['http://grail.test/pending/%d' % i for i in range(3)]
+    for klass in (DiskCache, SQLiteDiskCache):
+        for level in ('always', 'batch', 'exit'):
+            directory = tempfile.mkdtemp()
+            _crash(klass, directory, level, committed, uncommitted)
+            cache = klass(_ScratchManager(), 100000, directory)
+            survived = list(cache.use_order)
+            Assert(survived == (committed + uncommitted)[:len(survived)])
+            if level == 'always':
+                Assert(survived == committed + uncommitted)
+            elif level == 'batch':
+                Assert(survived[:len(committed)] == committed)
+            print("%-6s %-6s %d of %d entries survived"
+                  % (klass.journal_type, level, len(survived),
+                     len(committed) + len(uncommitted)))
+            cache.close(0)
+            shutil.rmtree(directory)
+
+
+def test_torn_log():
+    """Check that a record cut short in the LOG is dropped.
+
+    The LOG is cut in the middle of its last record, as a crash in
+    the middle of writing a batch leaves it. The records before it
+    must survive, and so must a record written after reopening.
+    """
+    import shutil
+    directory = tempfile.mkdtemp()
+    keys = ['http://grail.test/torn/%d' % i for i in range(4)]
+    cache = DiskCache(_ScratchManager(), 100000, directory)
+    cache.set_durability('batch')
+    for key in keys:
+        cache.add(_ScratchItem(key, key.encode()))
+    cache.flush_log()
+    logpath = os.path.join(directory, 'LOG')
+    f = open(logpath, 'rb')
+    log = f.read()
+    f.close()
+    # a crash, with the log written up to the middle of the last key
+    last = log.rindex(b'\n', 0, len(log) - 1) + 1
+    os.truncate(logpath, last + 12)
+    cache.log.close()
+    cache = DiskCache(_ScratchManager(), 100000, directory)
+    Assert(list(cache.use_order) == keys[:-1])
+    cache.add(_ScratchItem(keys[-1], b'again'))
+    cache.flush_log()
+    cache.log.close()
+    cache = DiskCache(_ScratchManager(), 100000, directory)
+    Assert(list(cache.use_order) == keys)
+    print("torn log: %d of %d records kept, then appended after"
+          % (len(keys) - 1, len(keys)))
+    cache.close(0)
+    shutil.rmtree(directory)
+
+
+def test_revalidate():
+    """Check the expiry a 304 without Cache-Control leaves behind.
+
+    The stored max-age must be counted again from the new Date.
+    """
+    import shutil
+    directory = tempfile.mkdtemp()
+    cache = DiskCache(_ScratchManager(), 100000, directory)
+    item = _ScratchItem('http://grail.test/revalidate', b'body')
+    then = time.time() - 3600
+    item.meta[2]['date'] = ht_time.unparse(then)
+    item.meta[2]['cache-control'] = 'max-age=60'
+    entry = cache.add(item)
+    Assert(entry.stale_p())
+    now = time.time()
+    entry.revalidate({'date': ht_time.unparse(now)})
+    Assert(not entry.stale_p())
+    Assert(abs(entry.expires.get_secs() - (now + 60)) < 2)
+    print("revalidate: max-age=60 counted from the 304's date")
+    cache.close(0)
+    shutil.rmtree(directory)
+
+
+def test():
+    """Test the disk cache journals and revalidation."""
+    test_journals()
+    test_durability()
+    test_torn_log()
+    test_revalidate()
+
+
+if __name__ == '__main__':
+    test()
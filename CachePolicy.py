@@ -0,0 +1,342 @@
+"""Replacement policies for the disk cache.
+
+A policy keeps the cache keys in the order they should be evicted.
+The DiskCache calls insert() when an entry is added, touch() on every
+hit, remove() when an entry leaves the cache for any reason, and
+victim() to pick the next entry to evict when it needs room. Policies
+count entries, not bytes; the cache keeps evicting victims until
+enough bytes are free.
+
+Iterating over a policy yields the resident keys in an order that,
+when inserted into a fresh policy, approximates the current state.
+That is how the cache log is checkpointed.
+
+Three policies are provided:
+
+lru -- least recently used
+2q -- the 2Q policy (Johnson and Shasha): new keys go to a FIFO and
+      are only promoted to the LRU list if they are seen again after
+      leaving it, so a single scan cannot flush the hot set
+arc -- Adaptive Replacement Cache (Megiddo and Modha), which balances
+       recency and frequency and adapts the balance to the workload
+
+The scan-resistant policies need a capacity in entries to size their
+queues; they use the largest number of entries the cache has held.
+
+Run this module with a trace file to compare the policies; see
+replay_trace(). Run it with -b to time the LRU policy against the
+list the disk cache used to keep; see benchmark_lru().
+"""
+
+from collections import OrderedDict
+
+
+class LRUPolicy:
+
+    """Least recently used replacement."""
+
+    def __init__(self):
+        self.order = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        return iter(list(self.order))
+
+    def insert(self, key):
+        self.order[key] = None
+
+    def touch(self, key):
+        if key in self.order:
+            self.order.move_to_end(key)
+
+    def remove(self, key):
+        del self.order[key]
+
+    def victim(self):
+        return next(iter(self.order))
+
+
+class TwoQPolicy:
+
+    """The full 2Q replacement policy.
+
+    a1in is a FIFO of keys seen once, am an LRU list of keys seen
+    again after falling out of a1in, and a1out remembers the keys
+    that recently left a1in (without their data).
+    """
+
+    kin = 0.25                          # share of capacity for a1in
+    kout = 0.5                          # share of capacity for a1out
+
+    def __init__(self):
+        self.a1in = OrderedDict()
+        self.am = OrderedDict()
+        self.a1out = OrderedDict()
+        self.capacity = 0
+
+    def __contains__(self, key):
+        return key in self.a1in or key in self.am
+
+    def __len__(self):
+        return len(self.a1in) + len(self.am)
+
+    def __iter__(self):
+        return iter(list(self.a1in) + list(self.am))
+
+    def insert(self, key):
+        if key in self.a1out:
+            del self.a1out[key]
+            self.am[key] = None
+        else:
+            self.a1in[key] = None
+        self.capacity = max(self.capacity, len(self))
+
+    def touch(self, key):
+        # hits in a1in are deliberately ignored
+        if key in self.am:
+            self.am.move_to_end(key)
+
+    def remove(self, key):
+        if key in self.a1in:
+            del self.a1in[key]
+            self.a1out[key] = None
+            while len(self.a1out) > max(1, int(self.capacity * self.kout)):
+                del self.a1out[next(iter(self.a1out))]
+        else:
+            del self.am[key]
+
+    def victim(self):
+        if self.a1in and (len(self.a1in) > self.capacity * self.kin
+                          or not self.am):
+            return next(iter(self.a1in))
+        return next(iter(self.am))
+
+
+class ARCPolicy:
+
+    """Adaptive Replacement Cache.
+
+    t1 holds keys seen once recently, t2 keys seen at least twice;
+    b1 and b2 are the ghost lists of keys evicted from each. p is the
+    target size of t1, raised by hits in b1 and lowered by hits in b2.
+    """
+
+    def __init__(self):
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+        self.p = 0
+        self.capacity = 0
+
+    def __contains__(self, key):
+        return key in self.t1 or key in self.t2
+
+    def __len__(self):
+        return len(self.t1) + len(self.t2)
+
+    def __iter__(self):
+        return iter(list(self.t1) + list(self.t2))
+
+    def insert(self, key):
+        if key in self.b1:
+            delta = max(len(self.b2) // len(self.b1), 1)
+            self.p = min(self.capacity, self.p + delta)
+            del self.b1[key]
+            self.t2[key] = None
+        elif key in self.b2:
+            delta = max(len(self.b1) // len(self.b2), 1)
+            self.p = max(0, self.p - delta)
+            del self.b2[key]
+            self.t2[key] = None
+        else:
+            self.t1[key] = None
+        self.capacity = max(self.capacity, len(self))
+
+    def touch(self, key):
+        if key in self.t1:
+            del self.t1[key]
+            self.t2[key] = None
+        elif key in self.t2:
+            self.t2.move_to_end(key)
+
+    def remove(self, key):
+        if key in self.t1:
+            del self.t1[key]
+            ghosts = self.b1
+        else:
+            del self.t2[key]
+            ghosts = self.b2
+        ghosts[key] = None
+        while len(ghosts) > max(1, self.capacity):
+            del ghosts[next(iter(ghosts))]
+
+    def victim(self):
+        if self.t1 and (len(self.t1) > self.p or not self.t2):
+            return next(iter(self.t1))
+        return next(iter(self.t2))
+
+
+policies = {
+    'lru': LRUPolicy,
+    '2q': TwoQPolicy,
+    'arc': ARCPolicy,
+    }
+
+def new_policy(name):
+    """Return a new policy object by name; unknown names get LRU."""
+    try:
+        return policies[str.lower(name)]()
+    except (KeyError, AttributeError):
+        return LRUPolicy()
+
+
+def replay_trace(trace, max_size, names=None):
+    """Replay an access trace through each policy and report hit ratios.
+
+    trace is a sequence of (key, size) pairs, one per request. Each
+    policy manages a simulated cache of max_size bytes, evicting the
+    way DiskCache.make_space() does and refusing objects bigger than
+    a quarter of the cache, as CacheManager.okay_to_cache_p() does.
+
+    Returns a dictionary mapping policy name to (hit ratio, byte hit
+    ratio).
+    """
+    results = {}
+    for name in names or sorted(policies.keys()):
+        policy = new_policy(name)
+        sizes = {}
+        used = 0
+        hits = bytes_hit = requests = bytes_total = 0
+        for key, size in trace:
+            requests = requests + 1
+            bytes_total = bytes_total + size
+            if key in policy:
+                hits = hits + 1
+                bytes_hit = bytes_hit + size
+                policy.touch(key)
+                continue
+            if size > max_size / 4:
+                continue
+            while used + size > max_size and len(policy):
+                victim = policy.victim()
+                policy.remove(victim)
+                used = used - sizes.pop(victim)
+            policy.insert(key)
+            sizes[key] = size
+            used = used + size
+        results[name] = (float(hits) / max(requests, 1),
+                         float(bytes_hit) / max(bytes_total, 1))
+    return results
+
+class _ListLRUPolicy(LRUPolicy):
+
+    """LRU kept in a list, as DiskCache.use_order used to be.
+
+    touch() and remove() are linear in the number of entries.
+    """
+
+    def __init__(self):
+        self.order = []
+
+    def insert(self, key):
+        self.order.append(key)
+
+    def touch(self, key):
+        if key in self.order:
+            self.order.remove(key)
+            self.order.append(key)
+
+    def remove(self, key):
+        self.order.remove(key)
+
+    def victim(self):
+        return self.order[0]
+
+
+def benchmark_lru(entries=5000, requests=20000):
+    """Time LRUPolicy against the old list on a disk cache workload.
+
+    The cache is filled with entries keys, then sees requests random
+    operations in the proportions of a browsing session: mostly hits,
+    some evictions to make room for new pages. Both policies must
+    agree on the final order. Returns a dictionary mapping 'list' and
+    'lru' to seconds.
+    """
+    import random
+    import time
+    rand = random.Random(1)
+    keys = ['http://grail.test/%d' % i for i in range(entries)]
+    ops = []
+    next_key = entries
+    for i in range(requests):
+        if rand.random() < 0.8:
+            ops.append(('touch', rand.choice(keys)))
+        else:
+            ops.append(('replace', 'http://grail.test/%d' % next_key))
+            next_key = next_key + 1
+    results = {}
+    orders = []
+    for name, klass in (('list', _ListLRUPolicy), ('lru', LRUPolicy)):
+        policy = klass()
+        for key in keys:
+            policy.insert(key)
+        t0 = time.perf_counter()
+        for op, key in ops:
+            if op == 'touch':
+                policy.touch(key)
+            else:
+                policy.remove(policy.victim())
+                policy.insert(key)
+        results[name] = time.perf_counter() - t0
+        orders.append(list(policy))
+    assert orders[0] == orders[1]
+    return results
+
+def test():
+    """Compare the policies on a trace file.
+
+    Usage: CachePolicy.py trace-file [cache-size-in-KB]
+           CachePolicy.py -b [entries]
+
+    Each line of the trace file names a URL, optionally followed by
+    the size of the response in bytes (the default is 1). With -b,
+    benchmark the LRU policy instead.
+    """
+    import sys
+    if not sys.argv[1:]:
+        print(test.__doc__)
+        return
+    if sys.argv[1] == '-b':
+        for entries in map(int, sys.argv[2:] or ['1000', '5000', '20000']):
+            times = benchmark_lru(entries)
+            print("%6d entries: list %.3fs, OrderedDict %.3fs (%.0fx)"
+                  % (entries, times['list'], times['lru'],
+                     times['list'] / times['lru']))
+        return
+    max_size = 1024 * 1024
+    if sys.argv[2:]:
+        max_size = int(sys.argv[2]) * 1024
+    trace = []
+    for line in open(sys.argv[1]):
+        words = str.split(line)
+        if not words:
+            continue
+        if words[1:]:
+            trace.append((words[0], int(words[1])))
+        else:
+            trace.append((words[0], 1))
+    results = replay_trace(trace, max_size)
+    print("%-6s %10s %10s" % ("policy", "hits", "byte hits"))
+    for name in sorted(results.keys()):
+        ratio, byte_ratio = results[name]
+        print("%-6s %9.1f%% %9.1f%%" % (name, ratio * 100, byte_ratio * 100))
+
+
+if __name__ == '__main__':
+    test()
@@ -308,6 +308,22 @@ class Context(URIContext):
                 image.start_loading(self)
         return image
 
+    def image_priority(self):
+        """Return the SocketQueue priority for an image requested now.
+
+        Images are requested as the document is parsed, so an image
+        lands below the visible part of the viewer if the text
+        already extends beyond it.
+        """
+        import SocketQueue
+        from tkinter import TclError
+        try:
+            if self.viewer.text.yview()[1] < 1.0:
+                return SocketQueue.OFFSCREEN
+        except (AttributeError, TclError):
+            pass
+        return SocketQueue.IMAGE
+
     # Navigation/history commands
 
     def go_back(self, event=None):
@@ -331,13 +347,49 @@ class Context(URIContext):
             return 0
         self.future = future
         if not reload:
-            self.follow(page.url(), histify=0, scrollpos=page.scrollpos(),
-                        target="_self")
+            if not self.replay_page(page):
+                self.follow(page.url(), histify=0,
+                            scrollpos=page.scrollpos(), target="_self")
         else:
             self.load(page.url(), reload=reload, scrollpos=page.scrollpos(),
                       target="_self")
         return 1
 
+    def replay_page(self, page):
+        """Show a page from the history by replaying its event log.
+
+        This takes neither reading nor parsing.  Return true if it was
+        done; if the page has no complete log, or it is the current
+        page, return false and leave the work to follow().
+        """
+        events = page.events()
+        if not (events and events.complete):
+            return 0
+        url = page.url()
+        newurl, frag = urldefrag(url)
+        current, f = urldefrag(self.get_url())
+        if newurl == current:
+            return 0
+        self.stop()
+        self.save_page_state()
+        self.message("Loading %s" % url)
+        self.set_postdata(None)
+        self.app.prefetcher.forget(self)
+        self.clear_reset()
+        self.set_headers(page.headers() or {})
+        self.set_url(url)
+        import GrailHTMLParser
+        parser = GrailHTMLParser.GrailHTMLParser(self.viewer, record=0)
+        parser.replay(events)
+        if frag:
+            self.viewer.scroll_to(frag)
+        else:
+            self.viewer.scroll_to_position(page.scrollpos())
+        if not self.readers:
+            self.readers_done()
+        self.new_reader_status()
+        return 1
+
     def show_history_dialog(self):
         if not self.history_dialog:
             self.history_dialog = History.HistoryDialog(self, self.history)
@@ -372,6 +424,7 @@ class Context(URIContext):
         # mailtoAPI.mailto_access can get at the URL of the page that
         # the user has clicked off of. -baw
         self.set_postdata(data)
+        self.app.prefetcher.forget(self)
         global LAST_CONTEXT
         LAST_CONTEXT = self
         from Reader import Reader
@@ -569,14 +622,19 @@ class Context(URIContext):
         if reader in self.readers:
             self.readers.remove(reader)
         if not self.readers:
-            if self.on_top():
-                self.browser.clearstop()
-            if self.source:
-                self.source.remove_temp_tag(histify=1)
-                self.source = None
-            self.notify()
+            self.readers_done()
         self.new_reader_status()
 
+    def readers_done(self):
+        # The page and everything in it has been loaded.
+        if self.on_top():
+            self.browser.clearstop()
+        if self.source:
+            self.source.remove_temp_tag(histify=1)
+            self.source = None
+        self.notify()
+        self.app.prefetcher.document_done(self)
+
     def busy(self):
         return not not self.readers
 
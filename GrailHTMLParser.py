@@ -16,6 +16,7 @@ import utils.grailutil as grailutil
 
 from utils.grailutil import extract_attribute, extract_keyword
 from sgml.HTMLParser import HTMLParser, HeaderNumber
+from sgml import SGMLLexer, SGMLParser
 
 
 AS_IS = formatter.AS_IS
@@ -46,7 +47,7 @@ class GrailHTMLParser(HTMLParser):
 
     object_aware_tags = ['param', 'a', 'alias', 'applet', 'script', 'object']
 
-    def __init__(self, viewer, reload=0):
+    def __init__(self, viewer, reload=0, record=1):
         global _inited
         self.viewer = viewer
         self.reload = reload
@@ -71,11 +72,33 @@ class GrailHTMLParser(HTMLParser):
             self.reload1.attach(self)
         if self.app.prefs.GetBoolean('parsing-html', 'strict'):
             self.sgml_parser.restrict(0)
+        lexer = self.app.prefs.Get('parsing-html', 'lexer')
+        if lexer in SGMLLexer.engines:
+            self.sgml_parser.engine(lexer)
+        # Keep the events of the parse with the history entry, so that
+        # going back to the page can replay them (see replay()).  The
+        # Reader marks the log complete when it has read everything.
+        page = self.context.page
+        if record and page \
+           and self.app.prefs.GetBoolean('parsing-html', 'replay'):
+            events = SGMLParser.EventLog()
+            self.sgml_parser.record(events)
+            page.set_events(events, self.context.get_headers())
         # Information from <META ... CONTENT="..."> is collected here.
         # Entries are KEY --> [(NAME, HTTP-EQUIV, CONTENT), ...], where
         # KEY is (NAME or HTTP-EQUIV).
         self._metadata = {}
 
+    def replay(self, events):
+        """Show a document again from the event log of an earlier parse.
+
+        The parser should have been created with record=0.
+        """
+        self.viewer.unfreeze()
+        events.replay(self.sgml_parser)
+        self.close()
+        self.viewer.freeze()
+
     def close(self):
         HTMLParser.close(self)
         if self.reload1:
@@ -0,0 +1,217 @@
+"""Event loops driving the readers and the protocol handlers.
+
+BaseReader and the protocol handlers need two services from an event
+loop: a call when a file descriptor becomes readable, and a call after
+a delay.  Two loops provide them:
+
+TkLoop -- Tk file handlers and timers; each readable event is a
+          separate trip through the Tk main loop (the classic way)
+
+AsyncioLoop -- an asyncio event loop.  Without Tk (html2ps, bkmktool,
+          batch fetching) it runs on its own; see run() and fetch().
+          Under the GUI it is pumped from a Tk timer, and each tick
+          services every ready socket at once, so many concurrent
+          loads don't cost a Tk round-trip per chunk.
+
+The browser picks one with the sockets--event-loop preference.  Code
+that has no application with a loop gets a shared headless
+AsyncioLoop from get_loop().
+"""
+
+import asyncio
+import tkinter
+
+
+class TkLoop:
+
+    def __init__(self, root):
+        self.root = root
+
+    def add_reader(self, fd, callback):
+        self.root.tk.createfilehandler(fd, tkinter.READABLE, callback)
+
+    def remove_reader(self, fd):
+        self.root.tk.deletefilehandler(fd)
+
+    def call_later(self, msecs, callback):
+        return self.root.after(msecs, callback)
+
+    def cancel(self, id):
+        self.root.after_cancel(id)
+
+
+class AsyncioLoop:
+
+    """An asyncio event loop, optionally pumped from Tk.
+
+    interval is the time in milliseconds between pumps while there is
+    anything to wait for; the pump stops by itself when the loop has
+    no readers and no timers left.
+    """
+
+    interval = 10
+
+    def __init__(self, root=None):
+        self.root = root
+        self.loop = asyncio.new_event_loop()
+        self.readers = {}               # fd -> callback
+        self.timers = set()             # pending timer handles
+        self.pump_id = None
+        self.idle = None                # future set when nothing is left
+
+    def add_reader(self, fd, callback):
+        self.readers[fd] = callback
+        self.loop.add_reader(fd, callback, fd, tkinter.READABLE)
+        self.wakeup()
+
+    def remove_reader(self, fd):
+        if fd in self.readers:
+            del self.readers[fd]
+            self.loop.remove_reader(fd)
+            self.check_idle()
+
+    def call_later(self, msecs, callback):
+        holder = []
+        handle = self.loop.call_later(msecs / 1000.0,
+                                      self.fire, holder, callback)
+        holder.append(handle)
+        self.timers.add(handle)
+        self.wakeup()
+        return handle
+
+    def cancel(self, handle):
+        if handle in self.timers:
+            self.timers.remove(handle)
+            handle.cancel()
+            self.check_idle()
+
+    def fire(self, holder, callback):
+        self.timers.discard(holder[0])
+        try:
+            callback()
+        finally:
+            self.check_idle()
+
+    def busy(self):
+        return self.readers or self.timers
+
+    def check_idle(self):
+        if not self.busy() and self.idle and not self.idle.done():
+            self.idle.set_result(None)
+
+    # Running under Tk
+
+    def wakeup(self):
+        if self.root and not self.pump_id:
+            self.pump_id = self.root.after(self.interval, self.pump)
+
+    def pump(self):
+        self.pump_id = None
+        self.run_once()
+        if self.busy():
+            self.pump_id = self.root.after(self.interval, self.pump)
+
+    def run_once(self):
+        """Run the callbacks that are ready, without blocking."""
+        if not self.loop.is_running():
+            # stop() makes run_forever() poll once and return
+            self.loop.stop()
+            self.loop.run_forever()
+
+    # Running on its own
+
+    def run(self, until=None):
+        """Run until nothing is left to do, or until a future is done."""
+        if until is not None:
+            return self.loop.run_until_complete(until)
+        while self.busy():
+            self.idle = self.loop.create_future()
+            self.loop.run_until_complete(self.idle)
+        self.idle = None
+
+
+def new_loop(root=None, kind="tk"):
+    """Return a new event loop of the given kind ('tk' or 'asyncio')."""
+    if root is not None and str.lower(kind or "") != "asyncio":
+        return TkLoop(root)
+    return AsyncioLoop(root)
+
+
+_headless = None
+
+def get_loop(app=None):
+    """Return the event loop of app, or the shared headless loop."""
+    global _headless
+    loop = getattr(app, 'ioloop', None)
+    if loop is None:
+        if _headless is None:
+            _headless = AsyncioLoop()
+        loop = _headless
+    return loop
+
+
+# Reading protocol API objects with coroutines, for headless use
+
+async def wait_readable(api, timeout=0.02):
+    # Wait until api has something for us; poll if it has no file
+    # descriptor (yet), e.g. while it is still connecting.
+    loop = asyncio.get_running_loop()
+    try:
+        fd = api.fileno()
+    except (AttributeError, OSError):
+        fd = -1
+    if fd < 0:
+        await asyncio.sleep(timeout)
+        return
+    future = loop.create_future()
+    def wake():
+        if not future.done():
+            future.set_result(None)
+    loop.add_reader(fd, wake)
+    try:
+        await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        loop.remove_reader(fd)
+
+async def read_api(api, bufsize=8*1024):
+    """Read a protocol API object to the end; return (meta, data).
+
+    meta is the (errcode, errmsg, headers) tuple from getmeta().
+    """
+    try:
+        message, ready = api.pollmeta()
+        while not ready:
+            await wait_readable(api)
+            message, ready = api.pollmeta()
+        meta = api.getmeta()
+        data = []
+        while 1:
+            message, ready = api.polldata()
+            if not ready:
+                await wait_readable(api)
+                continue
+            chunk = api.getdata(bufsize)
+            if not chunk:
+                break
+            data.append(chunk)
+    finally:
+        api.close()
+    return meta, b"".join(data)
+
+async def fetch_all(urls, mode='GET', params={}):
+    import protocols
+    apis = []
+    for url in urls:
+        apis.append(protocols.protocol_access(url, mode, params))
+    return await asyncio.gather(*[read_api(api) for api in apis],
+                                return_exceptions=True)
+
+def fetch(urls, app=None):
+    """Fetch URLs concurrently without Tk.
+
+    Return a list with a (meta, data) tuple, or the exception raised,
+    for each URL.
+    """
+    return get_loop(app).run(fetch_all(urls))
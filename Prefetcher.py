@@ -0,0 +1,195 @@
+"""Background prefetching into the cache.
+
+While the user reads a page, the Prefetcher loads the documents the
+user is likely to want next, so that following the link is served
+from the cache:
+
+- documents named by <LINK REL=NEXT> (or REL=PREFETCH) in the page,
+- links on the same site that the pointer rests on, and
+- the inline images of those documents.
+
+Nothing is fetched while the page that asked for it is still loading.
+All requests use the lowest SocketQueue priority, only a few run at a
+time, and the total is limited by a per-session byte budget.  The
+whole thing is off unless the prefetch--enabled preference is set.
+"""
+
+import re
+from urllib.parse import urljoin, urlparse
+from collections import OrderedDict
+
+import IOLoop
+import SocketQueue
+
+
+PREFS_GROUP = 'prefetch'
+
+MAX_ACTIVE = 2                          # concurrent prefetches
+MAX_SCAN = 256*1024                     # bytes of HTML scanned for images
+MAX_IMAGES = 20                         # images taken from one document
+CHUNKS = 16                             # reads per poll
+
+imgprog = re.compile(br'<img\s[^>]*?src\s*=\s*["\']?([^"\'\s>]+)',
+                     re.IGNORECASE)
+
+
+class Prefetcher:
+
+    def __init__(self, app):
+        self.app = app
+        self.pending = OrderedDict()    # url -> (context, scan)
+        self.active = {}                # url -> PrefetchLoad
+        self.seen = set()               # urls already prefetched or tried
+        self.used = 0                   # bytes fetched this session
+        self.update_prefs()
+        app.prefs.AddGroupCallback(PREFS_GROUP, self.update_prefs)
+
+    def update_prefs(self):
+        prefs = self.app.prefs
+        self.enabled = prefs.GetBoolean(PREFS_GROUP, 'enabled')
+        self.budget = prefs.GetInt(PREFS_GROUP, 'budget') * 1024
+        self.images = prefs.GetBoolean(PREFS_GROUP, 'images')
+        if not self.enabled:
+            self.pending.clear()
+            for load in list(self.active.values()):
+                load.stop()
+
+    def over_budget(self):
+        return self.used >= self.budget
+
+    # Hints from the documents and the viewers
+
+    def add(self, context, url, scan=1):
+        """Queue url for prefetching on behalf of context.
+
+        If scan is true and url turns out to be HTML, its images are
+        prefetched too. Returns true if url was queued.
+        """
+        if not self.enabled or self.over_budget():
+            return 0
+        url = urlparse(url)._replace(fragment='').geturl()
+        if url in self.seen or url in self.active or url in self.pending:
+            return 0
+        if urlparse(url)[0] != 'http':
+            return 0
+        self.pending[url] = (context, scan)
+        self.schedule()
+        return 1
+
+    def hover(self, context, url):
+        """The pointer rests on a link to url in context."""
+        page = urlparse(context.get_url())
+        target = urlparse(url)
+        if (page[0], page[1]) == (target[0], target[1]):
+            self.add(context, url)
+
+    def forget(self, context):
+        """Drop the hints of context, which is loading something else."""
+        for url, (ctx, scan) in list(self.pending.items()):
+            if ctx is context:
+                del self.pending[url]
+
+    def document_done(self, context):
+        """context has finished loading; its hints may go ahead."""
+        self.schedule()
+
+    # Running the loads
+
+    def schedule(self):
+        for url, (context, scan) in list(self.pending.items()):
+            if len(self.active) >= MAX_ACTIVE or self.over_budget():
+                break
+            if context.busy():
+                # wait until the page itself is done
+                continue
+            del self.pending[url]
+            self.seen.add(url)
+            try:
+                self.active[url] = PrefetchLoad(self, url, context,
+                                                scan and self.images)
+            except IOError:
+                pass
+
+    def load_done(self, load):
+        if self.active.get(load.url) is load:
+            del self.active[load.url]
+        if load.scan and load.html:
+            self.add_images(load)
+        self.schedule()
+
+    def add_images(self, load):
+        count = 0
+        for src in imgprog.findall(b"".join(load.data)):
+            src = urljoin(load.url, str(src, 'latin-1'))
+            if self.add(load.context, src, 0):
+                count = count + 1
+                if count >= MAX_IMAGES:
+                    break
+
+
+class PrefetchLoad:
+
+    """Read one URL through the cache, polling from a timer."""
+
+    interval = 50                       # msecs between polls
+
+    def __init__(self, prefetcher, url, context, scan):
+        self.prefetcher = prefetcher
+        self.url = url
+        self.scan = scan
+        self.context = context
+        self.html = 0
+        self.data = []
+        self.meta = None
+        app = prefetcher.app
+        self.loop = IOLoop.get_loop(app)
+        self.api = app.open_url(url, 'GET',
+                                {SocketQueue.PRIORITY: SocketQueue.PREFETCH})
+        self.id = None
+        self.again()
+
+    def poll(self):
+        self.id = None
+        if self.api.iscached() and not self.scan:
+            # nothing to do
+            return self.stop()
+        try:
+            if self.meta is None:
+                message, ready = self.api.pollmeta()
+                if not ready:
+                    return self.again()
+                self.meta = self.api.getmeta()
+                errcode, errmsg, headers = self.meta
+                if errcode != 200:
+                    return self.stop()
+                self.html = str.lower(headers.get('content-type', '')) \
+                            [:9] == 'text/html'
+            for i in range(CHUNKS):
+                message, ready = self.api.polldata()
+                if not ready:
+                    return self.again()
+                data = self.api.getdata(8*1024)
+                if not data:
+                    return self.stop()
+                if not self.api.iscached():
+                    self.prefetcher.used = self.prefetcher.used + len(data)
+                if self.scan and self.html \
+                   and len(self.data) * 8*1024 < MAX_SCAN:
+                    self.data.append(data)
+                if self.prefetcher.over_budget():
+                    return self.stop()
+            self.again()
+        except IOError:
+            self.stop()
+
+    def again(self):
+        self.id = self.loop.call_later(self.interval, self.poll)
+
+    def stop(self):
+        if self.id:
+            self.loop.cancel(self.id)
+            self.id = None
+        if self.api:
+            self.api.close()
+            self.api = None
+            self.prefetcher.load_done(self)
@@ -9,6 +9,7 @@ from urllib.parse import urlparse
 from tkinter import *
 from utils import tktools
 from BaseReader import BaseReader
+import SocketQueue
 import copy
 import re
 import time
@@ -340,6 +341,76 @@ class GzipWrapper:
         self.__parser.close()
 
 
+class ChunkedWrapper:
+    """Decode an HTTP/1.1 chunked body incrementally and pass the chunk
+    data on to the real handler.
+
+    Only the chunk-size and trailer lines are buffered, and only until
+    they are complete; chunk data is passed on as it arrives.  The
+    done attribute becomes true once the last chunk and the trailers
+    have been seen; anything fed after that is ignored.
+    """
+
+    def __init__(self, parser):
+        self.__parser = parser
+        self.__line = b""
+        self.__remaining = 0            # chunk data left in this chunk
+        self.__state = self.__read_size
+        self.done = 0
+
+    def feed(self, data):
+        while data and not self.done:
+            data = self.__state(data)
+
+    def __read_line(self, data):
+        # Return (line, rest), or (None, b"") if the line is incomplete.
+        i = data.find(b"\n")
+        if i < 0:
+            self.__line = self.__line + data
+            return None, b""
+        line = self.__line + data[:i]
+        self.__line = b""
+        return line.strip(), data[i+1:]
+
+    def __read_size(self, data):
+        line, data = self.__read_line(data)
+        if line is None:
+            return data
+        line = line.split(b";", 1)[0]   # ignore chunk extensions
+        try:
+            self.__remaining = int(line, 16)
+        except ValueError:
+            raise IOError(0, "bad chunk size in chunked transfer-encoding")
+        if self.__remaining:
+            self.__state = self.__read_data
+        else:
+            self.__state = self.__read_trailer
+        return data
+
+    def __read_data(self, data):
+        chunk = data[:self.__remaining]
+        self.__remaining = self.__remaining - len(chunk)
+        self.__parser.feed(chunk)
+        if not self.__remaining:
+            self.__state = self.__read_data_end
+        return data[len(chunk):]
+
+    def __read_data_end(self, data):
+        line, data = self.__read_line(data)
+        if line is not None:
+            self.__state = self.__read_size
+        return data
+
+    def __read_trailer(self, data):
+        line, data = self.__read_line(data)
+        if line == b"":
+            self.done = 1
+        return data
+
+    def close(self):
+        self.__parser.close()
+
+
 # This table maps content-transfer-encoding values to the appropriate
 # decoding wrappers.  It should not be needed with HTTP (1.1 explicitly
 # forbids it), but it's never a good idea to ignore the possibility.
@@ -433,6 +504,9 @@ class Reader(BaseReader):
         self.last_context = context
         self.method = method
         self.params = copy.copy(params)
+        if context.viewer.parent \
+           and SocketQueue.PRIORITY not in self.params:
+            self.params[SocketQueue.PRIORITY] = SocketQueue.FRAME
         self.show_source = show_source
         self.reload = reload
         self.data = data
@@ -667,6 +741,9 @@ class Reader(BaseReader):
         self.context.clear_reset()
         self.context.set_headers(headers)
         self.context.set_url(self.url)
+        if self.context.page:
+            # an HTML parser will start a new log
+            self.context.page.set_events(None)
         parser = parserclass(self.viewer, reload=self.reload)
         # decode the content
         parser = wrap_parser(parser, content_type,
@@ -731,6 +808,10 @@ class Reader(BaseReader):
 
     def handle_eof(self):
         if not self.save_file:
+            page = self.context.page
+            if page and page.events():
+                # the parser has seen it all; the page can be replayed
+                page.events().complete = 1
             if self.fragment:
                 self.viewer.scroll_to(self.fragment)
             elif self.scrollpos:
@@ -0,0 +1,168 @@
+"""Scheduling of network connections.
+
+The SocketQueue hands out a limited number of sockets to the protocol
+handlers.  A request that cannot be served at once waits in a queue
+until another connection is returned.  Waiting requests are served by
+priority class first; within a class, the hosts with waiting requests
+take turns, and no host gets more than max_per_host connections at a
+time, so a page with hundreds of images from one server cannot starve
+the loads from other servers.
+
+Requests are tagged with a priority by passing the PRIORITY key in
+the params dictionary handed to the protocol API (keys starting with
+a dot are not sent as headers).
+"""
+
+import time
+from collections import OrderedDict, deque
+
+
+# Priority classes, most urgent first
+DOCUMENT = 0                            # top-level documents
+FRAME = 1                               # frames, applets and the like
+IMAGE = 2                               # images in the visible area
+OFFSCREEN = 3                           # images below the fold
+PREFETCH = 4                            # speculative loads
+
+priority_names = ("document", "frame", "image", "offscreen", "prefetch")
+
+PRIORITY = '.priority'                  # the params key
+
+
+def get_priority(params, default=DOCUMENT):
+    """Return the priority class recorded in a params dictionary."""
+    try:
+        return min(max(int(params.get(PRIORITY, default)), DOCUMENT),
+                   PREFETCH)
+    except (TypeError, ValueError):
+        return default
+
+
+class Request:
+
+    def __init__(self, requestor, callback, host, priority):
+        self.requestor = requestor
+        self.callback = callback
+        self.host = host
+        self.priority = priority
+        self.queued = time.time()
+        self.cancelled = 0
+
+
+class SocketQueue:
+
+    def __init__(self, max_sockets, max_per_host=0):
+        self.max = max_sockets
+        self.max_per_host = max_per_host or max_sockets
+        # one OrderedDict per priority class, mapping host to a deque
+        # of its waiting requests; the order of the hosts is the order
+        # in which they take turns
+        self.queues = []
+        for name in priority_names:
+            self.queues.append(OrderedDict())
+        self.waiting = {}               # requestor -> Request
+        self.active = {}                # requestor -> host
+        self.per_host = {}              # host -> number of sockets in use
+        self.open = 0
+        # metrics
+        self.depth = [0] * len(priority_names)
+        self.granted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent_wait = 0.0          # moving average
+
+    def change_max(self, new_max, new_max_per_host=None):
+        self.max = new_max
+        if new_max_per_host is not None:
+            self.max_per_host = new_max_per_host or new_max
+        # run wild free sockets
+        self.schedule()
+
+    def request_socket(self, requestor, callback, host=None,
+                       priority=DOCUMENT):
+        request = Request(requestor, callback, host, priority)
+        self.waiting[requestor] = request
+        queue = self.queues[priority]
+        if host not in queue:
+            queue[host] = deque()
+        queue[host].append(request)
+        self.depth[priority] = self.depth[priority] + 1
+        self.schedule()
+
+    def return_socket(self, owner):
+        request = self.waiting.get(owner)
+        if request:
+            # died before its time; the queue entry is skipped later
+            del self.waiting[owner]
+            request.cancelled = 1
+            self.depth[request.priority] = self.depth[request.priority] - 1
+            return
+        if owner not in self.active:
+            return
+        host = self.active.pop(owner)
+        self.open = self.open - 1
+        self.per_host[host] = self.per_host[host] - 1
+        if not self.per_host[host]:
+            del self.per_host[host]
+        self.schedule()
+
+    def host_free_p(self, host):
+        return self.per_host.get(host, 0) < self.max_per_host
+
+    def grant(self, request):
+        self.open = self.open + 1
+        self.active[request.requestor] = request.host
+        self.per_host[request.host] = self.per_host.get(request.host, 0) + 1
+        wait = time.time() - request.queued
+        self.granted = self.granted + 1
+        self.total_wait = self.total_wait + wait
+        self.max_wait = max(self.max_wait, wait)
+        self.recent_wait = 0.9 * self.recent_wait + 0.1 * wait
+        request.callback()              # apply callback
+
+    def schedule(self):
+        while self.open < self.max:
+            request = self.next_request()
+            if not request:
+                break
+            self.grant(request)
+
+    def next_request(self):
+        for queue in self.queues:
+            for host in list(queue.keys()):
+                requests = queue[host]
+                while requests and requests[0].cancelled:
+                    requests.popleft()
+                if not requests:
+                    del queue[host]
+                    continue
+                if not self.host_free_p(host):
+                    continue
+                request = requests.popleft()
+                if requests:
+                    # let the other hosts go first next time
+                    queue.move_to_end(host)
+                else:
+                    del queue[host]
+                del self.waiting[request.requestor]
+                self.depth[request.priority] = \
+                    self.depth[request.priority] - 1
+                return request
+        return None
+
+    def stats(self):
+        """Return a dictionary describing the state of the queue."""
+        depths = {}
+        for i in range(len(priority_names)):
+            depths[priority_names[i]] = self.depth[i]
+        return {'open': self.open,
+                'max': self.max,
+                'max-per-host': self.max_per_host,
+                'waiting': len(self.waiting),
+                'depth': depths,
+                'hosts': dict(self.per_host),
+                'granted': self.granted,
+                'mean-wait': self.total_wait / max(self.granted, 1),
+                'recent-wait': self.recent_wait,
+                'max-wait': self.max_wait,
+                }
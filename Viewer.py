@@ -630,8 +630,9 @@ class Viewer(formatter.AbstractWriter):
         url, target = self.split_target(tagurl)
         message = ''
         if url:
+            absurl = self.context.get_baseurl(url)
+            self.context.app.prefetcher.hover(self.context, absurl)
             if self.SHOW_TITLES:
-                absurl = self.context.get_baseurl(url)
                 ghist = self.context.app.global_history
                 title, when = ghist.lookup_url(absurl)
                 if title:
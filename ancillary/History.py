@@ -35,27 +35,40 @@ class PageInfo:
     Third, if the pages contains a BASE tag, this URL is used in
     resolution of relative urls on this page.  Currently the base URL
     information is kept with the context object.
+
+    An HTML page may also carry the event log of its parse and the
+    headers it came with, so that it can be shown again without
+    reading and parsing it (see Context.replay_page()).
     """
-    def __init__(self, url='', title='', scrollpos=1.0, formdata=None):
+    def __init__(self, url='', title='', scrollpos=1.0, formdata=None,
+                 events=None, headers=None):
         self._url = url
         self._title = title
         self._scrollpos = scrollpos
         if formdata is None: formdata = []
         self._formdata = formdata
+        self._events = events
+        self._headers = headers
 
     def set_url(self, url): self._url = url
     def set_title(self, title): self._title = title
     def set_scrollpos(self, scrollpos): self._scrollpos = scrollpos
     def set_formdata(self, formdata): self._formdata = formdata
+    def set_events(self, events, headers=None):
+        self._events = events
+        self._headers = headers
 
     def url(self): return self._url
     def title(self): return self._title
     def scrollpos(self): return self._scrollpos
     def formdata(self): return self._formdata
+    def events(self): return self._events
+    def headers(self): return self._headers
 
     def clone(self):
         return self.__class__(self._url, self._title,
-                              self._scrollpos, self._formdata[:])
+                              self._scrollpos, self._formdata[:],
+                              self._events, self._headers)
 
 
 
@@ -65,6 +78,10 @@ class DummyHistoryDialog:
     def select(self, index): pass
 
 class History:
+
+    keep_events = 10                    # pages either side of the current
+                                        # one that keep their event logs
+
     def __init__(self):
         self._history = []
         self._dialog = DummyHistoryDialog()
@@ -91,12 +108,14 @@ class History:
         # CGI scripts that produced different output for the same URL
         self._history.append(pageinfo)
         self._current = len(self._history)-1
+        self.forget_events()
         self._dialog.refresh()
 
     def page(self, index=None):
         if index is None: index = self._current
         if 0 <= index < len(self._history):
             self._current = index
+            self.forget_events()
             self._dialog.select(self._current)
             return self._history[self._current]
         else: return None
@@ -110,6 +129,13 @@ class History:
         else:
             return -1, None
 
+    def forget_events(self):
+        # The event logs take a fair amount of memory; keep only those
+        # of the pages one is likely to go back or forward to.
+        for i in range(len(self._history)):
+            if abs(i - self._current) > self.keep_events:
+                self._history[i].set_events(None)
+
     def current(self): return self._current
     def forward(self): return self.page(self._current+1)
     def back(self): return self.page(self._current-1)
@@ -1,5 +1,6 @@
 from tkinter import *
 from utils import tktools
+import SocketQueue
 
 class IOStatusPanel:
 
@@ -61,6 +62,7 @@ class IOStatusPanel:
     def fill_info(self):
         count = 0
         self.infobox.delete(0, END)
+        self.add_queue_info()
         for browser in self.app.browsers:
             count = count+1
             headline = "<Browser %d>" % count
@@ -84,3 +86,21 @@ class IOStatusPanel:
         indent = "   " * level
         headline = str(reader)
         self.infobox.insert(END, indent + headline)
+
+    def add_queue_info(self):
+        stats = self.app.sq.stats()
+        self.infobox.insert(END, "<Connections: %d of %d open, %d waiting>"
+                            % (stats['open'], stats['max'], stats['waiting']))
+        depth = stats['depth']
+        for name in SocketQueue.priority_names:
+            if depth[name]:
+                self.infobox.insert(END, "   %s: %d queued"
+                                    % (name, depth[name]))
+        hosts = sorted(stats['hosts'].items(), key=str)
+        for host, count in hosts:
+            self.infobox.insert(END, "   %s: %d of %d open"
+                                % (host, count, stats['max-per-host']))
+        self.infobox.insert(END, "   wait: %.2fs recent, %.2fs mean,"
+                            " %.2fs max"
+                            % (stats['recent-wait'], stats['mean-wait'],
+                               stats['max-wait']))
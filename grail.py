@@ -46,6 +46,8 @@ import BaseApplication
 import grailbase.GrailPrefs
 import Stylesheet
 from CacheMgr import CacheManager
+import IOLoop
+from Prefetcher import Prefetcher
 from ImageCache import ImageCache
 from Authenticate import AuthenticationManager
 from ancillary import GlobalHistory
@@ -191,46 +193,6 @@ class URLReadWrapper:
         if api:
             api.close()
 
-class SocketQueue:
-
-    def __init__(self, max_sockets):
-        self.max = max_sockets
-        self.blocked = []
-        self.callbacks = {}
-        self.open = 0
-
-    def change_max(self, new_max):
-        old_max = self.max
-        self.max = new_max
-        if old_max < new_max and len(self.blocked) > 0:
-            for i in range(0,min(new_max-old_max, len(self.blocked))):
-                # run wild free sockets
-                self.open = self.open + 1
-                self.callbacks[self.blocked[0]]()
-                del self.callbacks[self.blocked[0]]
-                del self.blocked[0]
-            
-
-    def request_socket(self, requestor, callback):
-        if self.open >= self.max:
-            self.blocked.append(requestor)
-            self.callbacks[requestor] = callback
-        else:
-            self.open = self.open + 1
-            callback()
-
-    def return_socket(self, owner):
-        if owner in self.blocked:
-            # died before its time
-            self.blocked.remove(owner)
-            del self.callbacks[owner]
-        elif len(self.blocked) > 0:
-            self.callbacks[self.blocked[0]]()  # apply callback
-            del self.callbacks[self.blocked[0]]
-            del self.blocked[0]
-        else:
-            self.open = self.open - 1
-
 class Application(BaseApplication.BaseApplication):
 
     """The application class represents a group of browser windows."""
@@ -248,14 +210,10 @@ class Application(BaseApplication.BaseApplication):
         self.stylesheet = Stylesheet.Stylesheet(self.prefs)
         self.load_images = 1            # Overridden by cmd line or pref.
 
-        # socket management
-        sockets = self.prefs.GetInt('sockets', 'number')
-        self.sq = SocketQueue(sockets)
-        self.prefs.AddGroupCallback('sockets',
-                                    lambda self=self: \
-                                    self.sq.change_max(
-                                        self.prefs.GetInt('sockets',
-                                                          'number')))
+        # the event loop for the readers; the socket queue is set up
+        # by BaseApplication
+        self.ioloop = IOLoop.new_loop(
+            self.root, self.prefs.Get('sockets', 'event-loop'))
 
         # initialize on_exit_methods before global_history
         self.on_exit_methods = []
@@ -264,6 +222,7 @@ class Application(BaseApplication.BaseApplication):
         self.rexec_cache = {}
         self.url_cache = CacheManager(self)
         self.image_cache = ImageCache(self.url_cache)
+        self.prefetcher = Prefetcher(self)
         self.auth = AuthenticationManager(self)
         self.root.report_callback_exception = self.report_callback_exception
         if sys.stdin.isatty():
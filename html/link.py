@@ -0,0 +1,19 @@
+"""<LINK> handler: pass prefetching hints on to the Prefetcher."""
+
+from utils.grailutil import extract_keyword
+
+ATTRIBUTES_AS_KEYWORDS = 1
+
+PREFETCH_RELATIONS = ('next', 'prefetch')
+
+
+def do_link(parser, attrs):
+    href = extract_keyword('href', attrs)
+    rel = str.split(str.lower(extract_keyword('rel', attrs, '')))
+    if not href:
+        return
+    for relation in PREFETCH_RELATIONS:
+        if relation in rel:
+            context = parser.context
+            context.app.prefetcher.add(context, context.get_baseurl(href))
+            break
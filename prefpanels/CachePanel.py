@@ -88,6 +88,40 @@ class CachePanel(PrefsPanels.Framework):
         self.RegisterUI('disk-cache', 'size', 'int',
                         e.get, self.widget_set_func(e))
 
+        # in-memory tier size, with the hit rates so far
+        mem_frame = Frame(frame)
+        l = Label(mem_frame, text="Memory:")
+        e = Entry(mem_frame, relief=SUNKEN, width=8)
+        l2 = Label(mem_frame, text="KB")
+        rates = self.app.url_cache.hit_rates()
+        revalidated = self.app.url_cache.stats['revalidated']
+        stats = Label(mem_frame,
+                      text="Hit rate: memory %d%%, disk %d%%; %d not modified"
+                      % (rates['memory'] * 100, rates['disk'] * 100,
+                         revalidated))
+
+        l.pack(side=LEFT)
+        e.pack(side=LEFT)
+        l2.pack(side=LEFT)
+        stats.pack(side=RIGHT)
+        mem_frame.pack(fill=X)
+
+        self.RegisterUI('disk-cache', 'memory-size', 'int',
+                        e.get, self.widget_set_func(e))
+
+        # replacement policy
+        policy_frame = Frame(frame)
+        l = Label(policy_frame, text="Replacement:")
+        policy = StringVar(frame)
+        l.pack(side=LEFT)
+        for text, value in (("LRU", 'lru'), ("2Q", '2q'), ("ARC", 'arc')):
+            Radiobutton(policy_frame, text=text, variable=policy,
+                        value=value).pack(side=LEFT)
+        policy_frame.pack()
+
+        self.RegisterUI('disk-cache', 'policy', 'string',
+                        policy.get, policy.set)
+
         # cache directory
         e, l, f = tktools.make_labeled_form_entry(frame, "Directory:")
         self.RegisterUI('disk-cache', 'directory', 'string',
@@ -42,10 +42,18 @@ class GeneralPanel(PrefsPanels.Framework):
 
         self.PrefsEntry(frame, 'Max. connections:', 'sockets', 'number', 'int',
                         entry_width=3) 
+        self.PrefsEntry(frame, 'Per host:', 'sockets', 'per-host', 'int',
+                        entry_width=3)
 
         self.PrefsCheckButton(frame, "Image loading:", "Load inline images",
                               'browser', 'load-images')
 
+        self.PrefsCheckButton(frame, "Prefetching:",
+                              "Load likely next pages in the background",
+                              'prefetch', 'enabled')
+        self.PrefsEntry(frame, 'Prefetch budget (KB):',
+                        'prefetch', 'budget', 'int', entry_width=6)
+
         self.PrefsCheckButton(frame,
                               "Link information:",
                               "Show title of link target, if known",
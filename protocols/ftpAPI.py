@@ -18,13 +18,14 @@ import re
 import regsub
 
 import ftplib
+import select
 from urllib import unquote, splithost, splitport, splituser, \
      splitpasswd, splitattr, splitvalue, quote
 from urllib import urljoin
 import email
 from utils.Assert import Assert
 from utils import grailutil
-import socket
+from utils import dnscache
 
 app = grailutil.get_grailapp()          # app.guess_type(url)
 
@@ -84,7 +85,7 @@ class ftp_access:
         user, host = splituser(host)
         if user: user, passwd = splitpasswd(user)
         else: passwd = None
-        host = socket.gethostbyname(host)
+        host = dnscache.gethostbyname(host)
         if port:
             try:
                 port = int(port)
@@ -165,7 +166,10 @@ class ftp_access:
 
     def polldata(self):
         Assert(self.state in (EOF, DATA))
-        return "Ready", 1
+        if self.state == EOF:
+            return "Ready", 1
+        return ("waiting for data",
+                len(select.select([self.sock], [], [], 0)[0]))
 
     def getdata(self, maxbytes):
         if self.state == EOF:
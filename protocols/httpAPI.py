@@ -1,16 +1,32 @@
 """Provisional HTTP interface using the new protocol API.
 
 XXX This was hacked together in an hour si I would have something to
-test ProtocolAPI.py.  Especially the way it uses knowledge about the
-internals of http.client.HTTP is disgusting (but then, so would editing
-the source of http.client.py be :-).
+test ProtocolAPI.py.  MyHTTP only writes requests; the replies are
+read off the socket here and parsed by hand.
 
 XXX Main deficiencies:
 
 - poll*() always returns ready
 - should read the headers more carefully (no blocking)
 - (could even *write* the headers more carefully)
-- should poll the connection making part too
+
+Setting up a connection does not block: the host name is looked up
+by utils.dnscache in a worker thread, and the non-blocking connect is
+polled from the Tk event loop (the CONN stage) before the request is
+sent and the reader is started.
+
+Requests are sent as HTTP/1.1, and connections are kept alive where
+the server allows it: a response body delimited by its Content-Length
+or by chunked transfer-encoding ends without the server closing the
+socket, and the connection then goes back to a per-host pool (see
+ConnectionPool) to be picked up by the next request for the same host.
+A server may close an idle connection just as it is reused, so the
+readers are only started on a reused connection once the reply has
+begun to arrive; if it ends or is reset first, the request is sent
+again on a fresh connection. POSTs are not idempotent and are never
+sent on a reused connection.
+Chunked bodies are decoded here, below the cache, so the cache and the
+readers only ever see the decoded data.
 
 """
 
@@ -18,20 +34,24 @@ XXX Main deficiencies:
 
 import http.client
 from urllib import splithost
-import email
 from utils.Assert import Assert
 from utils import grailutil
 import select
 import Reader
+import SocketQueue
 import re
-import io
 import socket
+import errno
+import os
 import sys
+import time
+from utils import dnscache
+import IOLoop
 from __main__ import GRAILVERSION
 
 
-http.client.HTTP_VERSIONS_ACCEPTED = 'HTTP/1\.[0-9.]+'
-replypat = http.client.HTTP_VERSIONS_ACCEPTED + '[ \t]+\([0-9][0-9][0-9]\)\(.*\)'
+http.client.HTTP_VERSIONS_ACCEPTED = 'HTTP/(1\.[0-9.]+)'
+replypat = http.client.HTTP_VERSIONS_ACCEPTED + '[ \t]+([0-9][0-9][0-9])(.*)'
 replyprog = re.compile(replypat)
 
 http.client.replypat = replypat
@@ -39,31 +59,147 @@ http.client.replyprog = replyprog
 
 
 # Search for blank line following HTTP headers
-endofheaders = re.compile("\n[ \t]*\r?\n")
+endofheaders = re.compile(b"\n[ \t]*\r?\n")
 
 
 # Stages
 # there are now five stages
 WAIT = 'wait'  # waiting for a socket
+CONN = 'connect'  # looking up the host and connecting
 META = 'meta'
 DATA = 'data'
 DONE = 'done'
 CLOS = 'closed'
 
-class MyHTTP(http.client.HTTP):
+class MyHTTP:
+
+    """A client connection, in the style of the old httplib.HTTP.
+
+    The reply is parsed from the data http_access has already read
+    off the socket, so this class never reads from the socket itself.
+    """
+
+    debuglevel = 0
+    reused = 0                          # set by the pool on reuse
+    version = '0.9'                     # of the last reply
+    connect_timeout = 30                # seconds per address
+
+    def __init__(self, host):
+        self.file = None
+        self.sock = None
+        self.buffer = []
+        self.port = 80
+        i = str.rfind(host, ':')
+        if i >= 0 and str.isdigit(host[i+1:]):
+            host, self.port = host[:i], int(host[i+1:])
+        self.host = host
+        self.lookup = None
+        self.addresses = None
+        self.error = None
+        self.started = None
+        self.connected = 0
+
+    def connect_p(self):
+        """Advance the connection set-up without blocking.
+
+        Return true once the connection is made.  Raise socket.error
+        when the host name cannot be resolved or none of its
+        addresses accepts the connection.
+        """
+        if self.connected:
+            return 1
+        if self.addresses is None:
+            if not self.lookup:
+                self.lookup = dnscache.resolve(self.host)
+            if not self.lookup.done():
+                return 0
+            self.addresses = self.lookup.addresses(self.port)
+        while 1:
+            if self.sock is None:
+                if not self.addresses:
+                    raise self.error or \
+                          socket.error("no address for %s" % self.host)
+                family, address = self.addresses.pop(0)
+                self.sock = socket.socket(family, socket.SOCK_STREAM)
+                self.sock.setblocking(0)
+                self.started = time.time()
+                err = self.sock.connect_ex(address)
+                if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    self.connect_failed(err)
+                    continue
+            if not select.select([], [self.sock], [], 0)[1]:
+                if time.time() - self.started > self.connect_timeout:
+                    self.connect_failed(errno.ETIMEDOUT)
+                    continue
+                return 0
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self.connect_failed(err)
+                continue
+            self.sock.setblocking(1)
+            self.connected = 1
+            return 1
+
+    def connect_failed(self, err):
+        # try the next address, if any
+        self.error = socket.error(err, os.strerror(err))
+        self.sock.close()
+        self.sock = None
+
+    def connect(self):
+        """Finish the connection set-up, blocking if necessary."""
+        while not self.connect_p():
+            if self.sock is None:
+                self.lookup.wait()
+            else:
+                select.select([], [self.sock], [], self.connect_timeout)
 
     def putrequest(self, request, selector):
         self.selector = selector
-        http.client.HTTP.putrequest(self, request, selector)
-
-    def getreply(self, file):
-        self.file = file
-        line = self.file.readline()
-        if self.debuglevel > 0: print('reply:', repr(line))
-        if replyprog.match(line) < 0:
+        self.buffer = ['%s %s HTTP/1.1' % (request, selector)]
+
+    def putheader(self, header, value):
+        self.buffer.append('%s: %s' % (header, value))
+
+    def endheaders(self):
+        self.buffer.extend(['', ''])
+        self.send(str.join('\r\n', self.buffer))
+        self.buffer = []
+
+    def send(self, data):
+        if self.debuglevel > 0: print('send:', repr(data))
+        if isinstance(data, str):
+            data = data.encode('latin-1')
+        self.sock.sendall(data)
+
+    def keep_alive_p(self, errcode, headers):
+        """Check if the connection may carry another request.
+
+        Only when the server agreed to keep it open (HTTP/1.1 does
+        unless it says otherwise) and the end of the body can be told
+        without the server closing the connection.
+        """
+        connection = str.lower(headers.get('connection', ''))
+        if 'close' in connection:
+            return 0
+        if self.version == '1.0' and 'keep-alive' not in connection:
+            return 0
+        if errcode in (204, 304) or self.method == 'HEAD':
+            return 1
+        return chunked_p(headers) or 'content-length' in headers
+
+    def getreply(self, head):
+        """Parse the status line and headers of a reply in one pass.
+
+        head holds the reply up to the blank line after the headers,
+        or nothing at all for an HTTP/0.9 reply.
+        """
+        lines = str.split(str(head, 'latin-1'), '\n')
+        if self.debuglevel > 0: print('reply:', repr(lines[0]))
+        match = replyprog.match(lines[0])
+        if not match:
+            self.version = '0.9'
             # Not an HTTP/1.0 response.  Fall back to HTTP/0.9.
-            # Push the data back into the file.
-            self.file.seek(-len(line), 1)
             self.headers = {}
             app = grailutil.get_grailapp()
             c_type, c_encoding = app.guess_type(self.selector)
@@ -72,10 +208,22 @@ class MyHTTP(http.client.HTTP):
             # HTTP/0.9 sends HTML by default
             self.headers['content-type'] = c_type or "text/html"
             return 200, "OK", self.headers
-        errcode, errmsg = replyprog.group(1, 2)
+        self.version, errcode, errmsg = match.group(1, 2, 3)
         errcode = int(errcode)
         errmsg = str.strip(errmsg)
-        self.headers = email.Message(self.file, 0)
+        fields = []
+        for line in lines[1:]:
+            if line[:1] in (' ', '\t'):
+                # continuation line
+                if fields:
+                    fields[-1][1] = fields[-1][1] + ' ' + str.strip(line)
+                continue
+            i = str.find(line, ':')
+            if i > 0:
+                fields.append([line[:i], str.strip(line[i+1:])])
+        self.headers = http.client.HTTPMessage()
+        for name, value in fields:
+            self.headers[name] = value
         return errcode, errmsg, self.headers
 
     def close(self):
@@ -91,18 +239,119 @@ class MyHTTP(http.client.HTTP):
         self.sock = None
 
 
+class ConnectionPool:
+
+    """Idle keep-alive connections, by host.
+
+    At most max_idle connections are kept per host, and a connection
+    that has been idle longer than timeout seconds, or that the server
+    has closed in the meantime, is discarded instead of reused.
+    """
+
+    max_idle = 4
+    timeout = 5
+
+    def __init__(self):
+        self.idle = {}                  # host -> [(connection, time)]
+
+    def get(self, host):
+        """Return an idle connection to host, or None."""
+        idle = self.idle.get(host)
+        now = time.time()
+        while idle:
+            h, since = idle.pop()
+            if now - since < self.timeout and self.alive_p(h):
+                h.reused = 1
+                return h
+            h.close()
+        return None
+
+    def put(self, host, h):
+        """Make a connection available for reuse."""
+        idle = self.idle.setdefault(host, [])
+        idle.append((h, time.time()))
+        while len(idle) > self.max_idle:
+            idle.pop(0)[0].close()
+
+    def alive_p(self, h):
+        # an idle socket is only readable if the server closed it
+        try:
+            return h.sock and not select.select([h.sock], [], [], 0)[0]
+        except (select.error, ValueError):
+            return 0
+
+pool = ConnectionPool()
+
+
+def chunked_p(headers):
+    """Check if a response uses chunked transfer-encoding."""
+    encoding = str.lower(headers.get('transfer-encoding', ''))
+    return str.strip(str.split(encoding, ',')[-1]) == 'chunked'
+
+
+def request_headers(host, params, auth=None):
+    """Return the headers of a request, as a list of (name, value).
+
+    These are the headers send_request() sends: the defaults added
+    here, then params (minus the private ones starting with '.').
+    """
+    headers = [('User-agent', GRAILVERSION), ('Connection', 'keep-alive')]
+    if auth:
+        headers.append(('Authorization', 'Basic %s' % auth))
+    if 'host' not in params:
+        headers.append(('Host', host))
+    if 'accept-encoding' not in params:
+        encodings = sorted(Reader.get_content_encodings())
+        if encodings:
+            headers.append(('Accept-Encoding', ", ".join(encodings)))
+    for key, value in params.items():
+        if key[:1] != '.':
+            headers.append((key, value))
+    headers.append(('Accept', '*/*'))
+    return headers
+
+
+class ChunkCollector:
+
+    """Sink for a Reader.ChunkedWrapper, collecting decoded data."""
+
+    def __init__(self):
+        self.data = []
+
+    def feed(self, data):
+        self.data.append(data)
+
+    def get(self):
+        data = b"".join(self.data)
+        self.data = []
+        return data
+
+    def close(self):
+        pass
+
+
 class http_access:
 
+    recvsize = 16*1024                  # for reading the reply headers
+
     def __init__(self, resturl, method, params, data=None):
         self.app = grailutil.get_grailapp()
         self.args = (resturl, method, params, data)
         self.state = WAIT
         self.h = None
         self.reader_callback = None
-        self.app.sq.request_socket(self, self.open)
+        self.loop = IOLoop.get_loop(self.app)
+        if type(resturl) == type(()):
+            host = resturl[0]
+        else:
+            host = splithost(resturl)[0]
+        if host:
+            host = host[str.rfind(host, '@')+1:]
+        self.app.sq.request_socket(self, self.open, host,
+                                   SocketQueue.get_priority(params))
 
     def register_reader(self, reader_callback, ignore):
-        if self.state == WAIT:
+        if self.state in (WAIT, CONN):
             self.reader_callback = reader_callback
         else:
             # we've been waitin' fer ya
@@ -128,110 +377,445 @@ class http_access:
             user_passwd = None
         if user_passwd:
             import base64
-            auth = str.strip(base64.encodestring(user_passwd))
+            auth = base64.encodebytes(user_passwd.encode())
+            auth = str.strip(auth.decode())
         else:
             auth = None
+        self.host = host
+        self.request = (host, method, selector, params, data, auth)
+        self.readahead = bytearray()
+        self.header_end = None          # offset of the body in readahead
+        self.scanned = 0                # where to look for header_end
+        self.length = None
+        self.chunked = None
+        self.eof = 0                    # connection closed in mid-body
+        self.keep_alive = 0
+        self.line1seen = 0
+        self.error = None
+        self.connect_id = None
+        self.probing = None             # descriptor watched by probe()
+        if method != 'POST':
+            self.h = pool.get(host)
+        if self.h:
+            try:
+                self.send_request()
+            except socket.error:
+                # the server dropped the kept-alive connection
+                self.h.close()
+            else:
+                # stay in CONN, without a descriptor for the readers,
+                # until the reply shows the connection is still good
+                self.state = CONN
+                self.probing = self.h.sock.fileno()
+                self.loop.add_reader(self.probing, self.probe)
+                return
         self.h = MyHTTP(host)
+        self.state = CONN
+        self.poll_connect()
+
+    def poll_connect(self):
+        self.connect_id = None
+        if not self.connect_step():
+            self.connect_id = self.loop.call_later(20, self.poll_connect)
+
+    def connect_step(self):
+        # Advance the connection set-up; return true when it is over.
+        if self.state != CONN:
+            return 1
+        try:
+            if not self.h.connect_p():
+                return 0
+            self.send_request()
+        except socket.error as msg:
+            self.error = msg
+        self.connected()
+        return 1
+
+    def probe(self, *args):
+        """Check a reused connection once it turns readable.
+
+        If the server closed or reset it before sending anything, the
+        request is sent again on a fresh connection; otherwise the
+        readers are started. The data is only peeked at, so the
+        descriptor stays readable for them.
+        """
+        if self.probing is None:
+            return
+        sock = self.h.sock
+        try:
+            if not select.select([sock], [], [], 0)[0]:
+                return
+            first = sock.recv(1, socket.MSG_PEEK)
+        except socket.error as msg:
+            if msg.errno != errno.ECONNRESET:
+                self.error = msg
+            first = b""
+        self.loop.remove_reader(self.probing)
+        self.probing = None
+        if not first and not self.error:
+            self.h.close()
+            self.h = MyHTTP(self.host)
+            self.poll_connect()
+            return
+        self.connected()
+
+    def finish_connect(self):
+        if self.probing is not None:
+            select.select([self.h.sock], [], [])
+            self.probe()
+            return
+        try:
+            self.h.connect()
+            self.send_request()
+        except socket.error as msg:
+            self.error = msg
+        self.connected()
+
+    def connected(self):
+        if self.connect_id:
+            self.loop.cancel(self.connect_id)
+            self.connect_id = None
+        self.state = META
+        callback = self.reader_callback
+        self.reader_callback = None
+        if callback:
+            callback()
+
+    def send_request(self):
+        host, method, selector, params, data, auth = self.request
+        self.h.method = method
         self.h.putrequest(method, selector)
-        self.h.putheader('User-agent', GRAILVERSION)
-        if auth:
-            self.h.putheader('Authorization', 'Basic %s' % auth)
-        if not params.has_key('host'):
-            self.h.putheader('Host', host)
-        if not params.has_key('accept-encoding'):
-            encodings = Reader.get_content_encodings()
-            if encodings:
-                encodings.sort()
-                self.h.putheader(
-                    'Accept-Encoding', str.join(encodings, ", "))
-        for key, value in params.items():
-            if key[:1] != '.':
-                self.h.putheader(key, value)
-        self.h.putheader('Accept', '*/*')
+        for name, value in request_headers(host, params, auth):
+            self.h.putheader(name, value)
         self.h.endheaders()
         if data:
             self.h.send(data)
-        self.readahead = ""
-        self.state = META
-        self.line1seen = 0
-        if self.reader_callback:
-            self.reader_callback()
 
     def close(self):
+        if self.state == CONN and self.connect_id:
+            self.loop.cancel(self.connect_id)
+            self.connect_id = None
+        if self.probing is not None:
+            self.loop.remove_reader(self.probing)
+            self.probing = None
         if self.h:
-            self.h.close()
+            if self.state == DONE and self.keep_alive:
+                pool.put(self.host, self.h)
+            else:
+                self.h.close()
         if self.state != CLOS:
             self.app.sq.return_socket(self)
             self.state = CLOS
         self.h = None
 
     def pollmeta(self, timeout=0):
+        if self.state == WAIT:
+            return "waiting for socket", 0
+        if self.state == CONN:
+            if self.probing is not None:
+                self.probe()
+            else:
+                self.connect_step()
+            if self.state == CONN:
+                return "connecting to %s" % self.host, 0
         Assert(self.state == META)
+        if self.error:
+            return "connection failed", 1
 
         sock = self.h.sock
         try:
             if not select.select([sock], [], [], timeout)[0]:
                 return "waiting for server response", 0
         except select.error as msg:
-            raise IOError, msg, sys.exc_traceback
+            raise IOError(msg)
         try:
-            new = sock.recv(1024)
+            new = sock.recv(self.recvsize)
         except socket.error as msg:
-            raise IOError, msg, sys.exc_traceback
+            raise IOError(msg)
         if not new:
+            if self.h.reused and not self.line1seen:
+                # never take a cut-off reply for an HTTP/0.9 one
+                self.error = socket.error("connection closed in reply")
+                return "EOF in server response", 1
+            self.header_end = len(self.readahead)
             return "EOF in server response", 1
-        self.readahead = self.readahead + new
-        if '\n' not in new:
-            return "receiving server response", 0
+        self.readahead.extend(new)
         if not self.line1seen:
-            i = str.find(self.readahead, '\n')
+            i = self.readahead.find(b'\n')
             if i < 0:
                 return "receiving server response", 0
             self.line1seen = 1
-            line = self.readahead[:i+1]
-            if replyprog.match(line) < 0:
+            if not replyprog.match(str(self.readahead[:i], 'latin-1')):
+                if self.h.reused:
+                    # left over from an earlier reply, not HTTP/0.9
+                    self.error = socket.error("invalid server response")
+                    return "invalid server response", 1
+                self.header_end = 0
                 return "received non-HTTP/1.0 server response", 1
-        i = endofheaders.search(self.readahead)
-        if i >= 0:
+            self.scanned = i
+        # Only the data after the last newline seen before can hold
+        # the start of the blank line ending the headers.
+        match = endofheaders.search(self.readahead, self.scanned)
+        if match:
+            self.header_end = match.end()
             return "received server response", 1
+        self.scanned = max(self.scanned,
+                           self.readahead.rfind(b'\n', self.scanned))
         return "receiving server response", 0
 
     def getmeta(self):
+        while self.header_end is None and not self.error:
+            if self.state == CONN:
+                self.finish_connect()
+            else:
+                self.pollmeta(None)
         Assert(self.state == META)
-        if not self.readahead:
-            x, y = self.pollmeta(None)
-            while not y:
-                x, y = self.pollmeta(None)
-        file = io.io(self.readahead)
-        errcode, errmsg, headers = self.h.getreply(file)
+        if self.error:
+            # report it like the other I/O errors, as (errno, message)
+            self.state = DATA
+            self.length = 0
+            return self.error.errno or 0, str(self.error), {}
+        end = self.header_end
+        errcode, errmsg, headers = self.h.getreply(bytes(self.readahead[:end]))
         self.state = DATA
-        self.readahead = file.read()
+        self.readahead = bytes(self.readahead[end:])
+        self.keep_alive = self.h.keep_alive_p(errcode, headers)
+        if errcode in (204, 304) or self.h.method == 'HEAD':
+            self.length = 0
+        elif chunked_p(headers):
+            # the transfer-encoding is hop-by-hop; what is passed on
+            # (and cached) is the decoded body
+            self.collector = ChunkCollector()
+            self.chunked = Reader.ChunkedWrapper(self.collector)
+            del headers['transfer-encoding']
+        elif 'content-length' in headers:
+            try:
+                self.length = int(headers['content-length'])
+            except ValueError:
+                self.keep_alive = 0
+        if self.length is not None:
+            self.readahead = self.readahead[:self.length]
         return errcode, errmsg, headers
 
     def polldata(self):
         Assert(self.state == DATA)
-        if self.readahead:
+        if self.chunked:
+            # ready only once there is decoded data: a readable socket
+            # may hold nothing but chunk framing
+            if self.feed_chunked(0):
+                return "processing chunked data", 1
+            return "waiting for data", 0
+        if self.readahead or self.length == 0:
             return "processing readahead data", 1
         return ("waiting for data",
                 len(select.select([self], [], [], 0)[0]))
 
     def getdata(self, maxbytes):
         Assert(self.state == DATA)
+        if self.chunked:
+            return self.getchunkeddata(maxbytes)
+        if self.length is not None:
+            # never read past the end of the body; the rest of the
+            # stream belongs to the next response on this connection
+            maxbytes = min(maxbytes, self.length)
+            if not maxbytes:
+                self.state = DONE
+                return b""
         if self.readahead:
             data = self.readahead[:maxbytes]
             self.readahead = self.readahead[maxbytes:]
-            return data
-        try:
-            data = self.h.sock.recv(maxbytes)
-        except socket.error as msg:
-            raise IOError, msg, sys.exc_traceback
+        else:
+            try:
+                data = self.h.sock.recv(maxbytes)
+            except socket.error as msg:
+                raise IOError(msg)
         if not data:
             self.state = DONE
+            self.keep_alive = 0
             # self.close()
+        elif self.length is not None:
+            self.length = self.length - len(data)
+        return data
+
+    def feed_chunked(self, block):
+        """Decode the chunked body until there is data to return.
+
+        Return true once there is decoded data or the body is over.
+        Unless block is true, the socket is only read while select()
+        says it is readable, so this returns false instead of waiting
+        for the rest of a chunk.
+        """
+        while not self.collector.data and not self.chunked.done \
+              and not self.eof:
+            if self.readahead:
+                raw = self.readahead
+                self.readahead = b""
+            else:
+                sock = self.h.sock
+                try:
+                    if not block and not select.select([sock], [], [], 0)[0]:
+                        return 0
+                    raw = sock.recv(self.recvsize)
+                except (socket.error, select.error) as msg:
+                    raise IOError(msg)
+                if not raw:
+                    self.eof = 1
+                    self.keep_alive = 0
+                    break
+            self.chunked.feed(raw)
+        return 1
+
+    def getchunkeddata(self, maxbytes):
+        # An empty string means end of file to the caller, so block
+        # if polldata() was not asked first.
+        self.feed_chunked(1)
+        data = self.collector.get()
+        if not data:
+            self.state = DONE
         return data
 
     def fileno(self):
+        if self.state in (WAIT, CONN):
+            # not settled yet; see probe()
+            return -1
         return self.h.sock.fileno()
 
 
-# To test this, use ProtocolAPI.test()
+class _TestApp:
+
+    """What http_access needs of the application, for test_chunked()."""
+
+    def __init__(self):
+        self.sq = SocketQueue.SocketQueue(4)
+
+    def guess_type(self, url):
+        return None, None
+
+
+def test_chunked(delay=0.2):
+    """Read a chunked reply whose chunks arrive in pieces.
+
+    A local server sends each chunk header, its data and the last
+    chunk in separate writes, delay seconds apart, and then keeps the
+    connection open. polldata() must not report data before it is
+    there, and neither it nor getdata() may wait for the server.
+    """
+    import threading
+    from grailbase import utils
+    if utils.get_grailapp() is None:
+        utils._grail_app = _TestApp()
+    pieces = [b"5\r\n", b"hello\r\n", b"6;ext=1\r\n", b" world\r\n",
+              b"0\r\n\r\n"]
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    def serve():
+        conn = server.accept()[0]
+        conn.recv(4096)
+        conn.sendall(b"HTTP/1.1 200 OK\r\n"
+                     b"Transfer-Encoding: chunked\r\n\r\n")
+        for piece in pieces:
+            time.sleep(delay)
+            conn.sendall(piece)
+        time.sleep(len(pieces) * delay)
+        conn.close()
+    thread = threading.Thread(target=serve)
+    thread.start()
+    api = http_access('//127.0.0.1:%d/' % server.getsockname()[1],
+                      'GET', {})
+    while not api.pollmeta()[1]:
+        time.sleep(0.01)
+    errcode, errmsg, headers = api.getmeta()
+    Assert(errcode == 200)
+    data = []
+    longest = 0
+    while 1:
+        t0 = time.time()
+        message, ready = api.polldata()
+        if ready:
+            chunk = api.getdata(512)
+            Assert(chunk or api.chunked.done)
+        longest = max(longest, time.time() - t0)
+        if not ready:
+            time.sleep(0.01)
+        elif not chunk:
+            break
+        else:
+            data.append(chunk)
+    api.close()
+    thread.join()
+    server.close()
+    Assert(b"".join(data) == b"hello world")
+    Assert(longest < delay / 2)
+    print("chunked: %r, longest poll %.3f sec" % (b"".join(data), longest))
+
+
+
+def bench_headers(size=32*1024, rounds=50):
+    """Time the reading of a reply with size bytes of headers.
+
+    A local server answers each request with that much Set-Cookie
+    headers; once the whole reply is waiting in the socket, the
+    pollmeta() calls and the getmeta() that take it in are timed,
+    reading 1 KB and recvsize bytes at a time.
+    """
+    import threading
+    from grailbase import utils
+    if utils.get_grailapp() is None:
+        utils._grail_app = _TestApp()
+    cookies = []
+    length = 0
+    while length < size:
+        line = "Set-Cookie: c%d=%s; Path=/; HttpOnly\r\n" % (len(cookies),
+                                                           "x" * 40)
+        cookies.append(line)
+        length = length + len(line)
+    reply = ("HTTP/1.1 200 OK\r\nConnection: close\r\n%s"
+             "Content-Length: 2\r\n\r\nok" % "".join(cookies)
+             ).encode('latin-1')
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    def serve():
+        while 1:
+            conn = server.accept()[0]
+            request = conn.recv(4096)
+            if request:
+                conn.sendall(reply)
+            conn.close()
+            if not request:
+                break
+    thread = threading.Thread(target=serve)
+    thread.start()
+    url = '//127.0.0.1:%d/' % server.getsockname()[1]
+    for recvsize in (1024, http_access.recvsize):
+        total = 0.0
+        polls = 0
+        for i in range(rounds):
+            api = http_access(url, 'GET', {})
+            api.recvsize = recvsize
+            while api.state != META:
+                api.pollmeta()
+                time.sleep(0.001)
+            select.select([api.h.sock], [], [])
+            time.sleep(0.01)            # let the rest of the reply in
+            t0 = time.perf_counter()
+            while not api.pollmeta()[1]:
+                polls = polls + 1
+            errcode, errmsg, headers = api.getmeta()
+            total = total + time.perf_counter() - t0
+            polls = polls + 1
+            Assert(errcode == 200)
+            Assert(len(headers.get_all('set-cookie')) == len(cookies))
+            api.close()
+        print("%d bytes of headers, %5d byte reads: %6.1f usec, "
+              "%d polls per reply" % (len(reply), recvsize,
+                                     total / rounds * 1e6, polls // rounds))
+    socket.create_connection(server.getsockname()).close()
+    thread.join()
+    server.close()
+
+
+# To test this, use ProtocolAPI.test(); test_chunked() tests the
+# reading of chunked replies and bench_headers() times the reading of
+# large headers, against a local server.
@@ -463,7 +463,7 @@ class HTMLParser(SGMLHandler.BaseSGMLHandler):
                     self.sgml_parser.lex_endtag(stack[0])
                     stack = self.sgml_parser.get_context('p')
                 # XXX this is really evil!
-                del self.sgml_parser.stack[-1]
+                self.sgml_parser.remove_innermost()
             return
         self.element_close_maybe('p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6')
         self.formatter.end_paragraph(parbreak)
@@ -488,7 +488,7 @@ class HTMLParser(SGMLHandler.BaseSGMLHandler):
                 self.sgml_parser.lex_endtag(stack[0])
                 stack = self.sgml_parser.get_context('p')
             #  Remove <P> surgically:
-            del self.sgml_parser.stack[-1]
+            self.sgml_parser.remove_innermost()
             self.para_end(parbreak=0)
         else:
             self.formatter.add_line_break()
@@ -1038,6 +1038,14 @@ class HTMLParser(SGMLHandler.BaseSGMLHandler):
     def unknown_endtag(self, tag):
         self.badhtml = 1
 
+    def get_tagtable(self):
+        # get_taginfo() also depends on a preference and on the
+        # extensions the application can load
+        override = self.context.app.prefs.GetBoolean(
+            'parsing-html', 'override-builtin-tags')
+        key = (override,) + tuple(self.get_extension_loaders())
+        return SGMLHandler.BaseSGMLHandler.get_tagtable(self, key)
+
     def get_taginfo(self, tag):
         override = self.context.app.prefs.GetBoolean(
             'parsing-html', 'override-builtin-tags')
@@ -1058,16 +1066,20 @@ class HTMLParser(SGMLHandler.BaseSGMLHandler):
     __tagmask = str.maketrans('-.', '__')
     def get_extension_taginfo(self, tag):
         tag = str.translate(tag, self.__tagmask) # ??? why ???
+        for loader in self.get_extension_loaders():
+            taginfo = loader.get(tag)
+            if taginfo:
+                return taginfo
+        return None
+
+    def get_extension_loaders(self):
+        loaders = []
         for dev in self.get_devicetypes():
             try:
-                loader = self.context.app.get_loader("html." + dev)
+                loaders.append(self.context.app.get_loader("html." + dev))
             except KeyError:
                 pass
-            else:
-                taginfo = loader.get(tag)
-                if taginfo:
-                    return taginfo
-        return None
+        return loaders
 
     # a few interesting UNICODE values:
     __charrefs = {
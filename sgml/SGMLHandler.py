@@ -12,16 +12,23 @@ class ElementHandler:
         pass
 
     def get_taginfo(self, tag):
-        start = do = end = None
-        klass = self.__class__
-        if hasattr(klass, "start_" + tag):
-            start = getattr(klass, "start_" + tag)
-            if hasattr(klass, "end_" + tag):
-                end = getattr(klass, "end_" + tag)
-        elif hasattr(klass, "do_" + tag):
-            do = getattr(klass, "do_" + tag)
-        if start or do:
-            return SGMLParser.TagInfo(tag, start, do, end)
+        return _method_taginfo(self.__class__).get(tag)
+
+    def get_tagtable(self, key=None):
+        """Return the dictionary in which the parser keeps the answers
+        of get_taginfo().
+
+        The dictionary is shared by all instances of the class, so each
+        tag is looked up only once.  Subclasses whose get_taginfo()
+        depends on more than the class pass a key describing the rest;
+        each key gets a dictionary of its own.
+        """
+        key = (self.__class__, key)
+        try:
+            return _tagtables[key]
+        except KeyError:
+            table = _tagtables[key] = {}
+            return table
 
     def handle_endtag(self, tag, method):
         """
@@ -48,7 +55,7 @@ class BaseSGMLHandler(ElementHandler):
         """
         """
         table = self.entitydefs
-        if table.has_key(name):
+        if name in table:
             self.handle_data(table[name])
         else:
             self.unknown_entityref(name, terminator)
@@ -150,3 +157,35 @@ class CompositeHandler:
 
     def handle_endtag(self, tag, method):
         self.__tagmap[tag].handle_endtag(tag, method)
+
+
+_tagtables = {}                         # (class, key) -> tag table
+_method_tables = {}                     # class -> tag -> TagInfo
+
+def _method_taginfo(klass):
+    # Return a dictionary of TagInfo objects for the start_, end_ and
+    # do_ methods of klass, made the first time the class is asked.
+    # (Not when the class is created: some classes have methods taken
+    # away after that, see GrailHTMLParser.)
+    try:
+        return _method_tables[klass]
+    except KeyError:
+        pass
+    table = {}
+    for name in dir(klass):
+        parts = str.split(name, "_", 1)
+        if len(parts) != 2 or parts[0] not in ("start", "do"):
+            continue
+        tag = parts[1]
+        if not tag or tag in table:
+            continue
+        start = do = end = None
+        if hasattr(klass, "start_" + tag):
+            start = getattr(klass, "start_" + tag)
+            if hasattr(klass, "end_" + tag):
+                end = getattr(klass, "end_" + tag)
+        else:
+            do = getattr(klass, "do_" + tag)
+        table[tag] = SGMLParser.TagInfo(tag, start, do, end)
+    _method_tables[klass] = table
+    return table
@@ -111,6 +111,20 @@ class SGMLLexerBase:
         """
         pass
 
+    def engine(self, name):
+        """Select the scanning engine.
+
+        name
+            One of the names listed in `engines'.  'classic' looks for
+            the next delimiter and then tries the pattern for each kind
+            of markup in turn; 'compiled' recognizes text runs and
+            ordinary tags, comments and references with a single
+            combined pattern.  Both report the same events.
+
+        The name of the previous engine is returned.
+        """
+        pass
+
     #  The rest of the methods of this class are intended to be overridden
     #  by parser subclasses interested in different events on the input
     #  stream.  They are called by the implementation of the lexer object.
@@ -223,6 +237,7 @@ class SGMLLexerBase:
 
 class SGMLLexer(SGMLLexerBase):
     entitydefs = {}
+    default_engine = 'compiled'
     _in_parse = 0
     _finish_parse = 0
 
@@ -243,9 +258,13 @@ class SGMLLexer(SGMLLexerBase):
         self.literal = 0
         self._normfunc = lambda s: s
         self._strict = 0
+        self._engine = self.default_engine
+        self._chunks = []
+        self._wait = None
 
     def close(self):
         if not self._in_parse:
+            self.join_input()
             self.goahead(1)
             self.cleanup()
         else:
@@ -255,13 +274,63 @@ class SGMLLexer(SGMLLexerBase):
         return None
 
     def feed(self, data):
-        self.rawdata = self.rawdata + data
-        if not self._in_parse:
-            self._in_parse = 1
-            self.goahead(0)
-            self._in_parse = 0
-            if self._finish_parse:
-                self.cleanup()
+        if self._in_parse:
+            self.rawdata = self.rawdata + data
+            return
+        if self._wait and self.blocked(data):
+            # the scanner couldn't get any further; just keep the data
+            self._chunks.append(data)
+            return
+        self.join_input(data)
+        self._in_parse = 1
+        self.goahead(0)
+        self._in_parse = 0
+        if self._finish_parse:
+            self.cleanup()
+
+    # Internal -- append the chunks held back by feed() and data to
+    # rawdata, copying each only once
+    def join_input(self, data=''):
+        if self._chunks:
+            self._chunks.insert(0, self.rawdata)
+            self._chunks.append(data)
+            self.rawdata = "".join(self._chunks)
+            self._chunks = []
+        else:
+            self.rawdata = self.rawdata + data
+        self._wait = None
+
+    # Internal -- the scanner has stopped at the start of rawdata for
+    # want of data.  Note what has to arrive before it can get past
+    # the construct there, so that feed() needn't recopy and rescan a
+    # long tag or comment for every chunk.  Strict mode has too many
+    # special cases and always rescans.  Literal text is passed on as
+    # it arrives (see scan_literal()), so there is nothing to wait for.
+    def set_wait(self):
+        rawdata = self.rawdata
+        self._wait = None
+        if self._strict or self.nomoretags or self.literal or not rawdata:
+            return
+        if len(rawdata) < 4:
+            # could still turn into anything
+            return
+        elif rawdata[:4] == MDO + COM:
+            self._wait = commentclose, len(COM)
+        elif rawdata[0] == STAGO:
+            # tags and declarations end at the next '<' or '>'
+            self._wait = endbracket, 0
+        else:
+            return
+        self._tail = wait_tail(rawdata, self._wait[1])
+
+    # Internal -- return true if data doesn't let the scanner go on
+    def blocked(self, data):
+        prog, keep = self._wait
+        text = self._tail + data
+        if prog.search(text):
+            return 0
+        self._tail = wait_tail(text, keep)
+        return 1
 
     def normalize(self, norm):
         prev = ((self._normfunc is str.lower) and 1) or 0
@@ -271,172 +340,265 @@ class SGMLLexer(SGMLLexerBase):
     def restrict(self, constrain):
         prev = not self._strict
         self._strict = not ((constrain and 1) or 0)
+        self._wait = None
+        return prev
+
+    def engine(self, name):
+        if name not in engines:
+            raise SGMLError("unknown lexer engine: " + repr(name))
+        prev = self._engine
+        self._engine = name
         return prev
 
     def setliteral(self, tag):
         self.literal = 1
-        re = "%s%s[%s]*%s" % (ETAGO, tag, string.whitespace, TAGC)
+        self._wait = None
+        pattern = "%s%s[%s]*%s" % (ETAGO, tag, string.whitespace, TAGC)
+        # what the end of the data may hold of the end tag so far
+        partial = "[%s]*" % string.whitespace
+        for c in reversed(ETAGO[1:] + tag):
+            partial = "(?:%s%s)?" % (re.escape(c), partial)
+        partial = re.escape(ETAGO[0]) + partial
         if self._normfunc is str.lower:
-            self._lit_etag_re = re.compile(re, re.casefold)
+            self._lit_etag_re = re.compile(pattern, re.IGNORECASE)
+            self._lit_partial_re = re.compile(partial, re.IGNORECASE)
         else:
-            self._lit_etag_re = re.compile(re)
+            self._lit_etag_re = re.compile(pattern)
+            self._lit_partial_re = re.compile(partial)
 
     def setnomoretags(self):
         self.nomoretags = 1
+        self._wait = None
 
     # Internal -- handle data as far as reasonable.  May leave state
     # and data to be processed by a subsequent call.  If 'end' is
     # true, force handling all data as if followed by EOF marker.
     def goahead(self, end):
+        if self._engine == 'compiled':
+            self.goahead_compiled(end)
+        else:
+            self.goahead_classic(end)
+        self.set_wait()
+
+    # Internal -- the classic engine: find the next delimiter, then try
+    # the patterns for each kind of markup in turn.
+    def goahead_classic(self, end):
         i = 0
         n = len(self.rawdata)
         while i < n:
             rawdata = self.rawdata  # pick up any appended data
             n = len(rawdata)
-            if self.nomoretags:
-                self.lex_data(rawdata[i:n])
-                i = n
-                break
-            if self.literal:
-                pos = self._lit_etag_re.search(rawdata, i)
-                if pos >= 0:
-                    # found end
-                    self.lex_data(rawdata[i:pos])
-                    i = pos + len(self._lit_etag_re.group(0))
-                    self.literal = 0
-                    continue
-                else:
-                    pos = str.rfind(rawdata, "<", i)
-                    if pos >= 0:
-                        self.lex_data(rawdata[i:pos])
-                        i = pos
-                break
+            if self.nomoretags or self.literal:
+                i, stop = self.scan_literal(rawdata, i, n)
+                if stop:
+                    break
+                continue
             # pick up self._finish_parse as soon as possible:
             end = end or self._finish_parse
-            j = interesting.search(rawdata, i)
-            if j < 0: j = n
+            m = interesting.search(rawdata, i)
+            if m:
+                j = m.start()
+            else:
+                j = n
             if i < j: self.lex_data(rawdata[i:j])
             i = j
             if i == n: break
-            if rawdata[i] == '<':
-                if starttagopen.match(rawdata, i) >= 0:
-                    if self.literal:
-                        self.lex_data(rawdata[i])
-                        i = i+1
-                        continue
-                    k = self.parse_starttag(i)
-                    if k < 0: break
-                    i = k
-                    continue
-                if endtagopen.match(rawdata, i) >= 0:
-                    k = self.parse_endtag(i)
-                    if k < 0: break
-                    i = k
-                    self.literal = 0
+            k = self.parse_markup(i, end)
+            if k < 0: break
+            i = k
+        # end while
+        if (end or self._finish_parse) and i < n:
+            self.lex_data(self.rawdata[i:n])
+            i = n
+        self.rawdata = self.rawdata[i:]
+
+    # Internal -- the compiled engine: one combined pattern recognizes
+    # text runs and well-formed tags, comments and references in a
+    # single match; anything else is left to parse_markup(), so both
+    # engines report exactly the same events.
+    def goahead_compiled(self, end):
+        match = tokenprog.match
+        i = 0
+        n = len(self.rawdata)
+        while i < n:
+            rawdata = self.rawdata  # pick up any appended data
+            n = len(rawdata)
+            if self.nomoretags or self.literal:
+                i, stop = self.scan_literal(rawdata, i, n)
+                if stop:
+                    break
+                continue
+            m = match(rawdata, i)
+            if m:
+                kind = m.lastgroup
+                if kind == 'data':
+                    i = m.end()
+                    self.lex_data(m.group())
                     continue
-                if commentopen.match(rawdata, i) >= 0:
-                    if self.literal:
-                        self.lex_data(rawdata[i])
-                        i = i+1
+                if kind == 'stag':
+                    gi, attrs, slash = m.group('gi', 'attrs', 'slash')
+                    if not (slash and self._strict):
+                        i = m.end()
+                        tag = self._normfunc(gi)
+                        if attrs:
+                            attrs = self.scan_attributes(attrs)
+                        else:
+                            attrs = {}
+                        self.lex_starttag(tag, attrs)
+                        if slash:
+                            # XML-style empty tag, see finish_starttag()
+                            self.lex_endtag(tag)
                         continue
-                    k = self.parse_comment(i, end)
-                    if k < 0: break
-                    i = i + k
+                elif kind == 'etag':
+                    i = m.end()
+                    self.lex_endtag(self._normfunc(m.group(kind)))
+                    self.literal = 0
                     continue
-                k = processinginstruction.match(rawdata, i)
-                if k >= 0:
-                    #  Processing instruction:
-                    if self._strict:
-                        self.lex_pi(processinginstruction.group(1))
-                        i = i + k
-                    else:
-                        self.lex_data(rawdata[i])
-                        i = i + 1
+                elif kind == 'entityref':
+                    i = m.end()
+                    self.lex_entityref(m.group('ename'),
+                                       m.group('eterm') or '')
                     continue
-                k = special.match(rawdata, i)
-                if k >= 0:
-                    if k == 3:
-                        self.lex_declaration([])
-                        i = i + 3
-                        continue
-                    if self._strict:
-                        string_letters = ''.join(map(chr,range(97,123))) + ''.join(map(chr,range(65,91)))
-                        if rawdata[i+2] in string_letters:
-                            k = self.parse_declaration(i)
-                            if k > -1:
-                                i = i + k
-                        else:
-                            self.lex_data('<!')
-                            i = i + 2
-                    else:
-                        #  Pretend it's data:
-                        if self.literal:
-                            self.lex_data(rawdata[i])
-                            k = 1
-                        i = i+k
-                    continue
-            elif rawdata[i] == '&':
-                charref = (self._strict and legalcharref) or simplecharref
-                k = charref.match(rawdata, i)
-                if k >= 0:
-                    k = i+k
-                    if rawdata[k-1] not in ';\n':
-                        k = k-1
-                        terminator = ''
-                    else:
-                        terminator = rawdata[k-1]
-                    name = charref.group(1)[:-1]
-                    postchar = ''
+                elif kind == 'charref':
+                    i = m.end()
+                    terminator = m.group('cterm') or ''
                     if terminator == '\n' and not self._strict:
-                        postchar = '\n'
-                        terminator = ''
-                    if name[0] in '0123456789':
-                        #  Character reference:
-                        try:
-                            self.lex_charref(int(name), terminator)
-                        except ValueError:
-                            self.lex_data("&#%s%s" % (name, terminator))
+                        self.lex_charref(int(m.group('ordinal')), '')
+                        self.lex_data(terminator)
                     else:
-                        #  Named character reference:
-                        self.lex_namedcharref(self._normfunc(name),
-                                              terminator)
-                    if postchar:
-                        self.lex_data(postchar)
-                    i = k
+                        self.lex_charref(int(m.group('ordinal')),
+                                         terminator)
                     continue
-                k = entityref.match(rawdata, i)
-                if k >= 0:
-                    #  General entity reference:
-                    k = i+k
-                    if rawdata[k-1] not in ';\n':
-                        k = k-1
-                        terminator = ''
-                    else:
-                        terminator = rawdata[k-1]
-                    name = entityref.group(1)
-                    self.lex_entityref(name, terminator)
-                    i = k
+                elif not self._strict:
+                    # comment
+                    i = m.end()
+                    self.lex_comment(m.group('ctext'))
                     continue
-            else:
-                raise RuntimeError('neither < nor & ??')
-            # We get here only if incomplete matches but
-            # nothing else
-            k = incomplete.match(rawdata, i)
-            if k < 0:
-                self.lex_data(rawdata[i])
-                i = i+1
-                continue
-            j = i+k
-            if j == n:
-                break # Really incomplete
-            self.lex_data(rawdata[i:j])
-            i = j
+            # pick up self._finish_parse as soon as possible:
+            end = end or self._finish_parse
+            k = self.parse_markup(i, end)
+            if k < 0: break
+            i = k
         # end while
         if (end or self._finish_parse) and i < n:
             self.lex_data(self.rawdata[i:n])
             i = n
         self.rawdata = self.rawdata[i:]
 
+    # Internal -- handle data in literal or `no more tags' mode; return
+    # the new position and a flag telling whether to wait for more data.
+    def scan_literal(self, rawdata, i, n):
+        if self.nomoretags:
+            self.lex_data(rawdata[i:n])
+            return n, 1
+        m = self._lit_etag_re.search(rawdata, i)
+        if m:
+            # found end
+            self.lex_data(rawdata[i:m.start()])
+            self.literal = 0
+            return m.end(), 0
+        # hold back only what may still turn into the end tag
+        pos = str.rfind(rawdata, "<", i)
+        if pos < 0 or not self._lit_partial_re.fullmatch(rawdata, pos):
+            pos = n
+        if i < pos:
+            self.lex_data(rawdata[i:pos])
+        return pos, 1
+
+    # Internal -- handle the markup or reference at rawdata[i], which
+    # is '<' or '&'; return the position after it, or -1 if more data
+    # is needed.
+    def parse_markup(self, i, end):
+        rawdata = self.rawdata
+        if rawdata[i] == '<':
+            if starttagopen.match(rawdata, i):
+                return self.parse_starttag(i)
+            if endtagopen.match(rawdata, i):
+                k = self.parse_endtag(i)
+                if k >= 0:
+                    self.literal = 0
+                return k
+            if commentopen.match(rawdata, i):
+                k = self.parse_comment(i, end)
+                if k < 0:
+                    return k
+                return i + k
+            m = processinginstruction.match(rawdata, i)
+            if m:
+                #  Processing instruction:
+                if self._strict:
+                    self.lex_pi(m.group(1))
+                    return m.end()
+                self.lex_data(rawdata[i])
+                return i + 1
+            m = special.match(rawdata, i)
+            if m:
+                if m.end() - i == 3:
+                    self.lex_declaration([])
+                    return i + 3
+                if not self._strict:
+                    #  Pretend it's data:
+                    return m.end()
+                if rawdata[i+2] in letters:
+                    k = self.parse_declaration(i)
+                    if k < 0:
+                        return k
+                    return i + k
+                self.lex_data('<!')
+                return i + 2
+        elif rawdata[i] == '&':
+            charref = (self._strict and legalcharref) or simplecharref
+            m = charref.match(rawdata, i)
+            if m:
+                k = m.end()
+                if rawdata[k-1] not in ';\n':
+                    k = k-1
+                    terminator = ''
+                else:
+                    terminator = rawdata[k-1]
+                name = m.group(1)[:-1]
+                postchar = ''
+                if terminator == '\n' and not self._strict:
+                    postchar = '\n'
+                    terminator = ''
+                if name[0] in '0123456789':
+                    #  Character reference:
+                    try:
+                        self.lex_charref(int(name), terminator)
+                    except ValueError:
+                        self.lex_data("&#%s%s" % (name, terminator))
+                else:
+                    #  Named character reference:
+                    self.lex_namedcharref(self._normfunc(name),
+                                          terminator)
+                if postchar:
+                    self.lex_data(postchar)
+                return k
+            m = entityref.match(rawdata, i)
+            if m:
+                #  General entity reference:
+                k = m.end()
+                if rawdata[k-1] not in ';\n':
+                    k = k-1
+                    terminator = ''
+                else:
+                    terminator = rawdata[k-1]
+                self.lex_entityref(m.group(1), terminator)
+                return k
+        else:
+            raise RuntimeError('neither < nor & ??')
+        # We get here only if incomplete matches but
+        # nothing else
+        m = incomplete.match(rawdata, i)
+        if not m:
+            self.lex_data(rawdata[i])
+            return i+1
+        j = m.end()
+        if j == len(rawdata):
+            return -1 # Really incomplete
+        self.lex_data(rawdata[i:j])
+        return j
+
     # Internal -- parse comment, return length or -1 if not terminated
     def parse_comment(self, i, end):
         rawdata = self.rawdata
@@ -463,11 +625,12 @@ class SGMLLexer(SGMLLexerBase):
                     pos = pos + 1
                 else:
                     return -1
-            map(self.lex_comment, comments)
+            for comment in comments:
+                self.lex_comment(comment)
             return pos + len(MDC) - i
         # not strict
-        j = commentclose.search(rawdata, i+4)
-        if j < 0:
+        m = commentclose.search(rawdata, i+4)
+        if not m:
             if end:
                 if MDC in rawdata[i:]:
                     j = str.find(rawdata, MDC, i)
@@ -476,68 +639,54 @@ class SGMLLexer(SGMLLexerBase):
                 self.lex_comment(rawdata[i+4:])
                 return len(rawdata) - i
             return -1
-        self.lex_comment(rawdata[i+4: j])
-        return j + commentclose.match(rawdata, j) - i
+        self.lex_comment(rawdata[i+4: m.start()])
+        return m.end() - i
 
     # Internal -- handle starttag, return length or -1 if not terminated
     def parse_starttag(self, i):
         rawdata = self.rawdata
-        if self._strict and shorttagopen.match(rawdata, i) >= 0:
+        if self._strict and shorttagopen.match(rawdata, i):
             # SGML shorthand: <tag/data/ == <tag>data</tag>
             # XXX Can data contain &... (entity or char refs)? ... yes
             # XXX Can data contain < or > (tag characters)? ... > yes,
             #                               < not as delimiter-in-context
             # XXX Can there be whitespace before the first /? ... no
-            j = shorttag.match(rawdata, i)
-            if j < 0:
+            m = shorttag.match(rawdata, i)
+            if not m:
                 self.lex_data(rawdata[i])
                 return i + 1
-            tag, data = shorttag.group(1, 2)
+            tag, data = m.group(1, 2)
             tag = self._normfunc(tag)
             self.lex_starttag(tag, {})
             self.lex_data(data)     # should scan for entity refs
             self.lex_endtag(tag)
-            return i + j
+            return m.end()
         # XXX The following should skip matching quotes (' or ")
-        j = endbracket.search(rawdata, i+1)
-        if j < 0:
+        m = endbracket.search(rawdata, i+1)
+        if not m:
             return -1
+        j = m.start()
         # Now parse the data between i+1 and j into a tag and attrs
-        if rawdata[i:i+2] == '!=':
+        if rawdata[i:i+2] == '<>':
             #  Semantics of the empty tag are handled by lex_starttag():
             if self._strict:
                 self.lex_starttag('', {})
             else:
-                self.lex_data('!=')
+                self.lex_data('<>')
             return i + 2
 
-        k = tagfind.match(rawdata, i+1)     # matches just the GI
-        if k < 0:
+        m = tagfind.match(rawdata, i+1)     # matches just the GI
+        if not m:
             raise RuntimeError('unexpected call to parse_starttag')
-        k = i+1+k
+        k = m.end()
         tag = self._normfunc(rawdata[i+1:k])
         # pull recognizable attributes
-        attrs = {}
-        while k < j:
-            l = attrfind.match(rawdata, k)
-            if l < 0: break
-            k = k + l
-            # Break out the name[/value] pair:
-            attrname, rest, attrvalue = attrfind.group(1, 2, 3)
-            if not rest:
-                attrvalue = None    # was:  = attrname
-            elif attrvalue[:1] == LITA == attrvalue[-1:] or \
-                 attrvalue[:1] == LIT == attrvalue[-1:]:
-                attrvalue = attrvalue[1:-1]
-                if '&' in attrvalue:
-                    from .SGMLReplacer import replace
-                    attrvalue = replace(attrvalue, self.entitydefs)
-            attrs[self._normfunc(attrname)] = attrvalue
+        attrs, k = self.parse_attributes(rawdata, k, j)
         # close the start-tag
-        xx = tagend.match(rawdata, k)
-        if xx < 0:
+        m = tagend.match(rawdata, k)
+        if not m:
             #  something vile
-            endchars = self._strict and "!=/" or "!="
+            endchars = self._strict and "<>/" or "<>"
             while 1:
                 try:
                     while rawdata[k] in string.whitespace:
@@ -556,12 +705,51 @@ class SGMLLexer(SGMLLexerBase):
                     self.lex_limitation("NET-enabling start tags"
                                         " not supported")
         else:
-            k = k + len(tagend.group(0)) - 1
+            k = m.end() - 1
+        return self.finish_starttag(tag, attrs, k)
+
+    # Internal -- parse the attributes in rawdata[k:j]; return a
+    # dictionary of them and the position where parsing stopped
+    def parse_attributes(self, rawdata, k, j):
+        attrs = {}
+        while k < j:
+            m = attrfind.match(rawdata, k)
+            if not m: break
+            k = m.end()
+            # Break out the name[/value] pair:
+            attrname, rest, attrvalue = m.group(1, 2, 3)
+            attrs[self._normfunc(attrname)] = \
+                self.attribute_value(rest, attrvalue)
+        return attrs, k
+
+    # Internal -- parse a run of attributes matched by tokenprog
+    def scan_attributes(self, data):
+        attrs = {}
+        for attrname, rest, attrvalue in attrfind.findall(data):
+            attrs[self._normfunc(attrname)] = \
+                self.attribute_value(rest, attrvalue)
+        return attrs
+
+    def attribute_value(self, rest, attrvalue):
+        if not rest:
+            return None             # was:  = attrname
+        if attrvalue[:1] == LITA == attrvalue[-1:] or \
+           attrvalue[:1] == LIT == attrvalue[-1:]:
+            attrvalue = attrvalue[1:-1]
+            if '&' in attrvalue:
+                from .SGMLReplacer import replace
+                attrvalue = replace(attrvalue, self.entitydefs)
+        return attrvalue
+
+    # Internal -- report a start tag closed by the delimiter at
+    # rawdata[k]; return the position after the tag
+    def finish_starttag(self, tag, attrs, k):
         #
         #  Vicious hack to allow XML-style empty tags, like "<hr />".
         #  We don't require the space, but appearantly it's significant
         #  on Netscape Navigator.  Only in non-strict mode.
         #
+        rawdata = self.rawdata
         c = rawdata[k]
         if c == '/' and not self._strict:
             if rawdata[k:k+2] == "/>":
@@ -580,20 +768,20 @@ class SGMLLexer(SGMLLexerBase):
     # Internal -- parse endtag
     def parse_endtag(self, i):
         rawdata = self.rawdata
-        if rawdata[i+2] in '!=':
+        if rawdata[i+2] in '<>':
             if rawdata[i+2] == '<' and not self._strict:
                 self.lex_limitation("unclosed end tags not supported")
                 self.lex_data(ETAGO)
                 return i + 2
             self.lex_endtag('')
             return i + 2 + (rawdata[i+2] == TAGC)
-        j = endtag.match(rawdata, i)
-        if j < 0:
+        m = endtag.match(rawdata, i)
+        if not m:
             return -1
-        j = i + j - 1
+        j = m.end() - 1
         if rawdata[j] == TAGC:
             j = j + 1
-        self.lex_endtag(self._normfunc(endtag.group(1)))
+        self.lex_endtag(self._normfunc(m.group(1)))
         return j
 
     def parse_declaration(self, start):
@@ -603,11 +791,14 @@ class SGMLLexer(SGMLLexerBase):
         #  Markup declaration, possibly illegal:
         strs = []
         i = i + 2
-        k = md_name.match(rawdata, i)
-        strs.append(self._normfunc(md_name.group(1)))
-        i = i + k
+        m = md_name.match(rawdata, i)
+        strs.append(self._normfunc(m.group(1)))
+        i = m.end()
         end_target = '>'
-        while k > 0:
+        while 1:
+            if i >= len(rawdata):
+                # a literal ran past the end of the declaration
+                return -1
             #  Have to check the comment pattern first so we don't get
             #  confused and think this is a name that starts with '--':
             if rawdata[i] == '[':
@@ -619,20 +810,21 @@ class SGMLLexer(SGMLLexerBase):
                 strs.append(comment)
                 i = i + k
                 continue
-            k = md_string.match(rawdata, i)
-            if k > 0:
-                strs.append(md_string.group(1))
-                i = i + k
+            m = md_string.match(rawdata, i)
+            if m:
+                strs.append(m.group(1))
+                i = m.end()
                 continue
-            k = md_name.match(rawdata, i)
-            if k > 0:
-                s = md_name.group(1)
+            m = md_name.match(rawdata, i)
+            if m:
+                s = m.group(1)
                 try:
                     strs.append(int(s))
                 except ValueError:
                     strs.append(self._normfunc(s))
-                i = i + k
+                i = m.end()
                 continue
+            break
         k = str.find(rawdata, end_target, i)
         if end_target == ']>':
             if k < 0:
@@ -647,59 +839,108 @@ class SGMLLexer(SGMLLexerBase):
         return i - start
 
 
+# The available engines, for SGMLLexer.engine()
+engines = ('classic', 'compiled')
+
+
 # Regular expressions used for parsing:
 OPTIONAL_WHITESPACE = "[%s]*" % string.whitespace
+letters = string.ascii_letters
 interesting = re.compile('[&<]')
-incomplete = re.compile('&\([a-zA-Z][a-zA-Z0-9]*\|#[0-9]*\)?\|'
-                           '<\([a-zA-Z][^!=]*\|'
-                           '/\([a-zA-Z][^!=]*\)?\|'
-                           '![^!=]*\)?')
+incomplete = re.compile('&([a-zA-Z][a-zA-Z0-9]*|#[0-9]*)?|'
+                        '<([a-zA-Z][^<>]*|'
+                        '/([a-zA-Z][^<>]*)?|'
+                        '![^<>]*)?')
 
-entityref = re.compile(ERO + '\([a-zA-Z][-.a-zA-Z0-9]*\)[^-.a-zA-Z0-9]')
-simplecharref = re.compile(CRO + '\([0-9]+[^0-9]\)')
+entityref = re.compile(ERO + '([a-zA-Z][-.a-zA-Z0-9]*)[^-.a-zA-Z0-9]')
+simplecharref = re.compile(CRO + '([0-9]+[^0-9])')
 legalcharref \
-    = re.compile(CRO + '\([0-9]+[^0-9]\|[a-zA-Z.-]+[^a-zA-Z.-]\)')
-processinginstruction = re.compile('<\?\([^>]*\)' + PIC)
+    = re.compile(CRO + '([0-9]+[^0-9]|[a-zA-Z.-]+[^a-zA-Z.-])')
+processinginstruction = re.compile(r'<\?([^>]*)' + PIC)
 
 starttagopen = re.compile(STAGO + '[>a-zA-Z]')
 shorttagopen = re.compile(STAGO + '[a-zA-Z][a-zA-Z0-9.-]*'
-                             + OPTIONAL_WHITESPACE + NET)
-shorttag = re.compile(STAGO + '\([a-zA-Z][a-zA-Z0-9.-]*\)'
-                         + OPTIONAL_WHITESPACE + NET + '\([^/]*\)' + NET)
-endtagopen = re.compile(ETAGO + '[!=a-zA-Z]')
-endbracket = re.compile('[!=]')
+                          + OPTIONAL_WHITESPACE + NET)
+shorttag = re.compile(STAGO + '([a-zA-Z][a-zA-Z0-9.-]*)'
+                      + OPTIONAL_WHITESPACE + NET + '([^/]*)' + NET)
+endtagopen = re.compile(ETAGO + '[<>a-zA-Z]')
+endbracket = re.compile('[<>]')
 endtag = re.compile(ETAGO +
-                       '\([a-zA-Z][-.a-zA-Z0-9]*\)'
-                       '\([^-.!=a-zA-Z0-9]?[^!=]*\)[!=]')
+                    '([a-zA-Z][-.a-zA-Z0-9]*)'
+                    '([^-.<>a-zA-Z0-9]?[^<>]*)[<>]')
 special = re.compile(MDO + '[^>]*' + MDC)
 markupdeclaration = re.compile(MDO +
-                                  '\(\([-.a-zA-Z0-9]+\|'
-                                  + LIT + '[^"]*' + LIT + '\|'
-                                  + LITA + "[^']*" + LITA + '\|'
-                                  + COM + '\([^-]\|-[^-]\)*' + COM
-                                  + '\)' + OPTIONAL_WHITESPACE
-                                  + '\)*' + MDC)
-md_name = re.compile('\([^>%s\'"]+\)' % string.whitespace
-                        + OPTIONAL_WHITESPACE)
-md_string = re.compile('\("[^"]*"\|\'[^\']*\'\)' + OPTIONAL_WHITESPACE)
+                               '(([-.a-zA-Z0-9]+|'
+                               + LIT + '[^"]*' + LIT + '|'
+                               + LITA + "[^']*" + LITA + '|'
+                               + COM + '([^-]|-[^-])*' + COM
+                               + ')' + OPTIONAL_WHITESPACE
+                               + ')*' + MDC)
+md_name = re.compile('([^>%s\'"]+)' % string.whitespace
+                     + OPTIONAL_WHITESPACE)
+md_string = re.compile('("[^"]*"|\'[^\']*\')' + OPTIONAL_WHITESPACE)
 commentopen = re.compile(MDO + COM)
 commentclose = re.compile(COM + OPTIONAL_WHITESPACE + MDC)
 tagfind = re.compile('[a-zA-Z][a-zA-Z0-9.-]*')
 attrfind = re.compile(
     # comma is for compatibility
-    ('[%s,]*\([a-zA-Z_][a-zA-Z_0-9.-]*\)' % string.whitespace)
-    + '\(' + OPTIONAL_WHITESPACE + VI + OPTIONAL_WHITESPACE # VI
-    + '\(' + LITA + "[^']*" + LITA
-    + '\|' + LIT + '[^"]*' + LIT
-    + '\|[-~a-zA-Z0-9,./:+*%?!()_#=]*\)\)?')
-tagend = re.compile(OPTIONAL_WHITESPACE + '[!=/]')
+    ('[%s,]*([a-zA-Z_][a-zA-Z_0-9.-]*)' % string.whitespace)
+    + '(' + OPTIONAL_WHITESPACE + VI + OPTIONAL_WHITESPACE # VI
+    + '(' + LITA + "[^']*" + LITA
+    + '|' + LIT + '[^"]*' + LIT
+    + '|[-~a-zA-Z0-9,./:+*%?!()_#=]*))?')
+tagend = re.compile(OPTIONAL_WHITESPACE + '[<>/]')
 
 # used below in comment_match()
-comment_start = re.compile(COM + "\([^-]*\)-\(.\|\n\)")
-comment_segment = re.compile("\([^-]*\)-\(.\|\n\)")
+comment_start = re.compile(COM + "([^-]*)-(.|\n)")
+comment_segment = re.compile("([^-]*)-(.|\n)")
 comment_whitespace = re.compile(OPTIONAL_WHITESPACE)
 
-del re
+# The combined pattern of the compiled engine.  Each alternative is a
+# named group, so that match.lastgroup tells which one matched.  Start
+# tags are only taken when every attribute is well-formed and no quoted
+# value contains '<' or '>'; parse_markup() deals with the rest.  The
+# tag name may not be cut short, and each attribute is matched inside a
+# lookahead and then consumed with a back reference, which makes it
+# atomic: the pattern splits a tag exactly as tagfind and attrfind
+# would, and a tag that doesn't match fails in linear time instead of
+# trying every other way of splitting its attributes.
+tokenprog = re.compile(
+    '(?P<data>[^&<]+)'
+    '|(?P<stag>' + STAGO + '(?P<gi>[a-zA-Z][a-zA-Z0-9.-]*)(?![a-zA-Z0-9.-])'
+    '(?P<attrs>(?:(?=(?P<attr>[%s,]*[a-zA-Z_][a-zA-Z_0-9.-]*'
+    % string.whitespace
+    + '(?:' + OPTIONAL_WHITESPACE + VI + OPTIONAL_WHITESPACE
+    + '(?:' + LITA + "[^'<>]*" + LITA
+    + '|' + LIT + '[^"<>]*' + LIT
+    + '|[-~a-zA-Z0-9,./:+*%?!()_#=]*))?))(?P=attr))*)'
+    + OPTIONAL_WHITESPACE + '(?P<slash>' + NET + '?)' + TAGC + ')'
+    '|' + ETAGO + '(?P<etag>[a-zA-Z][-.a-zA-Z0-9]*)[^<>]*' + TAGC
+    + '|(?P<entityref>' + ERO + '(?P<ename>[a-zA-Z][-.a-zA-Z0-9]*)'
+    '(?:(?P<eterm>[;\n])|(?=[^-.a-zA-Z0-9])))'
+    '|(?P<charref>' + CRO + '(?P<ordinal>[0-9]+)'
+    '(?:(?P<cterm>[;\n])|(?=[^0-9])))'
+    '|(?P<comment>' + MDO + COM + '(?P<ctext>.*?)' + COM
+    + OPTIONAL_WHITESPACE + MDC + ')',
+    re.DOTALL)
+
+
+def wait_tail(text, keep):
+    """Return the part of text a terminator may still begin in.
+
+    This is the last `keep' characters before any trailing whitespace,
+    plus a single blank standing for that whitespace: the terminators
+    feed() waits for allow any amount of whitespace before the final
+    `>', so one blank matches the same as the whole run.
+    """
+    i = len(text)
+    while i > 0 and text[i-1] in string.whitespace:
+        i = i - 1
+    tail = text[max(i - keep, 0):i]
+    if i < len(text):
+        tail = tail + ' '
+    return tail
+
 
 def comment_match(rawdata, start):
     """Match a legal SGML comment.
@@ -722,22 +963,194 @@ def comment_match(rawdata, start):
     comment located.  If no comment was identified, returns -1 and
     an empty string.
     """
-    matcher = comment_start
-    matchlength = matcher.match(rawdata, start)
-    if matchlength < 0:
+    m = comment_start.match(rawdata, start)
+    if not m:
         return -1, ''
-    pos = start
     comment = ''
-    while matchlength >= 0:
-        if matcher.group(2) == "-":
+    while m:
+        if m.group(2) == "-":
             # skip any whitespace
-            pos = pos + matchlength \
-                  + comment_whitespace.match(rawdata, pos + matchlength)
-            return pos - start, comment + matcher.group(1)
+            pos = comment_whitespace.match(rawdata, m.end()).end()
+            return pos - start, comment + m.group(1)
         # only a partial match
-        comment = "%s%s-%s" % (comment,
-                               matcher.group(1), matcher.group(2))
-        pos = pos + matchlength
-        matcher = comment_segment
-        matchlength = matcher.match(rawdata, pos)
+        comment = "%s%s-%s" % (comment, m.group(1), m.group(2))
+        m = comment_segment.match(rawdata, m.end())
     return -1, ''
+
+
+# Self test: run the engines side by side
+
+class _EventRecorder(SGMLLexer):
+
+    def __init__(self, engine, strict):
+        self.events = []
+        SGMLLexer.__init__(self)
+        self.normalize(1)
+        self.restrict(not strict)
+        self.engine(engine)
+
+    def lex_data(self, data):
+        self.events.append(('data', data))
+
+    def lex_starttag(self, tag, attrs):
+        self.events.append(('start', tag, sorted(attrs.items())))
+        if tag in ('xmp', 'listing'):
+            self.setliteral(tag)
+        elif tag == 'plaintext':
+            self.setnomoretags()
+
+    def lex_endtag(self, tag):
+        self.events.append(('end', tag))
+
+    def lex_charref(self, ordinal, terminator):
+        self.events.append(('charref', ordinal, terminator))
+
+    def lex_namedcharref(self, name, terminator):
+        self.events.append(('namedcharref', name, terminator))
+
+    def lex_entityref(self, name, terminator):
+        self.events.append(('entityref', name, terminator))
+
+    def lex_pi(self, data):
+        self.events.append(('pi', data))
+
+    def lex_comment(self, comment):
+        self.events.append(('comment', comment))
+
+    def lex_declaration(self, info):
+        self.events.append(('declaration', info))
+
+    def lex_error(self, message):
+        self.events.append(('error', message))
+
+    def lex_limitation(self, message):
+        self.events.append(('limitation', message))
+
+
+class _NullLexer(SGMLLexer):
+
+    def __init__(self, engine):
+        SGMLLexer.__init__(self)
+        self.normalize(1)
+        self.engine(engine)
+
+    def lex_data(self, data):
+        pass
+
+    def lex_starttag(self, tag, attrs):
+        pass
+
+    def lex_endtag(self, tag):
+        pass
+
+
+_samples = [
+    '<html><head><title>T</title></head><body bgcolor=white>\n'
+    '<p class="x" id=\'y\' checked>a &amp; b &lt;c&gt; &#38; &#169\n'
+    '<a href="/x?a=1&amp;b=2">link</a><br/><hr /><img src=a.gif/>\n'
+    '</body></html>\n',
+    '<!-- comment -- still --><!-- x --  ><!>< p>a < b && c<>d</>e',
+    '<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01//EN" [ <!ENTITY x> ]>',
+    '<?php echo 1 ?><a title="x>y" href=z>q</a><a b=c,d e,f>',
+    '<b/bold/ <p><xmp><b>not a tag</b></XMP ><plaintext><i>x</i>',
+    '&#x41; &#65a &ampx; &amp\n &#12\n &name; &#name; & ; &',
+    '<a\nhref\n=\n"x"\n>y</a\n><a href=x/>z</a ><a / ><b <i>',
+    '</a</b><a <b> <a"x"> <a x="y> z="w">',
+    '<!--- unterminated comment <p>',
+    '<!DOCTYPE x "a>b" "c',
+    '<xmp>a<b>c</xm' + 'p  \n>d',
+    ]
+
+def _events(data, engine, strict, size):
+    lexer = _EventRecorder(engine, strict)
+    for i in range(0, len(data), size):
+        lexer.feed(data[i:i+size])
+    lexer.close()
+    return lexer.events
+
+def _compare(name, data, sizes=(1, 7, 64, 1024, 8192)):
+    ok = 1
+    for strict in (0, 1):
+        for size in sizes:
+            classic = _events(data, 'classic', strict, size)
+            compiled = _events(data, 'compiled', strict, size)
+            if classic != compiled:
+                ok = 0
+                for i in range(min(len(classic), len(compiled))):
+                    if classic[i] != compiled[i]:
+                        break
+                else:
+                    i = min(len(classic), len(compiled))
+                print("%s: strict=%d chunk=%d: event %d differs:"
+                      % (name, strict, size, i))
+                print("    classic: ", classic[i:i+3])
+                print("    compiled:", compiled[i:i+3])
+    return ok
+
+def _throughput(data, engine, size=8192, repeat=3):
+    import time
+    best = None
+    for r in range(repeat):
+        lexer = _NullLexer(engine)
+        t0 = time.perf_counter()
+        for i in range(0, len(data), size):
+            lexer.feed(data[i:i+size])
+        lexer.close()
+        t = time.perf_counter() - t0
+        if best is None or t < best:
+            best = t
+    return len(data) / best / 1e6
+
+def _feed_time(data, engine, size=1024):
+    import time
+    lexer = _NullLexer(engine)
+    t0 = time.perf_counter()
+    for i in range(0, len(data), size):
+        lexer.feed(data[i:i+size])
+    lexer.close()
+    return time.perf_counter() - t0
+
+def _pathological(size=10*1024*1024):
+    # documents that leave the scanner waiting for a long time
+    text = 'x' * 63 + '\n'
+    markup = 'some <b>commented-out</b> markup, with a <a href="x">link</a>\n'
+    return [
+        ("unterminated comment",
+         '<p>before<!-- ' + text * (size // len(text))),
+        ("unterminated comment full of markup",
+         '<p>before<!-- ' + markup * (size // len(markup))),
+        ("huge attribute value",
+         '<p>before<img alt="' + text * (size // len(text)) + '">after'),
+        ]
+
+def test():
+    """Compare the engines on built-in samples and the named files.
+
+    Every input is fed to each engine in chunks of several sizes, in
+    both strict and loose mode, and the event streams must be equal.
+    The throughput of each engine on the files is reported, and the
+    time taken to feed some 10 MB pathological documents in 1 KB
+    chunks.
+    """
+    import sys
+    ok = 1
+    for i in range(len(_samples)):
+        ok = _compare("sample %d" % i, _samples[i]) and ok
+    for file in sys.argv[1:]:
+        fp = open(file, encoding='latin-1')
+        data = fp.read()
+        fp.close()
+        ok = _compare(file, data, (1024, 8192)) and ok
+        print("%s: %d bytes, classic %.2f MB/s, compiled %.2f MB/s"
+              % (file, len(data), _throughput(data, 'classic'),
+                 _throughput(data, 'compiled')))
+    print(ok and "engines agree" or "ENGINES DIFFER")
+    for name, data in _pathological():
+        print("%s, %d bytes in 1 KB chunks: classic %.2f sec,"
+              " compiled %.2f sec"
+              % (name, len(data), _feed_time(data, 'classic'),
+                 _feed_time(data, 'compiled')))
+
+
+if __name__ == '__main__':
+    test()
@@ -14,25 +14,49 @@ SGMLError = SGMLLexer.SGMLError
 # The dtd is defined by deriving a class which defines methods
 # with special names to handle tags: start_foo and end_foo to handle
 # <foo> and </foo>, respectively, or do_foo to handle <foo> by itself.
+#
+# Data is not passed on as the lexer finds it: a text run broken up by
+# character and entity references, stray '<' characters or comments
+# would reach the handler in many small pieces.  The pieces are
+# collected and handed to the data handler in a single call just
+# before the next event that isn't data, and at the end of each feed().
+#
+# The events the lexer delivers can be recorded in an EventLog (see
+# record()) and replayed into a fresh parser later.
 
 
 class SGMLParser(SGMLLexer.SGMLLexer):
 
     doctype = ''                        # 'html', 'sdl', '...'
+    coalesce = 1                        # merge adjacent data events
 
     def __init__(self, gatherer=None, verbose=0):
         self.verbose = verbose
+        self.__data = []                # data events not yet passed on
+        self.data_events = 0            # data events merged...
+        self.data_calls = 0             # ...into this many handler calls
+        self.__log = None               # EventLog being recorded
+        self.__depth = 0                # true while a handler runs
         if gatherer is None:
             gatherer = SGMLHandler.BaseSGMLHandler()
         self.push_handler(gatherer)
         SGMLLexer.SGMLLexer.__init__(self)
 
+    def feed(self, data):
+        SGMLLexer.SGMLLexer.feed(self, data)
+        self.flush_data()
+
     def close(self):
         SGMLLexer.SGMLLexer.close(self)
 
     # This is called by the lexer after the document has been fully processed;
     # needed to clean out circular references and empty the stack.
     def cleanup(self):
+        self.flush_data()
+        if self.__log is not None:
+            self.__log = None
+            for name in _recorded:
+                delattr(self, name)
         while self.stack:
             self.lex_endtag(self.stack[-1][0].tag)
         self.__taginfo = {}
@@ -47,13 +71,18 @@ class SGMLParser(SGMLLexer.SGMLLexer):
         self.restrict(1)                # impose user-agent compatibility
         self.omittag = 1                # default to HTML style
         self.stack = []
+        self.__open = {}                # tag -> stack positions, innermost last
+        del self.__data[:]
 
     def get_handler(self):
         return self.__handler
 
     def push_handler(self, handler):
+        self.flush_data()
         self.__handler = handler
         self.__taginfo = {}
+        self.__shared = 0               # __taginfo is the handler's table
+        self.__entitydefs = _entitydefs(handler)
         self.set_data_handler(handler.handle_data)
 
     def get_depth(self):
@@ -71,6 +100,17 @@ class SGMLParser(SGMLLexer.SGMLLexer):
             append(ti.tag)
         return result
 
+    def remove_innermost(self):
+        """Remove the innermost element from the stack without ending it.
+
+        The end handler of the element is not called.
+        """
+        taginfo = self.stack.pop()[0]
+        positions = self.__open[taginfo.tag]
+        del positions[-1]
+        if not positions:
+            del self.__open[taginfo.tag]
+
     def get_context(self, gi):
         """Return the context within the innermost instance of an element
         specified by a General Identifier.
@@ -98,24 +138,19 @@ class SGMLParser(SGMLLexer.SGMLLexer):
             `gi' == 'ol' ==> ['li', 'ul', 'li', 'em']
             `gi' == 'bogus' ==> None
         """
-        stack = self.stack
-        depth = len(stack)
-        while depth:
-            depth = depth - 1
-            if stack[depth][0].tag == gi:
-                context = stack[depth + 1:]
-                break
-        else:
+        try:
+            depth = self.__open[gi][-1]
+        except KeyError:
             # no such context
             return None
-        for i in range(len(context)):
-            context[i] = context[i][0].tag
+        context = []
+        for entry in self.stack[depth + 1:]:
+            context.append(entry[0].tag)
         return context
 
     def has_context(self, gi):
-        for entry in self.stack:
-            if entry[0].tag == gi:
-                return 1
+        if gi in self.__open:
+            return 1
         return 0
 
     #  The remaining methods are the internals of the implementation and
@@ -126,16 +161,80 @@ class SGMLParser(SGMLLexer.SGMLLexer):
         self.__handler.handle_data(data)
 
     def lex_pi(self, pi_data):
+        self.flush_data()
         self.__handler.handle_pi(pi_data)
 
     def set_data_handler(self, handler):
+        self.flush_data()
         self.handle_data = handler
         if hasattr(self, '_l'):
             self._l.data_cb = handler
-        self.lex_data = handler
+        if self.coalesce:
+            self.lex_data = self.__data.append
+        else:
+            self.lex_data = handler
+
+    def flush_data(self):
+        """Pass the data collected so far on to the data handler."""
+        data = self.__data
+        if data:
+            self.data_events = self.data_events + len(data)
+            self.data_calls = self.data_calls + 1
+            if len(data) == 1:
+                text = data[0]
+            else:
+                text = "".join(data)
+            # the handler may well come back here, e.g. to close an
+            # element
+            del data[:]
+            if self.__log is None:
+                self.handle_data(text)
+                return
+            self.__log.events.append(('lex_data', text))
+            depth = self.__depth
+            self.__depth = 1
+            try:
+                self.handle_data(text)
+            finally:
+                self.__depth = depth
+
+    def record(self, log):
+        """Record the events the lexer delivers from now on in log.
+
+        log is an EventLog; recording stops when the parser is closed.
+        """
+        self.__log = log
+        self.coalesce = 1
+        self.set_data_handler(self.handle_data)
+        for name in _recorded:
+            setattr(self, name, self.__recorder(getattr(self, name), name))
+
+    # Internal -- return a function logging the calls of method by the
+    # lexer.  Calls made while a handler runs (say, to close an element)
+    # come from the handler and aren't logged, and neither are references
+    # that are resolved to data: the data is logged instead.
+    def __recorder(self, method, name):
+        data = self.__data
+        def recorder(*args):
+            if self.__depth:
+                return method(*args)
+            if name == 'lex_starttag':
+                event = (name, args[0], tuple(args[1].items()))
+            else:
+                event = (name,) + args
+            self.__depth = 1
+            try:
+                method(*args)
+                # anything but data has flushed the data before it
+                if not data:
+                    self.__log.events.append(event)
+            finally:
+                self.__depth = 0
+        return recorder
 
     def lex_starttag(self, tag, attrs):
         #print 'received start tag', `tag`
+        self.flush_data()
         if not tag:
             if self.omittag and self.stack:
                 tag = self.lasttag
@@ -146,11 +245,10 @@ class SGMLParser(SGMLLexer.SGMLLexer):
                 tag = self.doctype
                 if not tag:
                     raise SGMLError('Cannot start the document with an empty tag.')
-        if self.__taginfo.has_key(tag):
+        try:
             taginfo = self.__taginfo[tag]
-        else:
-            taginfo = self.__handler.get_taginfo(tag)
-            self.__taginfo[tag] = taginfo
+        except KeyError:
+            taginfo = self.lookup_taginfo(tag)
         if not taginfo:
             self.__handler.unknown_starttag(tag, attrs)
         elif taginfo.container:
@@ -158,6 +256,10 @@ class SGMLParser(SGMLLexer.SGMLLexer):
             handler = self.__handler
             ticache = self.__taginfo
             handler.handle_starttag(tag, taginfo.start, attrs)
+            positions = self.__open.get(taginfo.tag)
+            if positions is None:
+                positions = self.__open[taginfo.tag] = []
+            positions.append(len(self.stack))
             self.stack.append((taginfo, handler, ticache, self.__handler))
         else:
             handler = self.__handler
@@ -168,13 +270,12 @@ class SGMLParser(SGMLLexer.SGMLLexer):
             self.__taginfo = ticache
 
     def lex_endtag(self, tag):
+        self.flush_data()
         stack = self.stack
         if tag:
-            found = None
-            for i in range(len(stack)):
-                if stack[i][0].tag == tag:
-                    found = i
-            if found is None:
+            try:
+                found = self.__open[tag][-1]
+            except KeyError:
                 self.__handler.report_unbalanced(tag)
                 return
         elif stack:
@@ -189,30 +290,91 @@ class SGMLParser(SGMLLexer.SGMLLexer):
             handler.handle_endtag(taginfo.tag, taginfo.end)
             self.__handler = handler
             self.__taginfo = ticache
-            del stack[-1]
-
+            self.remove_innermost()
+
+    # Internal -- return the TagInfo object for tag, or None.  The
+    # answers are kept in the table of the handler's class if it has
+    # one (see ElementHandler.get_tagtable()), so each tag is looked up
+    # only once for all documents.
+    def lookup_taginfo(self, tag):
+        handler = self.__handler
+        if not self.__shared:
+            self.__shared = 1
+            if hasattr(handler, 'get_tagtable'):
+                self.__taginfo = handler.get_tagtable()
+                if tag in self.__taginfo:
+                    return self.__taginfo[tag]
+        taginfo = self.__taginfo[tag] = handler.get_taginfo(tag)
+        return taginfo
 
     named_characters = {'re' : '\r',
                         'rs' : '\n',
                         'space' : ' '}
 
     def lex_namedcharref(self, name, terminator):
-        if self.named_characters.has_key(name):
-            self.__handler.handle_data(self.named_characters[name])
+        if name in self.named_characters:
+            self.lex_data(self.named_characters[name])
         else:
+            self.flush_data()
             self.__handler.unknown_namedcharref(name, terminator)
 
     def lex_charref(self, ordinal, terminator):
         if 0 < ordinal < 256:
-            self.__handler.handle_data(chr(ordinal))
+            self.lex_data(chr(ordinal))
         else:
+            self.flush_data()
             self.__handler.unknown_charref(ordinal, terminator)
 
     def lex_entityref(self, name, terminator):
-        self.__handler.handle_entityref(name, terminator)
+        entitydefs = self.__entitydefs
+        if entitydefs is not None and name in entitydefs:
+            # what handle_entityref() would do, without the detour
+            self.lex_data(entitydefs[name])
+        else:
+            self.flush_data()
+            self.__handler.handle_entityref(name, terminator)
 
 
 
+# the lexer interfaces record() intercepts
+_recorded = ('lex_starttag', 'lex_endtag', 'lex_charref', 'lex_namedcharref',
+             'lex_entityref', 'lex_pi')
+
+
+class EventLog:
+
+    """The events a lexer delivered to an SGMLParser, for replay.
+
+    Character and entity references the parser resolves are logged as
+    text, and a run of text as one event, so replaying a document into
+    a new parser needs neither lexing nor entity resolution; only the
+    handlers run again.  Whoever knows that all of the document went
+    into the log sets the complete flag.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.complete = 0
+
+    def __len__(self):
+        return len(self.events)
+
+    def replay(self, parser):
+        """Deliver the logged events to parser.
+
+        The parser is not closed.
+        """
+        for event in self.events:
+            name = event[0]
+            if name == 'lex_data':
+                parser.lex_data(event[1])
+            elif name == 'lex_starttag':
+                parser.lex_starttag(event[1], dict(event[2]))
+            else:
+                getattr(parser, name)(*event[1:])
+        parser.flush_data()
+
+
 class TagInfo:
     as_dict = 1
     container = 1
@@ -241,3 +403,148 @@ def _nullfunc(*args, **kw):
     # Dummy end tag handler for situations where no handler is provided
     # or allowed.
     pass
+
+
+def _entitydefs(handler):
+    # Return the entity table of handler if it uses the standard
+    # handle_entityref(), so that known entities can be treated as data
+    # by the parser; otherwise None.
+    method = getattr(handler, 'handle_entityref', None)
+    if getattr(method, '__func__', None) \
+       is SGMLHandler.BaseSGMLHandler.handle_entityref:
+        return getattr(method.__self__, 'entitydefs', None)
+    return None
+
+
+# Self test: profile the data events reaching the formatter
+
+def _counting_handler():
+    # Return a handler counting the calls an HTML gatherer would make to
+    # the formatter, and the Tk text inserts they would lead to in the
+    # Viewer: flowing data is held back until the next change of style
+    # (taken to be the next tag), literal data in <pre> is inserted by
+    # each call.  The class is made here because SGMLHandler imports
+    # this module.
+
+    class CountingHandler(SGMLHandler.BaseSGMLHandler):
+
+        entitydefs = {'lt': '<', 'gt': '>', 'amp': '&', 'quot': '"',
+                      'copy': '\xa9', 'eacute': '\xe9'}
+
+        def __init__(self):
+            self.calls = 0
+            self.inserts = 0
+            self.literal = 0
+            self.pending = 0
+
+        def get_taginfo(self, tag):
+            return TagInfo(tag, _nullfunc, None, _nullfunc)
+
+        def handle_starttag(self, tag, method, attrs):
+            self.flush()
+            if tag == 'pre':
+                self.literal = self.literal + 1
+
+        def handle_endtag(self, tag, method):
+            self.flush()
+            if tag == 'pre':
+                self.literal = max(0, self.literal - 1)
+
+        def handle_data(self, data):
+            self.calls = self.calls + 1
+            if self.literal:
+                self.inserts = self.inserts + 1
+            else:
+                self.pending = 1
+
+        def flush(self):
+            if self.pending:
+                self.inserts = self.inserts + 1
+                self.pending = 0
+
+    return CountingHandler()
+
+
+def _profile(data, coalesce, size=8192):
+    handler = _counting_handler()
+    parser = SGMLParser(handler)
+    parser.coalesce = coalesce
+    parser.set_data_handler(handler.handle_data)
+    for i in range(0, len(data), size):
+        parser.feed(data[i:i+size])
+    parser.close()
+    handler.flush()
+    return handler.calls, handler.inserts
+
+def _replay(data, repeat=3):
+    # Return the best times for parsing data while recording it, and
+    # for replaying the log; and whether the handler saw the same thing.
+    # The data is fed in one piece, since the end of each feed() also
+    # ends a text run.
+    import time
+    best_parse = best_replay = None
+    for r in range(repeat):
+        handler = _counting_handler()
+        parser = SGMLParser(handler)
+        log = EventLog()
+        parser.record(log)
+        t0 = time.perf_counter()
+        parser.feed(data)
+        parser.close()
+        t1 = time.perf_counter()
+        again = _counting_handler()
+        parser = SGMLParser(again)
+        log.replay(parser)
+        parser.close()
+        t2 = time.perf_counter()
+        if best_parse is None or t1 - t0 < best_parse:
+            best_parse = t1 - t0
+        if best_replay is None or t2 - t1 < best_replay:
+            best_replay = t2 - t1
+    same = (handler.calls, handler.inserts) == (again.calls, again.inserts)
+    return best_parse, best_replay, same
+
+_sample = (
+    '<html><head><title>Caf&eacute; &amp; Bar</title></head><body>\n'
+    '<h1>Fish &amp; chips</h1>\n'
+    '<p>Prices &lt; &#163;5, &copy; 1996 the &quot;management&quot;.\n'
+    'Opening hours: 9&nbsp;am&nbsp;&ndash;&nbsp;5&nbsp;pm<br>\n'
+    '<pre>\n'
+    'if (a &lt; b &amp;&amp; c &gt; d) {\n'
+    '    printf("%d &lt;-&gt; %d\\n", a, b);\n'
+    '}\n'
+    '</pre>\n'
+    '<p>a < b, <!-- note --> x &#38; y</p>\n'
+    '</body></html>\n') * 50
+
+def test():
+    """Count the data handler calls and the Tk inserts they would cause.
+
+    The built-in sample and the files named on the command line are
+    parsed with and without merging adjacent data events.  Then the
+    time taken to parse each of them is compared with the time taken
+    to replay its event log.
+    """
+    import sys
+    inputs = [("sample", _sample)]
+    for file in sys.argv[1:]:
+        fp = open(file, encoding='latin-1')
+        inputs.append((file, fp.read()))
+        fp.close()
+    print("%-30s %17s %17s" % ("", "handler calls", "Tk inserts"))
+    for name, data in inputs:
+        calls, inserts = _profile(data, 0)
+        merged_calls, merged_inserts = _profile(data, 1)
+        print("%-30s %8d %8d %8d %8d"
+              % (name[-30:], calls, merged_calls, inserts, merged_inserts))
+    print()
+    print("%-30s %8s %8s" % ("", "parse", "replay"))
+    for name, data in inputs:
+        parse, replay, same = _replay(data)
+        print("%-30s %7.1fms %7.1fms%s"
+              % (name[-30:], parse * 1000, replay * 1000,
+                 not same and "  REPLAY DIFFERS" or ""))
+
+
+if __name__ == '__main__':
+    test()
@@ -6,7 +6,7 @@ import re
 from .SGMLLexer import *
 import string
 
-_entref_exp = re.compile("&\(\(#\|\)[a-zA-Z0-9][-.a-zA-Z0-9]*\)\(;\|\)")
+_entref_exp = re.compile("&((#|)[a-zA-Z0-9][-.a-zA-Z0-9]*)(;|)")
 
 _named_chars = {'#re' : '\r',
                 '#rs' : '\n',
@@ -15,12 +15,10 @@ _named_chars = {'#re' : '\r',
 for i in range(256):
     _named_chars["#" + repr(i)] = chr(i)
 
-#  build a table suitable for string.translate()
-_chartable = map(chr, range(256))
-for i in range(256):
-    if chr(i) in string.whitespace:
-        _chartable[i] = " "
-_chartable = str.join(_chartable, '')
+#  build a table suitable for str.translate()
+_chartable = {}
+for c in string.whitespace:
+    _chartable[ord(c)] = " "
 
 
 def replace(data, entities = None):
@@ -29,12 +27,13 @@ def replace(data, entities = None):
     data = str.translate(data, _chartable)
     if '&' in data and entities:
         value = None
-        pos = _entref_exp.search(data)
-        while pos >= 0 and pos + 1 < len(data):
-            ref, term = _entref_exp.group(1, 3)
-            if entities.has_key(ref):
+        m = _entref_exp.search(data)
+        while m and m.start() + 1 < len(data):
+            pos = m.start()
+            ref, term = m.group(1, 3)
+            if ref in entities:
                 value = entities[ref]
-            elif _named_chars.has_key(str.lower(ref)):
+            elif str.lower(ref) in _named_chars:
                 value = _named_chars[str.lower(ref)]
             if value is not None:
                 data = data[:pos] + value + data[pos+len(ref)+len(term)+1:]
@@ -42,5 +41,5 @@ def replace(data, entities = None):
                 value = None
             else:
                 pos = pos + len(ref) + len(term) + 1
-            pos = _entref_exp.search(data, pos)
+            m = _entref_exp.search(data, pos)
     return data
@@ -32,7 +32,7 @@ class TagExtensionLoader(grailbase.extloader.ExtensionLoader):
                 continue
             [action, tag] = parts
             start = do = end = None
-            if handlers.has_key(tag):
+            if tag in handlers:
                 start, do, end = handlers[tag]
             if action == 'start':
                 start = function
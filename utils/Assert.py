@@ -1,6 +1,6 @@
 # Trivial assertion function
 
-class AssertionError:
+class AssertionError(Exception):
     def __init__(self, msg):
     	self.msg = msg
     def __str__(self):
@@ -0,0 +1,179 @@
+"""Host name resolution with a shared cache.
+
+Lookups are done by a small pool of threads, so a slow name server
+never holds up the Tk event loop: resolve() returns at once with a
+Lookup object that the caller polls.  The answers are cached for all
+protocol modules, positive answers for POSITIVE_TTL seconds and
+negative ones (the name does not exist or has no addresses) for
+NEGATIVE_TTL seconds.  Other failures, such as a name server that
+timed out, are not cached, so the next resolve() tries again.  The
+resolver library does not tell us the real TTLs, so these are fixed.
+
+getaddrinfo() and gethostbyname() are blocking versions for code that
+cannot wait asynchronously; they share the cache.
+"""
+
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+POSITIVE_TTL = 300
+NEGATIVE_TTL = 30
+WORKERS = 4
+MAX_ENTRIES = 1000
+
+# getaddrinfo() errors that are answers from the name server
+NEGATIVE_ERRORS = [socket.EAI_NONAME]
+if hasattr(socket, 'EAI_NODATA'):
+    NEGATIVE_ERRORS.append(socket.EAI_NODATA)
+
+
+class Lookup:
+
+    """A host name lookup that may still be in progress."""
+
+    def __init__(self, host, future=None, answer=None):
+        self.host = host
+        self.future = future
+        self.answer = answer            # (addresses, error)
+
+    def done(self):
+        return self.answer is not None or self.future.done()
+
+    def wait(self, timeout=None):
+        """Block until the lookup is done; return true if it is."""
+        if self.answer is None:
+            try:
+                self.future.exception(timeout)
+            except Exception:
+                return 0
+        return 1
+
+    def addresses(self, port):
+        """Return a list of (family, sockaddr) pairs for a port.
+
+        Raise socket.error if the host name could not be resolved.
+        """
+        if self.answer is None:
+            self.answer = self.future.result()
+        addresses, error = self.answer
+        if error:
+            raise error
+        result = []
+        for family, sockaddr in addresses:
+            result.append((family, sockaddr[:1] + (port,) + sockaddr[2:]))
+        return result
+
+
+class Resolver:
+
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self.executor = None
+        self.lock = threading.Lock()
+        self.cache = {}                 # host -> (expires, addresses, error)
+        self.pending = {}               # host -> Future
+        self.hits = self.misses = 0
+
+    def resolve(self, host):
+        """Start looking up host; return a Lookup object."""
+        host = str.lower(host)
+        with self.lock:
+            answer = self.cached(host)
+            if answer:
+                self.hits = self.hits + 1
+                return Lookup(host, answer=answer)
+            self.misses = self.misses + 1
+            future = self.pending.get(host)
+            if not future:
+                if not self.executor:
+                    self.executor = ThreadPoolExecutor(self.workers)
+                future = self.executor.submit(self.lookup, host)
+                self.pending[host] = future
+        return Lookup(host, future)
+
+    def getaddrinfo(self, host, port):
+        """Blocking lookup; return a list of (family, sockaddr) pairs."""
+        return self.resolve(host).addresses(port)
+
+    def gethostbyname(self, host):
+        """Blocking lookup of an IPv4 address, like the socket module's."""
+        for family, sockaddr in self.getaddrinfo(host, 0):
+            if family == socket.AF_INET:
+                return sockaddr[0]
+        raise socket.gaierror(socket.EAI_NONAME,
+                              "no IPv4 address for %s" % host)
+
+    def flush(self):
+        with self.lock:
+            self.cache.clear()
+
+    def cached(self, host):
+        # Call with the lock held.
+        try:
+            expires, addresses, error = self.cache[host]
+        except KeyError:
+            return None
+        if expires < time.time():
+            del self.cache[host]
+            return None
+        return addresses, error
+
+    def lookup(self, host):
+        # Runs in a worker thread.
+        addresses, error = [], None
+        try:
+            for info in socket.getaddrinfo(host, 0, 0, socket.SOCK_STREAM):
+                addresses.append((info[0], info[4]))
+        except socket.error as msg:
+            error = msg
+        if not error:
+            expires = time.time() + POSITIVE_TTL
+        elif isinstance(error, socket.gaierror) \
+             and error.errno in NEGATIVE_ERRORS:
+            expires = time.time() + NEGATIVE_TTL
+        else:
+            # temporary failure; let the next resolve() retry
+            expires = None
+        with self.lock:
+            if expires is not None:
+                if len(self.cache) >= MAX_ENTRIES:
+                    self.expire()
+                self.cache[host] = (expires, addresses, error)
+            del self.pending[host]
+        return addresses, error
+
+    def expire(self):
+        # Call with the lock held.
+        now = time.time()
+        for host, (expires, addresses, error) in list(self.cache.items()):
+            if expires < now:
+                del self.cache[host]
+        if len(self.cache) >= MAX_ENTRIES:
+            self.cache.clear()
+
+
+resolver = Resolver()
+
+resolve = resolver.resolve
+getaddrinfo = resolver.getaddrinfo
+gethostbyname = resolver.gethostbyname
+
+
+def test():
+    """Look up the host names given on the command line, twice."""
+    import sys
+    for host in sys.argv[1:]:
+        for i in range(2):
+            t0 = time.time()
+            try:
+                addresses = getaddrinfo(host, 80)
+            except socket.error as msg:
+                addresses = msg
+            print("%s: %s (%.3f sec)" % (host, addresses, time.time() - t0))
+
+
+if __name__ == '__main__':
+    test()
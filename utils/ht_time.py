@@ -29,7 +29,7 @@ def _2dyear_to_4dyear(yy):
     else:
         return yy + 1900
 
-def parse(str):
+def parse(s):
     """Parses time in rfc850, rfc1123, and raw seconds formats. Returns
     seconds since the epoch corrected for timezone.
 
@@ -41,9 +41,9 @@ def parse(str):
     """
 
     # first we need to determine the format
-    if ',' in str:
-        noday = str.strip(str[str.find(str, ',')+1:])
-        if '-' in str:
+    if ',' in s:
+        noday = str.strip(s[str.find(s, ',')+1:])
+        if '-' in s:
             # Format...... Weekday, 00-Mon-00 00:00:00 GMT (rfc850)
             mday = int(noday[0:2])
             mon = _month_to_num(noday[3:6])
@@ -65,15 +65,15 @@ def parse(str):
         return secs - time.timezone
     else:
         # could be raw digits
-        if str[0] in string.digits:
-            return time.time() + int(str)
+        if s[0] in string.digits:
+            return time.time() + int(s)
         else:
-            mon = _month_to_num(str[4:7])
-            mday = int(str[8:10])
-            year = int(str[-4:])
-            hour = int(str[11:13])
-            min = int(str[14:16])
-            sec = int(str[17:19])
+            mon = _month_to_num(s[4:7])
+            mday = int(s[8:10])
+            year = int(s[-4:])
+            hour = int(s[11:13])
+            min = int(s[14:16])
+            sec = int(s[17:19])
             
             ### do we assume this is GMT time or not?
             ### let's assume it is